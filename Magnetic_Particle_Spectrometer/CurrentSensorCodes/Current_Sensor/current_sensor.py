@@ -1,23 +1,20 @@
+import os
+import sys
 import numpy as np
 import nidaqmx
 import time
 
 import wave_gen
 
+#the vectorized current analysis is shared with the MPS app (appended so the local wave_gen is still used)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import current_analysis
+
 fs=1000000
 num_samples = fs//10
 
 #current sensing variables:
-Vcc = 5.0
-VQ = 0.5 * Vcc
-sensitivity = 0.1
-voltages_raw = np.zeros(num_samples)
-currents = np.zeros(num_samples)
-squares = np.zeros(num_samples)
-squares_added = 0
-mean_square = 0
-rms_current = 0
-i = 0
+sensor = current_analysis.get_sensor('ACS712-20A') #'ACS712-5A' for the 5 A sensor (0.185 V/A)
 
 #Input parameters:
 vi = 2.377 #100mVpp
@@ -35,24 +32,13 @@ def receive_raw_voltage(daq_location, sample_rate, num_samples):
 
 
 def get_rms_current(daq_location, fs, num_samples):
-    global i, squares_added, rms_current
     voltage = receive_raw_voltage(daq_location, fs, num_samples)
-    squares_added = 0
-
-    for i in range(num_samples):
-        voltages_raw[i] = voltage[i]
-        voltage_corrected = voltages_raw[i] - VQ
-        currents[i] = voltage_corrected / sensitivity
-
-        squares[i] = currents[i] ** 2
-        squares_added += squares[i]
-
-    mean_square = squares_added / num_samples
-    rms_current = np.sqrt(mean_square)
+    stats = current_analysis.analyze_current(voltage, fs, f, sensor)
 
-    print(f"I(rms): {rms_current:.2f}")
+    print(f"I(rms): {stats.rms:.2f}  I(peak): {stats.peak:.2f}  I(dc): {stats.dc:.3f}  "
+          f"I({f} Hz): {stats.amplitude:.2f} A at {np.degrees(stats.phase):.1f} deg")
 
-    return rms_current
+    return stats.rms
 
 # Main loop
 daq_location = "Dev3/ai1"
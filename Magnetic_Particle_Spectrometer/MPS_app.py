@@ -1,15 +1,27 @@
+import startup  # first import: starts the time to interactive clock
 import customtkinter as ctk
 from tkinter import Listbox, filedialog
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+import simulation
+simulation.install_if_requested() #--simulate or MPS_SIMULATE=1, has to run before the hardware modules are imported
 import receive_and_analyze as analyze
 import numpy as np
 import wave_gen
-import nidaqmx
+import daq_session
+import live_stream
+import lock_in
+import plotting
+import sweep_engine
+import background_library
+import results_store
+import checkpoint
+import coherent_average
+import acquisition_worker
+import timing
 import time
-import threading
 import webbrowser
+from functools import partial
 
-from scipy.io import savemat
 from matplotlib.backends._backend_tk import NavigationToolbar2Tk
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
@@ -37,8 +49,28 @@ class App(ctk.CTk):
         self.harmonics = None
         self.slope = 10.339
         self.zoom_to_11_enabled = True
+        self.live_harmonics_only = False #live view computes the 11 harmonics only instead of the full spectrum
+        self.spectral_window = None  # harmonics from the closest bins (whole periods), or a window of analyze.WINDOWS
+        self.bin_interpolation = 'nominal'  # harmonic position between bins, see analyze.windowed_harmonics
         self.sample_frequency_array_magnitude = None
         self.run = 0
+        self.on_off = 0
+        self.live_stream = None  # background acquisition of the live frequency array
+        self.live_poll_ms = 30
+        self.live_lock_in = False  # live view runs the lock-in (harmonics 2-11 vs time) instead of spectra
+        self.lock_in_reference = 'current'  # 'current' channel or the 'sync' trigger (see lock_in.py)
+        self.lock_in_filter = 'iir'
+        self.lock_in_time_constant = 0.1  # s
+        self.lock_in_output_rate = 20  # outputs per second
+        self.lock_in_poll_ms = 100  # plot update interval of the lock-in view
+        self.backgrounds = background_library.BackgroundLibrary()  # measured backgrounds, kept on disk
+        self.results = results_store.ResultsStore()  # every run is streamed into ~/MPS_results (HDF5, one file per day)
+        self.store_raw_records = True  # also keep the raw DAQ records of every sweep step
+        self.last_run = None  # group of the last run in the results file
+        self.num_background_points = 6  # dc setpoints measured by 'Measure DC Backgrounds' (interpolated in between)
+        self.profile_next_run = False #opt-in cProfile capture of the next run (Settings > Run Timings)
+        self.worker = acquisition_worker.AcquisitionWorker(on_progress=self.show_progress)  # runs off the Tk thread
+        self.worker_poll_ms = 50
 
         self.title("MPS App")
         self.width = self.winfo_screenwidth()
@@ -54,6 +86,10 @@ class App(ctk.CTk):
         self.dc_offset = 0
         self.only_harmonics = False
         self.triggering_enabled = True
+        self.num_averages = 1  # coherently averaged frames per acquisition (retriggered, or back to back without trigger)
+        self.target_snr = 0  # adaptive acquisition: frames are added until these harmonics reach the SNR (0 = off)
+        self.snr_time_budget = 10.0  # s per acquisition in adaptive mode
+        self.snr_orders = [3, 5, 7]
 
         # DAQ Card Parameters
         self.daq_signal_channel = "Dev3/ai0"
@@ -128,73 +164,32 @@ class App(ctk.CTk):
         self.help_button.place(x=start_x + btn_spacing*6 + self.width * 0.08, y=btn_y, anchor='center')
 
         ############### Figures ########################
+        # plain matplotlib Figures, their Tk canvases and toolbars are built once the window is up (build_next_canvas)
+        # or when a panel is drawn before that
         x_fig = 5.5
         y_fig = 4
 
-        self.fig1 = plt.figure(figsize=(x_fig, y_fig))
+        self.fig1 = Figure(figsize=(x_fig, y_fig))
         self.ax1 = self.fig1.add_subplot(111)
 
-        self.fig2 = plt.figure(figsize=(x_fig, y_fig))
+        self.fig2 = Figure(figsize=(x_fig, y_fig))
         self.ax2 = self.fig2.add_subplot(111)
 
-        self.fig3 = plt.figure(figsize=(x_fig, y_fig))
+        self.fig3 = Figure(figsize=(x_fig, y_fig))
         self.ax3 = self.fig3.add_subplot(111)
 
-        self.fig4 = plt.figure(figsize=(x_fig, y_fig))
+        self.fig4 = Figure(figsize=(x_fig, y_fig))
         self.ax4 = self.fig4.add_subplot(111)
 
-        self.fig5 = plt.figure(figsize=(x_fig, y_fig))
+        self.fig5 = Figure(figsize=(x_fig, y_fig))
         self.ax5 = self.fig5.add_subplot(111)
 
-        self.fig6 = plt.figure(figsize=(x_fig, y_fig))
+        self.fig6 = Figure(figsize=(x_fig, y_fig))
         self.ax6 = self.fig6.add_subplot(111)
 
         y_canvas = [int(self.height *0.25), int(self.height * 0.7)]
         x_canvas = [int(self.width * 0.17), int(self.width * 0.5), int(self.width * 0.83)]
 
-        self.canvas1 = FigureCanvasTkAgg(self.fig1, master=self)
-        self.canvas1.get_tk_widget().place(x=x_canvas[0], y=y_canvas[0], anchor='center')
-
-        self.canvas2 = FigureCanvasTkAgg(self.fig2, master=self)
-        self.canvas2.get_tk_widget().place(x=x_canvas[1], y=y_canvas[0], anchor='center')
-
-        self.canvas3 = FigureCanvasTkAgg(self.fig3, master=self)
-        self.canvas3.get_tk_widget().place(x=x_canvas[2], y=y_canvas[0], anchor='center')
-
-        self.canvas4 = FigureCanvasTkAgg(self.fig4, master=self)
-        self.canvas4.get_tk_widget().place(x=x_canvas[0], y=y_canvas[1], anchor='center')
-
-        self.canvas5 = FigureCanvasTkAgg(self.fig5, master=self)
-        self.canvas5.get_tk_widget().place(x=x_canvas[1], y=y_canvas[1], anchor='center')
-
-        self.canvas6 = FigureCanvasTkAgg(self.fig6, master=self)
-        self.canvas6.get_tk_widget().place(x=x_canvas[2], y=y_canvas[1], anchor='center')
-
-        # For each canvas
-        self.toolbar1 = NavigationToolbar2Tk(self.canvas1, self)
-        self.toolbar1.update()
-        self.toolbar1.place(x=x_canvas[0]-int(self.width *0.075), y=y_canvas[0] + int(self.height * 0.22), anchor='center')
-
-        self.toolbar2 = NavigationToolbar2Tk(self.canvas2, self)
-        self.toolbar2.update()
-        self.toolbar2.place(x=x_canvas[1]-int(self.width *0.075), y=y_canvas[0] + int(self.height * 0.22), anchor='center')
-
-        self.toolbar3 = NavigationToolbar2Tk(self.canvas3, self)
-        self.toolbar3.update()
-        self.toolbar3.place(x=x_canvas[2]-int(self.width *0.075), y=y_canvas[0] + int(self.height * 0.22), anchor='center')
-
-        self.toolbar4 = NavigationToolbar2Tk(self.canvas4, self)
-        self.toolbar4.update()
-        self.toolbar4.place(x=x_canvas[0]-int(self.width *0.075), y=y_canvas[1] + int(self.height * 0.22), anchor='center')
-
-        self.toolbar5 = NavigationToolbar2Tk(self.canvas5, self)
-        self.toolbar5.update()
-        self.toolbar5.place(x=x_canvas[1]-int(self.width *0.075), y=y_canvas[1] + int(self.height * 0.22), anchor='center')
-
-        self.toolbar6 = NavigationToolbar2Tk(self.canvas6, self)
-        self.toolbar6.update()
-        self.toolbar6.place(x=x_canvas[2]-int(self.width *0.075), y=y_canvas[1] + int(self.height * 0.22), anchor='center')
-
         # Add a button for each figure to open the plot in a new window
         self.add_plot_button(self.fig1, x_canvas[0], y_canvas[0])
         self.add_plot_button(self.fig2, x_canvas[1], y_canvas[0])
@@ -203,6 +198,22 @@ class App(ctk.CTk):
         self.add_plot_button(self.fig5, x_canvas[1], y_canvas[1])
         self.add_plot_button(self.fig6, x_canvas[2], y_canvas[1])
 
+        # Retained mode plotting (lines are created once and updated with set_data):
+        self.panel1 = plotting.PlotPanel(self.fig1, self.ax1, make_canvas=partial(self.build_canvas, self.fig1,
+                                                                                   x_canvas[0], y_canvas[0]))
+        self.panel2 = plotting.PlotPanel(self.fig2, self.ax2, make_canvas=partial(self.build_canvas, self.fig2,
+                                                                                   x_canvas[1], y_canvas[0]))
+        self.panel3 = plotting.PlotPanel(self.fig3, self.ax3, make_canvas=partial(self.build_canvas, self.fig3,
+                                                                                   x_canvas[2], y_canvas[0]))
+        self.panel4 = plotting.PlotPanel(self.fig4, self.ax4, make_canvas=partial(self.build_canvas, self.fig4,
+                                                                                   x_canvas[0], y_canvas[1]))
+        self.panel5 = plotting.PlotPanel(self.fig5, self.ax5, make_canvas=partial(self.build_canvas, self.fig5,
+                                                                                   x_canvas[1], y_canvas[1]))
+        self.panel6 = plotting.PlotPanel(self.fig6, self.ax6, make_canvas=partial(self.build_canvas, self.fig6,
+                                                                                   x_canvas[2], y_canvas[1]))
+        self.panels = {self.ax1: self.panel1, self.ax2: self.panel2, self.ax3: self.panel3,
+                       self.ax4: self.panel4, self.ax5: self.panel5, self.ax6: self.panel6}
+
         #Clear Comparison Button:
         self.clear_plot_button(self.ax1, x_canvas[0], y_canvas[0])
         self.clear_plot_button(self.ax2, x_canvas[1], y_canvas[0])
@@ -211,7 +222,43 @@ class App(ctk.CTk):
         self.clear_plot_button(self.ax5, x_canvas[1], y_canvas[1])
         self.clear_plot_button(self.ax6, x_canvas[2], y_canvas[1])
 
+        ############### Status panel (timings of the last run) ########################
+        self.status_label = ctk.CTkLabel(self, text="No run yet", font=('Arial', int(self.height * 0.013)))
+        self.status_label.place(x=self.width // 2, y=int(self.height * 0.965), anchor='center')
+        self.progress_bar = ctk.CTkProgressBar(self, width=int(self.width * 0.1))
+        self.progress_bar.set(0)
+        self.progress_bar.place(x=int(self.width * 0.85), y=int(self.height * 0.965), anchor='center')
+        self.cancel_button = ctk.CTkButton(self, text="Cancel", command=self.cancel_jobs, width=0, hover_color="red")
+        self.cancel_button.place(x=int(self.width * 0.93), y=int(self.height * 0.965), anchor='center')
+        self.after(self.worker_poll_ms, self.poll_worker)
+        self.after_idle(self.finish_startup)
+
     ################ Functions for user interface ###########################
+    def build_canvas(self, figure, x, y):
+        # Tk canvas and toolbar of one figure
+        canvas = FigureCanvasTkAgg(figure, master=self)
+        canvas.get_tk_widget().place(x=x, y=y, anchor='center')
+        toolbar = NavigationToolbar2Tk(canvas, self)
+        toolbar.update()
+        toolbar.place(x=x-int(self.width *0.075), y=y + int(self.height * 0.22), anchor='center')
+        return canvas
+
+    def finish_startup(self):
+        # first idle pass of the event loop: the window is up and takes input. The hardware libraries are imported and
+        # the instruments discovered in the background, the canvases are built one per event loop pass
+        self.startup_time = startup.time_to_interactive()
+        print(f"Window interactive after {self.startup_time:.2f} s")
+        self.status_label.configure(text=f"Ready (started in {self.startup_time:.2f} s)")
+        startup.warm_up(discover=wave_gen.pool.discover)
+        self.after(1, self.build_next_canvas)
+
+    def build_next_canvas(self):
+        for panel in self.panels.values():
+            if not panel.has_canvas:
+                panel.canvas  # builds it
+                self.after(1, self.build_next_canvas)
+                return
+
     def clear_plot_button(self, ax, x, y):
         button = ctk.CTkButton(self, text="Clear", command=lambda: self.clear_plot(ax), width=0)
         button.place(x=x+int(self.width *0.1), y=y + int(self.height * 0.22), anchor="center")
@@ -220,8 +267,7 @@ class App(ctk.CTk):
         if ax is self.ax6: #if we are resetting ax6 which contains the MH curves compared
             self.run=0
 
-        ax.clear()
-        ax.figure.canvas.draw_idle()
+        self.panels[ax].clear()
 
     def add_plot_button(self, figure, x, y):
         button = ctk.CTkButton(self, text="View Full Plot", command=lambda: self.open_plot_window(figure), width=0)
@@ -239,7 +285,7 @@ class App(ctk.CTk):
         frame.pack(fill="both", expand=True)
 
         # Create a new figure for the new window (copy the content from the original figure)
-        new_figure = plt.Figure(figsize=figure.get_size_inches())
+        new_figure = Figure(figsize=figure.get_size_inches())
         new_ax = new_figure.add_subplot(111)
 
         # Copy plot data (lines, labels, etc.)
@@ -274,7 +320,7 @@ class App(ctk.CTk):
         scrollbar.pack(side="right", fill="y")
 
         listbox = Listbox(frame, height=6, yscrollcommand=scrollbar.set)
-        options = ['Save Results', 'Setup Analysis', 'Plot Settings']
+        options = ['Save Results', 'Setup Analysis', 'Plot Settings', 'Run Timings']
         for option in options:
             listbox.insert("end", option)
         listbox.pack(fill="both", expand=True)
@@ -283,12 +329,14 @@ class App(ctk.CTk):
         def on_select(event):
             selected = listbox.get(listbox.curselection())
             dropdown_window.destroy()
-            if selected == "Setup Analysis":
-                threading.Thread(target=self.open_setup_analysis_window).start()
+            if selected == "Setup Analysis":  # Tk windows are only created on the Tk thread
+                self.open_setup_analysis_window()
             elif selected == "Save Results":
-                threading.Thread(target=self.save_input).start()
+                self.save_input()
             elif selected == "Plot Settings":
-                threading.Thread(target=self.open_plot_settings_window).start()
+                self.open_plot_settings_window()
+            elif selected == "Run Timings":
+                self.open_timing_window()
 
         listbox.bind("<<ListboxSelect>>", on_select)
 
@@ -385,6 +433,17 @@ class App(ctk.CTk):
 
         y += self.height * 0.06
 
+        # Adaptive acquisition: target SNR of the harmonics (0 = off) and time budget per acquisition
+        snr_label = ctk.CTkLabel(small_frame, text="Target SNR / Budget (s)", font=label_font)
+        snr_label.place(x=x_spacing, y=y, anchor="center")
+        snr_entry = ctk.CTkEntry(small_frame, width=input_width // 2, height=input_height)
+        snr_entry.insert(0, str(self.target_snr))
+        snr_entry.place(x=x_spacing + input_width * 0.75 + self.width * 0.02, y=y, anchor="center")
+        budget_entry = ctk.CTkEntry(small_frame, width=input_width // 2, height=input_height)
+        budget_entry.insert(0, str(self.snr_time_budget))
+        budget_entry.place(x=x_spacing + input_width * 1.3 + self.width * 0.02, y=y, anchor="center")
+        y += self.height * 0.06
+
         def deselect_no():
             no_radio.deselect()
 
@@ -454,6 +513,13 @@ class App(ctk.CTk):
         num_periods_entry.place(x=daq_x_spacing + input_width + self.width * 0.02, y=daq_y, anchor="center")
         daq_y += self.height * 0.06
 
+        num_averages_label = ctk.CTkLabel(daq_frame, text="Num Averages:", font=label_font)
+        num_averages_label.place(x=daq_x_spacing, y=daq_y, anchor="center")
+        num_averages_entry = ctk.CTkEntry(daq_frame, width=input_width, height=input_height)
+        num_averages_entry.insert(0, str(self.num_averages))
+        num_averages_entry.place(x=daq_x_spacing + input_width + self.width * 0.02, y=daq_y, anchor="center")
+        daq_y += self.height * 0.06
+
         system_label = ctk.CTkLabel(daq_frame, text="MPS System:", font=label_font)
         system_label.place(x=daq_x_spacing, y=daq_y, anchor="center")
         sys_big_radio = ctk.CTkRadioButton(daq_frame, text="Big", fg_color='blue', hover_color="white",
@@ -500,6 +566,9 @@ class App(ctk.CTk):
             self.daq_trigger_channel = daq_trigger_option.get()
             self.sample_rate = int(sample_rate_entry.get())
             self.num_periods = int(num_periods_entry.get())
+            self.num_averages = max(1, int(num_averages_entry.get()))
+            self.target_snr = max(0.0, float(snr_entry.get()))
+            self.snr_time_budget = float(budget_entry.get())
 
             result_text = (
                 f"Saved Values:\n"
@@ -514,6 +583,8 @@ class App(ctk.CTk):
                 f"DAQ Trigger Channel: {self.daq_trigger_channel}\n"
                 f"Sample Rate: {self.sample_rate}\n"
                 f"Num Periods: {self.num_periods}\n"
+                f"Num Averages: {self.num_averages}\n"
+                f"Target SNR: {self.target_snr} (harmonics {self.snr_orders}, {self.snr_time_budget} s budget)\n"
                 f"Big MPS: {self.big_system}\n"
             )
             self.parameter_textbox.configure(state="normal")
@@ -539,7 +610,7 @@ class App(ctk.CTk):
     def open_plot_settings_window(self):
         plot_settings_window = ctk.CTkToplevel(self)
         plot_settings_window.title("Plot Settings")
-        plot_settings_window.geometry("300x150")
+        plot_settings_window.geometry("300x340")
         plot_settings_window.attributes("-topmost", True)
 
         def toggle_zoom():
@@ -556,6 +627,77 @@ class App(ctk.CTk):
         if self.zoom_to_11_enabled:
             zoom_checkbox.select()
 
+        def toggle_live_harmonics():
+            self.live_harmonics_only = bool(live_harmonics_checkbox.get())
+        live_harmonics_checkbox = ctk.CTkCheckBox(
+            plot_settings_window,
+            text="Live View: Harmonics Only",
+            command=toggle_live_harmonics
+        )
+        live_harmonics_checkbox.pack()
+        if self.live_harmonics_only:
+            live_harmonics_checkbox.select()
+
+        def toggle_lock_in():
+            self.live_lock_in = bool(lock_in_checkbox.get())
+        lock_in_checkbox = ctk.CTkCheckBox(
+            plot_settings_window,
+            text="Live View: Lock-In",
+            command=toggle_lock_in
+        )
+        lock_in_checkbox.pack(pady=(10, 0))
+        if self.live_lock_in:
+            lock_in_checkbox.select()
+
+        # Lock-in reference, filter and time constant (used by the next live view)
+        lock_in_frame = ctk.CTkFrame(plot_settings_window)
+        lock_in_frame.pack(pady=5)
+        def set_reference(value):
+            self.lock_in_reference = value
+        reference_option = ctk.CTkOptionMenu(lock_in_frame, values=list(lock_in.REFERENCES), command=set_reference,
+                                             width=80)
+        reference_option.set(self.lock_in_reference)
+        reference_option.grid(row=0, column=0, padx=2)
+        def set_filter(value):
+            self.lock_in_filter = value
+        filter_option = ctk.CTkOptionMenu(lock_in_frame, values=list(lock_in.FILTERS), command=set_filter, width=60)
+        filter_option.set(self.lock_in_filter)
+        filter_option.grid(row=0, column=1, padx=2)
+        def set_time_constant(event=None):
+            try:
+                self.lock_in_time_constant = float(time_constant_entry.get())
+            except ValueError:
+                print("Lock-in time constant has to be a number (s)")
+        time_constant_entry = ctk.CTkEntry(lock_in_frame, width=60)
+        time_constant_entry.insert(0, str(self.lock_in_time_constant))
+        time_constant_entry.bind("<Return>", set_time_constant)
+        time_constant_entry.bind("<FocusOut>", set_time_constant)
+        time_constant_entry.grid(row=0, column=2, padx=2)
+
+        # Window and bin interpolation of the harmonics (used by the next runs, sweeps and the live view)
+        window_frame = ctk.CTkFrame(plot_settings_window)
+        window_frame.pack(pady=5)
+        def interpolations(window):
+            # sinc only has a closed form for some windows, offering it for the others would fail every run
+            return [value for value in analyze.INTERPOLATIONS if value != 'sinc' or window in analyze.SINC_WINDOWS]
+        def set_window(value):
+            self.spectral_window = None if value == 'none' else value
+            allowed = interpolations(self.spectral_window)
+            interpolation_option.configure(values=allowed)
+            if self.bin_interpolation not in allowed:
+                self.bin_interpolation = 'nominal'
+                interpolation_option.set(self.bin_interpolation)
+        window_option = ctk.CTkOptionMenu(window_frame, values=['none'] + list(analyze.WINDOWS), command=set_window,
+                                          width=120)
+        window_option.set(self.spectral_window or 'none')
+        window_option.grid(row=0, column=0, padx=2)
+        def set_interpolation(value):
+            self.bin_interpolation = value
+        interpolation_option = ctk.CTkOptionMenu(window_frame, values=interpolations(self.spectral_window),
+                                                 command=set_interpolation, width=100)
+        interpolation_option.set(self.bin_interpolation)
+        interpolation_option.grid(row=0, column=1, padx=2)
+
         height = plot_settings_window.winfo_height()
         width = plot_settings_window.winfo_width()
 
@@ -669,9 +811,88 @@ class App(ctk.CTk):
         run_lbl.place(relx=0.5, rely=0.75, anchor="center")
 
         run_static_ac = ctk.CTkButton(frame, text='Run Static AC',command=self.auto_mode_static_ac)
-        run_static_ac.place( relx = 0.25, rely=0.9, relwidth=0.4, anchor="center")
+        run_static_ac.place( relx = 0.25, rely=0.85, relwidth=0.4, anchor="center")
         run_static_dc = ctk.CTkButton(frame, text='Run Static DC', command=self.auto_mode_static_dc)
-        run_static_dc.place(relx=0.75, rely=0.9, relwidth=0.4, anchor="center")
+        run_static_dc.place(relx=0.75, rely=0.85, relwidth=0.4, anchor="center")
+        measure_backgrounds = ctk.CTkButton(frame, text='Measure DC Backgrounds', command=self.measure_dc_backgrounds)
+        measure_backgrounds.place(relx=0.25, rely=0.94, relwidth=0.4, anchor="center")
+        resume_sweep = ctk.CTkButton(frame, text='Resume Sweep', command=self.resume_sweep)
+        resume_sweep.place(relx=0.75, rely=0.94, relwidth=0.4, anchor="center")
+
+    def open_timing_window(self):
+        timing_window = ctk.CTkToplevel(self)
+        timing_window.title("Run Timings")
+        timing_window.geometry("620x420")
+        timing_window.attributes("-topmost", True)
+
+        report = ctk.CTkTextbox(timing_window, font=('Courier', 12))
+        report.pack(fill="both", expand=True, padx=10, pady=(10, 0))
+        report.insert("end", timing.timer.report())
+        report.configure(state="disabled")
+
+        def toggle_profile():
+            self.profile_next_run = bool(profile_checkbox.get())
+        profile_checkbox = ctk.CTkCheckBox(timing_window, text="Profile next run (cProfile)", command=toggle_profile)
+        profile_checkbox.pack(pady=10)
+        if self.profile_next_run:
+            profile_checkbox.select()
+
+    def submit_job(self, label, work, done=None):
+        # queues work(job) on the acquisition worker, so the DAQ, the instruments and the analysis run off the Tk thread.
+        # The stage timings (and the cProfile capture if requested) are taken on the worker, done(result) updates the
+        # plots on the Tk thread once the job has finished
+        profile, self.profile_next_run = self.profile_next_run, False
+        status = []  # timing summary of this job (the timer already belongs to the next job when done runs)
+
+        def run(job):
+            timing.timer.start_run(label, profile=profile)
+            try:
+                return work(job)
+            finally:
+                timing.timer.finish_run()
+                status.append(timing.timer.status_line())
+
+        def finished(result):
+            self.progress_bar.set(1)
+            self.status_label.configure(text=status[0])
+            if done is not None:
+                done(result)
+
+        def failed(job, error):
+            self.progress_bar.set(0)
+            if isinstance(error, acquisition_worker.JobCancelled):
+                self.status_label.configure(text=f"{label}: cancelled")
+            else:
+                self.status_label.configure(text=f"{label}: failed ({error})")
+
+        self.status_label.configure(text=f"{label}: {'queued' if self.worker.busy else 'running...'}")
+        return self.worker.submit(label, run, finished, failed)
+
+    def poll_worker(self):
+        # results and progress of the acquisition worker are handled here, on the Tk thread
+        try:
+            self.worker.dispatch()
+        finally:
+            self.after(self.worker_poll_ms, self.poll_worker)  # keeps polling after an error in a plot update
+
+    def show_progress(self, job):
+        self.progress_bar.set(job.fraction)
+        self.status_label.configure(text=f"{job.name}: {job.message}")
+
+    def cancel_jobs(self):
+        # stops the running job at its next step (a sweep stays resumable) and drops the queued ones
+        if self.worker.cancel():
+            self.status_label.configure(text="Cancelling...")
+
+    def spectrum_xaxis(self, sample_rate):
+        # x limits and ticks (kHz) of the frequency spectrum plots
+        if self.zoom_to_11_enabled:
+            return (0, 11), range(1, 12)  # Zoom in to 11 harmonics, tick from 1 to 11
+        if sample_rate == 100000:
+            return None, [1, 5, 9, 13, 17, 21, 25, 29, 33, 37, 41, 45, 49]
+        elif sample_rate == 1000000:
+            return None, [25, 75, 125, 175, 225, 275, 325, 375, 425, 475]
+        return None, None
 
     def help(self):
         # URL to the rendered README.md on GitHub
@@ -679,10 +900,8 @@ class App(ctk.CTk):
         webbrowser.open(url)
     ##################### functions to run data acquisition #####################
     def calibrate_H_V(self):
-        self.H_cal = np.zeros(50)               #array to store the calibrated field
-        self.V_cal = np.zeros(50)
-
-        v_amplitude = 0 #start at 0
+        self.stop_live_stream()  # the live view holds the DAQ device
+        num_points = 50
         sample_rate = 100000  # no need for more than that for the 11th harmonic
         num_periods = int(self.num_periods)
 
@@ -695,47 +914,51 @@ class App(ctk.CTk):
 
         channel = int(self.channel)
 
-        # Connect to the waveform generator and send current voltage:
-        waveform_gen = wave_gen.connect_waveform_generator(gpib_address)
+        def calibrate(job):
+            H_cal = np.zeros(num_points)               #array to store the calibrated field
+            V_cal = np.zeros(num_points)
+            v_amplitude = 0 #start at 0
 
-        for l in range(50):
+            # Connect to the waveform generator and send current voltage:
+            waveform_gen = wave_gen.connect_waveform_generator(gpib_address)
+            try:
+                for l in range(num_points):
+                    job.progress(l / num_points, f"point {l + 1} of {num_points}")
 
-            wave_gen.send_voltage(waveform_gen, v_amplitude, frequency, channel)
-
-            if v_amplitude > 3:
-                v_amplitude = 0
+                    wave_gen.send_voltage(waveform_gen, v_amplitude, frequency, channel)
 
+                    if v_amplitude > 3:
+                        v_amplitude = 0
 
-            # get the sample's data:
-            i_rms = analyze.get_rms_current(current_source, sample_rate, num_periods, daq_trigger)
 
+                    # get the sample's data:
+                    i_rms = analyze.get_rms_current(current_source, sample_rate, num_periods, daq_trigger)
 
-            # get the magnetization from the detected rms current:
-            H_magnitude = self.coefficient * i_rms * np.sqrt(2)
 
-            self.H_cal[l] = H_magnitude
-            self.V_cal[l] = v_amplitude
+                    # get the magnetization from the detected rms current:
+                    H_magnitude = self.coefficient * i_rms * np.sqrt(2)
 
-            v_amplitude += 0.05
-            time.sleep(0.05)
+                    H_cal[l] = H_magnitude
+                    V_cal[l] = v_amplitude
 
-        wave_gen.turn_off(waveform_gen, channel)
-        self.ax1.clear()
-        self.ax1.set_title("H_V Calibrated", fontsize=11)
-        self.ax1.set_xlabel("V", fontsize=10)
-        self.ax1.set_ylabel("H", fontsize=10)
+                    v_amplitude += 0.05
+                    time.sleep(0.05)
+            finally:
+                wave_gen.turn_off(waveform_gen, channel)
+            return V_cal, H_cal
 
-        self.ax1.plot(self.V_cal, self.H_cal)
+        def show(result):
+            self.V_cal, self.H_cal = result
+            self.panel1.update("H_V Calibrated", "V", "H", {"calibration": (self.V_cal, self.H_cal)})
 
-        self.canvas1.draw()
+            self.slope, _ = np.polyfit(self.V_cal, self.H_cal, 1)
+            print(self.slope)
 
-        self.slope, _ = np.polyfit(self.V_cal, self.H_cal, 1)
-        print(self.slope)
+        self.submit_job("calibration", calibrate, show)
 
     def run_background_subtraction(self):
         # Turn the live_frequency display off if if it's on by switching state to 0:
-        self.mode = "background"
-        self.on_off = 0
+        self.stop_live_stream()
 
         # Retrieve necessary parameters from the GUI
         sample_rate = int(self.sample_rate)
@@ -755,81 +978,64 @@ class App(ctk.CTk):
         # Get the dc current you want to run through the helmoholtz coils:
         dc_current = float(self.dc_offset)  # Amps
 
-        # Call the background_subtraction function with appropriate arguments
-        num_samples, background_magnitude, background_frequency, background_phase, daq_readout, background_complex = analyze.get_background(
-            daq_signal, daq_source,daq_trigger, sample_rate, num_periods, gpib_address, V_amplitude, frequency, channel,
-            dc_current)
-
-        recon, integral = analyze.reconstruct_and_integrate(num_samples, background_frequency, background_magnitude,
-                                                            frequency)
-
-        # Store the values in the self object to later have the option of saving them as .mat files
-        self.num_samples = num_samples
-        self.background_frequency_array_magnitude = background_magnitude
-        self.background_frequency_array_frequency = background_frequency
-        self.background_frequency_array_phase = background_phase
-        self.background_frequency_array_complex = background_complex
-        self.frequency_back = background_frequency
-        self.phase = background_phase
-        self.recon = recon
-        self.magnetization = integral
-        self.background = daq_readout
-
-        # Update Plots:
-        self.ax1.clear()
-        self.ax1.set_title("Daq Readout", fontsize=11)
-        self.ax1.set_xlabel("Number Of Samples", fontsize=10)
-        self.ax1.set_ylabel("Magnitude", fontsize=10)
-        # self.ax1.set_facecolor('#505050')
-
-        self.ax1.plot(daq_readout)
-
-        self.canvas1.draw()
-
-        self.ax2.clear()
-        self.ax2.set_title("Background Frequency Spectrum (Magnitude)", fontsize=11)
-        self.ax2.set_xlabel("Frequency, kHz", fontsize=10)
-        self.ax2.set_ylabel("Magnitude", fontsize=10)
-        if self.zoom_to_11_enabled:
-            self.ax2.set_xlim(left=0, right=11)  # Zoom in to 11 harmonics
-            self.ax2.set_xticks(range(1, 12))  # Tick from 1 to 11
-        else:
-            if sample_rate == 100000:
-                self.ax2.set_xticks([1, 5, 9, 13, 17, 21, 25, 29, 33, 37, 41, 45, 49])
-            elif sample_rate == 1000000:
-                self.ax2.set_xticks([25, 75, 125, 175, 225, 275, 325, 375, 425, 475])
-
-        self.ax2.plot(background_frequency / 1000, background_magnitude)
-
-        self.canvas2.draw()
-
-        self.ax3.clear()
-        self.ax3.set_title("Reconstructed Waveform", fontsize=11)
-        self.ax3.set_xlabel("One Period", fontsize=10)
-        self.ax3.set_ylabel("Magnitude", fontsize=10)
-        # self.ax3.set_facecolor('#505050')
-
-        self.ax3.plot(recon)
-
-        self.canvas3.draw()
-
-        self.ax4.clear()
-        self.ax4.set_title("Magnetization", fontsize=11)
-        self.ax4.set_xlabel("One Period", fontsize=10)
-        self.ax4.set_ylabel("Magnitude", fontsize=10)
-        # self.ax3.set_facecolor('#505050')
-
-        self.ax4.plot(integral)
-
-        self.canvas4.draw()
+        num_averages = int(self.num_averages)
+        continuous = not self.triggering_enabled
+
+        def measure(job):
+            self.mode = "background"
+            average = self.frame_average(num_averages, continuous, job)
+            # Call the background_subtraction function with appropriate arguments
+            num_samples, background_magnitude, background_frequency, background_phase, daq_readout, background_complex = analyze.get_background(
+                daq_signal, daq_source,daq_trigger, sample_rate, num_periods, gpib_address, V_amplitude, frequency, channel,
+                dc_current, average=average)
+            job.progress(0.8, "analyzing")
+
+            recon, integral = analyze.reconstruct_and_integrate_fast(num_samples, background_frequency, background_magnitude,
+                                                                     frequency, np.angle(background_complex))
+
+            # Store the values in the self object to later have the option of saving them as .mat files
+            self.num_samples = num_samples
+            self.background_frequency_array_magnitude = background_magnitude
+            self.background_frequency_array_frequency = background_frequency
+            self.background_frequency_array_phase = background_phase
+            self.background_frequency_array_complex = background_complex
+            self.backgrounds.store(frequency, V_amplitude, dc_current, sample_rate, num_periods, background_complex)
+            self.frequency_back = background_frequency
+            self.phase = background_phase
+            self.recon = recon
+            self.magnetization = integral
+            self.background = daq_readout
+
+            run = self.start_results_run()
+            run.write('background', daq_readout)
+            run.write('background_frequency_array_frequency', background_frequency)
+            run.write('background_frequency_array_amplitude', background_complex)
+            run.write('magnetization', integral)
+            self.store_average(run, 'background', average)
+            run.close()
+            return daq_readout, background_frequency, background_magnitude, recon, integral
+
+        def show(result):
+            daq_readout, background_frequency, background_magnitude, recon, integral = result
+            # Update Plots:
+            self.panel1.update("Daq Readout", "Number Of Samples", "Magnitude", {"readout": (None, daq_readout)})
+
+            xlim, xticks = self.spectrum_xaxis(sample_rate)
+            self.panel2.update("Background Frequency Spectrum (Magnitude)", "Frequency, kHz", "Magnitude",
+                               {"spectrum": (background_frequency / 1000, background_magnitude)}, xlim, xticks)
+
+            self.panel3.update("Reconstructed Waveform", "One Period", "Magnitude", {"recon": (None, recon)})
+
+            self.panel4.update("Magnetization", "One Period", "Magnitude", {"magnetization": (None, integral)})
+
+        self.submit_job("background", measure, show)
 
     def run_with_sample(self):
-        self.mode = "standard sample"
-
         # Turn the live_frequency display off if if it's on by switching state to 0:
-        self.on_off = 0
+        self.stop_live_stream()
 
         self.run += 1
+        run_number = self.run
 
         # Retrieve necessary parameters from the GUI
         sample_rate = int(self.sample_rate)
@@ -849,105 +1055,87 @@ class App(ctk.CTk):
         # Get the dc current you want to run through the helmoholtz coils:
         dc_current = float(self.dc_offset)  # Amps
 
-        background_complex = self.background_frequency_array_complex
-
-        # get the sample's data:
-        (num_samples, sample_magnitude, signal_frequency, signal_with_background, sample_phase, i_rms,
-         signal_with_background_complex, sample_complex) = analyze.get_sample_signal(
-            daq_signal, daq_source, daq_trigger, sample_rate, num_periods, gpib_address, V_amplitude,
-            frequency, channel, dc_current, background_complex, self.only_harmonics)
+        only_harmonics = self.only_harmonics
 
-        sample_phase = np.abs(sample_magnitude)
-        self.num_samples = num_samples
-        self.signal_with_background = signal_with_background
-        self.signal_frequency_array_amplitude = signal_with_background_complex #this is the sample with its background (raw fourrier transform)
-        self.sample_frequency_array_magnitude = sample_magnitude
-        self.sample_frequency_array_amplitude = sample_complex
-        self.sample_frequency_array_frequency = signal_frequency #frequency array of the frequencies (considers sampling rate)
-
-        # reconstruct the waveform over one period and get the magnetization (integral)
-        recon, integral = analyze.reconstruct_and_integrate(num_samples, signal_frequency, sample_magnitude,
-                                                            frequency)
-
-        self.magnetization = integral  # to save to .mat file
+        num_averages = int(self.num_averages)
+        continuous = not self.triggering_enabled
+        snr = self.adaptive_settings(sample_rate, frequency)
 
-        # get the magnetic field from the detected rms current:
-        H_magnitude = self.coefficient * i_rms * np.sqrt(2)
-        H = analyze.general_reconstruction(H_magnitude, frequency)
+        def measure(job):
+            self.mode = "standard sample"
+            background_complex = self.background_frequency_array_complex  # also a background scan queued before this run
+            average = self.frame_average(num_averages, continuous, job, snr=snr, background=background_complex)
 
-        self.H_field = H  # to be saved to .mat file
-
-        # Update Plots:
-        self.ax1.clear()
-        self.ax1.set_title("Daq Readout", fontsize=11)
-        self.ax1.set_xlabel("Number Of Samples", fontsize=10)
-        self.ax1.set_ylabel("Magnitude", fontsize=10)
-        self.fig1.tight_layout()
-        # self.ax1.set_facecolor('#505050')
+            # get the sample's data:
+            (num_samples, sample_magnitude, signal_frequency, signal_with_background, sample_phase, i_rms,
+             signal_with_background_complex, sample_complex, current_voltage) = analyze.get_sample_signal(
+                daq_signal, daq_source, daq_trigger, sample_rate, num_periods, gpib_address, V_amplitude,
+                frequency, channel, dc_current, background_complex, only_harmonics, average=average)
+            job.progress(0.8, "analyzing")
 
-        self.ax1.plot(signal_with_background)
+            sample_phase = np.abs(sample_magnitude)
+            self.num_samples = num_samples
+            self.signal_with_background = signal_with_background
+            self.signal_frequency_array_amplitude = signal_with_background_complex #this is the sample with its background (raw fourrier transform)
+            self.sample_frequency_array_magnitude = sample_magnitude
+            self.sample_frequency_array_amplitude = sample_complex
+            self.sample_frequency_array_frequency = signal_frequency #frequency array of the frequencies (considers sampling rate)
 
-        self.canvas1.draw()
+            # reconstruct the waveform over one period and get the magnetization (integral). The phases keep M on the
+            # time base of the acquisition so it lines up with H(t) below
+            recon, integral = analyze.reconstruct_and_integrate_fast(num_samples, signal_frequency, sample_magnitude,
+                                                                     frequency, np.angle(sample_complex))
 
-        self.ax2.clear()
-        self.ax2.set_title("Sample's Frequency Spectrum (Backsubtracted)", fontsize=11)
-        self.ax2.set_xlabel("Frequency, kHz", fontsize=10)
-        self.ax2.set_ylabel("Magnitude", fontsize=10)
-        if self.zoom_to_11_enabled:
-            self.ax2.set_xlim(left=0, right=11)  # Zoom in to 11 harmonics
-            self.ax2.set_xticks(range(1, 12))  # Tick from 1 to 11
-        else:
-            if sample_rate == 100000:
-                self.ax2.set_xticks([1, 5, 9, 13, 17, 21, 25, 29, 33, 37, 41, 45, 49])
-            elif sample_rate == 1000000:
-                self.ax2.set_xticks([25, 75, 125, 175, 225, 275, 325, 375, 425, 475])
+            self.magnetization = integral  # to save to .mat file
 
-        self.ax2.plot(signal_frequency / 1000, sample_magnitude)
+            # get the magnetic field H(t) on the same one period grid from the harmonics of the measured drive current:
+            H = analyze.field_from_current(current_voltage, sample_rate, frequency, self.coefficient,
+                                           window=self.spectral_window, interpolation=self.bin_interpolation)
 
-        self.canvas2.draw()
+            self.H_field = H  # to be saved to .mat file
 
-        self.ax3.clear()
-        self.ax3.set_title("Reconstructed Waveform", fontsize=11)
-        self.ax3.set_xlabel("One Period", fontsize=10)
-        self.ax3.set_ylabel("Magnitude", fontsize=10)
-        # self.ax3.set_facecolor('#505050')
-
-        self.ax3.plot(recon)
-
-        self.canvas3.draw()
+            # Need half of a period for MH and dM/dH:
+            #integral = integral[:len(integral) // 2]
+            #H = H[:len(H) // 2]
+            dMdH = analyze.dMdH(integral, H)
 
-        self.ax4.clear()
-        self.ax4.set_title("Magnetization", fontsize=11)
-        self.ax4.set_xlabel("One Period", fontsize=10)
-        self.ax4.set_ylabel("Magnitude", fontsize=10)
-        # self.ax3.set_facecolor('#505050')
+            run = self.start_results_run()
+            run.write('signal_with_background', signal_with_background)
+            run.write('current_voltage', current_voltage)
+            run.write('sample_frequency_array_frequency', signal_frequency)
+            run.write('signal_frequency_array_amplitude', signal_with_background_complex)
+            run.write('sample_frequency_array_amplitude', sample_complex)
+            run.write('magnetization', integral)
+            run.write('magnetic_field', H)
+            self.store_average(run, 'signal', average)
+            run.close()
+            return signal_with_background, signal_frequency, sample_magnitude, recon, integral, H, dMdH
 
-        self.ax4.plot(integral)
+        def show(result):
+            signal_with_background, signal_frequency, sample_magnitude, recon, integral, H, dMdH = result
+            # Update Plots:
+            self.panel1.update("Daq Readout", "Number Of Samples", "Magnitude", {"readout": (None, signal_with_background)})
 
-        self.canvas4.draw()
+            xlim, xticks = self.spectrum_xaxis(sample_rate)
+            self.panel2.update("Sample's Frequency Spectrum (Backsubtracted)", "Frequency, kHz", "Magnitude",
+                               {"spectrum": (signal_frequency / 1000, sample_magnitude)}, xlim, xticks)
 
-        self.ax5.clear()
-        self.ax5.set_title("dM/dH Curve", fontsize=11)
-        self.ax5.set_xlabel("H", fontsize=10)
-        self.ax5.set_ylabel("dM/dH", fontsize=10)
-        # Need half of a period for MH and dM/dH:
-        #integral = integral[:len(integral) // 2]
-        #H = H[:len(H) // 2]
-        dMdH = analyze.dMdH(integral, H)
+            self.panel3.update("Reconstructed Waveform", "One Period", "Magnitude", {"recon": (None, recon)})
 
-        self.ax5.plot(H, dMdH)
+            self.panel4.update("Magnetization", "One Period", "Magnitude", {"magnetization": (None, integral)})
 
-        self.canvas5.draw()
+            self.panel5.update("dM/dH Curve", "H", "dM/dH", {"dMdH": (H, dMdH)})
 
-        self.ax6.set_title("MH Curve comparison", fontsize=11)
-        self.ax6.set_xlabel("H", fontsize=10)
-        self.ax6.set_ylabel("M", fontsize=10)
-        self.ax6.plot(H, integral, label='Run#' + str(self.run))
+            self.panel6.configure("MH Curve comparison", "H", "M")
+            self.panel6.add_line('Run#' + str(run_number), H, integral, legend=True, legend_loc='upper left')
 
-        self.ax6.legend(loc='upper left')
-        self.canvas6.draw()
+        self.submit_job("standard sample", measure, show)
 
     def run_live_frequency_array(self):
+        if self.worker.busy:  # the running job holds the DAQ device and the waveform generator
+            print("Wait for the running acquisition to finish (or cancel it) before starting the live view")
+            return
+        self.stop_live_stream()  # only one live stream at a time
         self.on_off = 1  # set the state to on
         # Retrieve necessary parameters from the GUI
         # Retrieve necessary parameters from the GUI
@@ -966,7 +1154,7 @@ class App(ctk.CTk):
         channel = int(self.channel)
 
         num_pts_per_period = sample_rate / frequency  # Fs/F_drive
-        num_samples = int((num_periods * num_pts_per_period) + 1)
+        num_samples = int(round(num_periods * num_pts_per_period))  # whole periods, no extra sample to leak
 
         if V_amplitude > 3:
             amplitude = 0
@@ -975,242 +1163,530 @@ class App(ctk.CTk):
         self.waveform_generator = waveform_generator  # will be used in the stop function
         wave_gen.send_voltage(waveform_generator, V_amplitude, frequency, channel)
 
-        with nidaqmx.Task() as task:
-            task.ai_channels.add_ai_voltage_chan(daq_signal)
-            task.timing.cfg_samp_clk_timing(sample_rate, samps_per_chan=num_samples)
+        if self.live_lock_in:
+            self.start_lock_in(sample_rate, frequency)
+            return
 
-            while self.on_off == 1:
-                voltage_raw = task.read(number_of_samples_per_channel=num_samples)  # read pure daq readout
+        # Continuous acquisition and the spectra run in background threads, the GUI only polls for the newest frame
+        self.live_stream = live_stream.LiveSpectrumStream(daq_signal, sample_rate, num_samples, frequency,
+                                                          harmonics_only=self.live_harmonics_only,
+                                                          window=self.spectral_window,
+                                                          interpolation=self.bin_interpolation)
+        self.live_stream.start()
+        self.live_frame_id = 0
+        self.after(self.live_poll_ms, self.poll_live_frame)
+
+    def poll_live_frame(self):
+        stream = self.live_stream
+        if stream is None:
+            return
+        if self.on_off != 1 or stream.error is not None:
+            if stream.error is not None:
+                print(f"Live acquisition stopped: {stream.error}")
+            self.stop_live_stream()
+            return
 
-                # Get the fourier data
-                fourier_magnitude, fourier_frequency, phase, fourier_amplitude = analyze.fourier(voltage_raw, sample_rate, num_samples)
-                fourier_magnitude = np.abs(fourier_magnitude)
+        frame = stream.latest_frame(self.live_frame_id) #None if nothing new, skipped frames are never drawn
+        if frame is not None:
+            self.live_frame_id, frequency, magnitude = frame
+            self.update_plot(frequency, magnitude, stream.sample_rate)
+        self.after(self.live_poll_ms, self.poll_live_frame)
+
+    def start_lock_in(self, sample_rate, frequency):
+        # Continuous harmonic tracking, the outputs are streamed into a 'lock-in' run of the results file
+        try:
+            demodulator = lock_in.LockIn(sample_rate, frequency, orders=range(2, 12),
+                                         time_constant=self.lock_in_time_constant, filter=self.lock_in_filter,
+                                         output_rate=self.lock_in_output_rate, reference=self.lock_in_reference)
+        except ValueError as e:
+            print(f"Lock-in not started: {e}")
+            self.stop_acquisition()  # the generator is already on
+            return
+        self.mode = 'lock-in'
+        run = self.results.start_run(self.mode, dict(self.run_parameters(), lock_in_reference=self.lock_in_reference,
+                                                     lock_in_filter=self.lock_in_filter,
+                                                     lock_in_time_constant=self.lock_in_time_constant,
+                                                     lock_in_output_rate=demodulator.output_rate))
+        run.write('orders', demodulator.orders)
+        self.last_run = run.name
+        trigger = self.daq_trigger_channel if self.lock_in_reference == 'sync' else None
+        self.live_stream = lock_in.LockInStream(self.daq_signal_channel, self.daq_current_channel, demodulator,
+                                                trigger_location=trigger, writer=run)
+        self.live_stream.start()
+        self.live_frame_id = 0
+        self.after(self.lock_in_poll_ms, self.poll_lock_in)
+
+    def poll_lock_in(self):
+        stream = self.live_stream
+        if stream is None:
+            return
+        if self.on_off != 1 or stream.error is not None:
+            if stream.error is not None:
+                print(f"Lock-in stopped: {stream.error}")
+            self.stop_live_stream()
+            return
 
-                self.update_plot(fourier_frequency, fourier_magnitude, sample_rate)
-                self.canvas1.draw()
-                self.update()
+        history = stream.history(self.live_frame_id)  # None if there are no new outputs
+        if history is not None:
+            self.live_frame_id, times, harmonics, _ = history
+            orders = stream.lock_in.orders
+            self.panel1.update("Lock-In Harmonics", "Time, s", "Magnitude",
+                               {f'H{order}': (times, np.abs(harmonics[:, i]), f'{order}') for i, order in
+                                enumerate(orders)}, legend=True, legend_loc='upper left')
+            self.panel2.update("Lock-In Phases (" + stream.lock_in.reference + " reference)", "Time, s", "Phase, rad",
+                               {f'H{order}': (times, np.angle(harmonics[:, i]), f'{order}') for i, order in
+                                enumerate(orders)})
+            if stream.dropped_samples:
+                self.status_label.configure(text=f"Lock-in behind, {stream.dropped_samples} samples dropped")
+        self.after(self.lock_in_poll_ms, self.poll_lock_in)
+
+    def stop_live_stream(self):
+        # Releases the DAQ from the live view (other acquisitions need the device)
+        self.on_off = 0
+        if self.live_stream is not None:
+            self.live_stream.stop()
+            self.live_stream = None
 
     def update_plot(self, frequency, magnitude, f_s):
-        # Update the plot
-        self.ax1.clear()
-        self.ax1.set_title("Frequency Spectrum", fontsize=11)
-        self.ax1.set_xlabel("Frequency, kHz", fontsize=10)
-        self.ax1.set_ylabel("Magnitude", fontsize=10)
-        if self.zoom_to_11_enabled:
-            self.ax1.set_xlim(left=0, right=11)  # Zoom in to 11 harmonics
-            self.ax1.set_xticks(range(1, 12))  # Tick from 1 to 11
-        else:
-            if f_s == 100000:
-                self.ax1.set_xticks([1, 5, 9, 13, 17, 21, 25, 29, 33, 37, 41, 45, 49])
-            elif f_s == 1000000:
-                self.ax1.set_xticks([25, 75, 125, 175, 225, 275, 325, 375, 425, 475])
-        self.ax1.plot(frequency / 1000, magnitude)
-        self.fig1.tight_layout()
+        # Update the plot (only the spectrum line is redrawn, the axes are blitted from a cached background)
+        xlim, xticks = self.spectrum_xaxis(f_s)
+        self.panel1.configure("Frequency Spectrum", "Frequency, kHz", "Magnitude", xlim, xticks)
+        self.panel1.blit_line("live spectrum", frequency / 1000, magnitude)
 
     def stop_acquisition(self):
         channel = int(self.channel)
-        self.waveform_generator.write(f"OUTPUT{channel} OFF")
-        self.on_off = 0  # set the state to off
-        self.waveform_generator.close()
-
-    def auto_mode_static_dc(self): #To record harmonics and compare them
-        self.mode = "auto mode static dc"
-        num_steps = self.num_steps
-        max_v= self.statdc_ac_amplitude * (1/self.slope) #the max field we want is 25mT initially
-        step_size = max_v / num_steps
+        self.stop_live_stream()  # set the state to off
+        wave_gen.turn_off(self.waveform_generator, channel)
 
+    def auto_mode_static_dc(self, resume=None): #To record harmonics and compare them
+        self.stop_live_stream()  # the live view holds the DAQ device
         harmonic_orders = list(range(1, 12))  #2nd to 11th
-        harmonic_indices = [1, 2, 3,4, 5, 6, 7, 8, 9, 10, 11]
-
-        self.max_H_field = np.zeros(num_steps+1)
-        self.harmonics = {order: np.zeros(num_steps+1) for order in harmonic_orders}
-        self.phases = {order: np.zeros(num_steps+1) for order in harmonic_orders}
-
-        v_amplitude = 0 #start at 0...
-
-        sample_rate = self.sample_rate  # no need for more than that for the 11th harmonic
-        num_periods = int(self.num_periods)
-
-        for i in range(len(harmonic_indices)):                          #the frequency array varies based on the number of samples
-            harmonic_indices[i]= harmonic_indices[i] * int(num_periods)
 
-        daq_signal = self.daq_signal_channel
-        daq_source = self.daq_current_channel
-        daq_trigger = self.daq_trigger_channel
-        gpib_address = 10
-
-        frequency = float(self.frequency)
+        if resume is None:
+            num_steps = self.num_steps
+            max_v= self.statdc_ac_amplitude * (1/self.slope) #the max field we want is 25mT initially
+            step_size = max_v / num_steps
+            v_amplitude = 0 #start at 0...
+
+            # setpoints: ac amplitude per step (None = above the 4.5 V limit, the output is left as it is)
+            amplitudes = []
+            for l in range(num_steps+1):
+                if v_amplitude > 4.5:
+                    v_amplitude = 0
+                    amplitudes.append(None)
+                else:
+                    amplitudes.append(v_amplitude)
+                v_amplitude += step_size
+
+            settings = {
+                'sample_rate': self.sample_rate,  # no need for more than that for the 11th harmonic
+                'num_periods': int(self.num_periods),
+                'daq_signal': self.daq_signal_channel,
+                'daq_source': self.daq_current_channel,
+                'daq_trigger': self.daq_trigger_channel,
+                'num_averages': int(self.num_averages),
+                'continuous_average': not self.triggering_enabled,
+                'adaptive': self.adaptive_settings(self.sample_rate, float(self.frequency)),
+                'window': self.spectral_window,
+                'interpolation': self.bin_interpolation,
+                'gpib_address': 10,
+                'frequency': float(self.frequency),
+                'channel': int(self.channel),
+                'dc_current': float(self.statdc_dc_offset),  # dc current through the helmholtz coils (A)
+                'coefficient': self.coefficient,
+            }
+        else:
+            settings, amplitudes = resume.parameters, resume.setpoints
+
+        num_steps = len(amplitudes) - 1
+        sample_rate = settings['sample_rate']
+        num_periods = settings['num_periods']
+        daq_signal = settings['daq_signal']
+        daq_source = settings['daq_source']
+        daq_trigger = settings['daq_trigger']
+        num_averages = settings.get('num_averages', 1)  # not in checkpoints of older sweeps
+        continuous = settings.get('continuous_average', False)
+        snr = settings.get('adaptive')
+        window = settings.get('window')
+        interpolation = settings.get('interpolation', 'nominal')
+        gpib_address = settings['gpib_address']
+        frequency = settings['frequency']
+        channel = settings['channel']
+        dc_current = settings['dc_current']
+        coefficient = settings['coefficient']
+
+        # ac voltage on the generator after every step (a None step keeps the previous one)
+        ac_voltages, ac_voltage = [], 0
+        for amplitude in amplitudes:
+            ac_voltage = ac_voltage if amplitude is None else amplitude
+            ac_voltages.append(ac_voltage)
+
+        def sweep(job):
+            self.mode = "auto mode static dc"
+            # taken when the job starts, so a background scan queued before the sweep is used
+            background_complex = (self.background_frequency_array_complex if resume is None
+                                  else resume.arrays.get('background'))
+
+            run, state = self.open_sweep(settings, amplitudes, harmonic_orders, resume, background=background_complex)
+            if snr is not None:
+                run.set_attrs(snr_orders=np.asarray(snr['orders']), target_snr=snr['target_snr'])
+
+            self.max_H_field = np.zeros(num_steps+1)
+            self.harmonics = {order: np.zeros(num_steps+1) for order in harmonic_orders}
+            self.phases = {order: np.zeros(num_steps+1) for order in harmonic_orders}
+            self.restore_sweep_data(state, harmonic_orders)
+            if 'H_field_harmonic' in state.data:
+                self.max_H_field[:state.completed] = state.data['H_field_harmonic'][:state.completed]
+
+            if resume is None:
+                #turn on dc offset:
+                power_supply = wave_gen.DC_offset(dc_current)
+                #connect to the waveform generator:
+                waveform_generator = wave_gen.connect_waveform_generator(gpib_address=gpib_address)
+                wave_gen.send_voltage(waveform_generator, 0, frequency, channel)
+            else:
+                # re-establish the instruments: dc current ramped up again, ac output of the last finished step
+                power_supply = wave_gen.connect_power_supply()
+                wave_gen.ramp_dc_current(power_supply, dc_current)
+                waveform_generator = wave_gen.connect_waveform_generator(gpib_address=gpib_address)
+                wave_gen.restore_output(waveform_generator, state.instrument.get('ac_voltage', 0), frequency, channel)
+
+            def apply(step, amplitude):
+                job.progress(step / len(amplitudes), f"step {step + 1} of {len(amplitudes)}")  # stops a cancelled sweep
+                if amplitude is not None:
+                    wave_gen.send_voltage(waveform_generator, amplitude, frequency, channel)
+
+            def acquire(step, amplitude):
+                average = self.frame_average(num_averages, continuous, job, False, snr, background_complex)
+                records = analyze.acquire_sample_records(daq_signal, daq_source, daq_trigger, sample_rate,
+                                                         num_periods, frequency, average=average)
+                return records, average
+
+            def process(step, amplitude, acquired):
+                records, average = acquired
+                # get the sample's harmonics only (targeted DFT instead of a full spectrum):
+                num_samples, orders, sample_harmonics, i_rms = analyze.analyze_sample_harmonics(
+                    records, sample_rate, frequency, background_complex, harmonic_orders, window, interpolation)
+
+                # get the magnetization from the detected rms current:
+                H_magnitude = coefficient * i_rms * np.sqrt(2)
+                self.max_H_field[step] = H_magnitude
+                self.store_harmonics(step, orders, sample_harmonics)
+                self.store_sweep_step(run, state, step, {'ac_voltage': ac_voltages[step], 'dc_current': dc_current},
+                                      harmonic_orders, orders, sample_harmonics, records, average,
+                                      ac_amplitude=amplitude, H_field_harmonic=H_magnitude, i_rms=i_rms)
+
+            complete = False
+            try:
+                sweep_engine.SweepEngine(apply, acquire, process).run(amplitudes, start=state.completed)
+                complete = True
+            finally:
+                self.close_sweep(run, state, complete)
+                if power_supply:
+                    wave_gen.turn_off_dc_output(power_supply)
+                if waveform_generator:
+                    wave_gen.turn_off(waveform_generator, channel)
+
+        def show(_):
+            self.plot_harmonics(field=self.max_H_field,dc_static=True)
+
+        self.submit_job("auto mode static dc", sweep, show)
+
+    def auto_mode_static_ac(self, resume=None):
+        self.stop_live_stream()  # the live view holds the DAQ device
+        harmonic_orders = list(range(1, 12))  # 2nd to 11th
 
-        channel = int(self.channel)
+        if resume is None:
+            num_steps = self.num_steps
+            max_current = self.statac_dc_offset #going from 0 to 10 A unless modified by user
+            step_size = max_current/ num_steps
 
-        # Get the dc current you want to run through the helmoholtz coils:
-        dc_current = float(self.statdc_dc_offset)  # Amps
-
-        #turn on dc offset:
-        power_supply = wave_gen.DC_offset(dc_current)
-        #connect to the waveform generator:
-        waveform_generator = wave_gen.connect_waveform_generator(gpib_address=gpib_address)
-        wave_gen.send_voltage(waveform_generator, v_amplitude, frequency, channel)
-        for l in range(num_steps+1):
+            v_amplitude = (1 / self.slope) * float(self.statac_ac_amplitude)
             if v_amplitude > 4.5:
                 v_amplitude = 0
-            else:
-                wave_gen.send_voltage(waveform_generator, v_amplitude, frequency, channel)
-
-            background_complex = self.background_frequency_array_complex
-
-            # get the sample's data:
-            num_samples, sample_magnitude, signal_frequency, signal_with_background, sample_phase, i_rms,\
-                signal_with_background_complex, sample_complex = analyze.get_sample_signal(
-                daq_signal, daq_source, daq_trigger, sample_rate, num_periods, gpib_address, amplitude=None,
-                frequency=frequency, channel=channel, dc_current=None, background_complex=background_complex, isClean=False)
-
-            self.frequency_array_magnitude = sample_magnitude
-
-            # get the magnetization from the detected rms current:
-            H_magnitude = self.coefficient * i_rms * np.sqrt(2)
-            self.max_H_field[l] = H_magnitude
-
-            # Store all harmonics
-            for i, order in enumerate(harmonic_orders):
-                self.harmonics[order][l] = sample_magnitude[harmonic_indices[i]]
-                self.phases[order][l] = sample_phase[harmonic_indices[i]]
-
-            v_amplitude += step_size
-            time.sleep(0.01)
-        if power_supply:
-            wave_gen.turn_off_dc_output(power_supply)
-            power_supply.close()
-        if waveform_generator:
-            wave_gen.turn_off(waveform_generator, channel)
-        self.plot_harmonics(field=self.max_H_field,dc_static=True)
-
-    def auto_mode_static_ac(self):
-        self.mode = "auto mode static ac"
-        num_steps = self.num_steps
-        max_current = self.statac_dc_offset #going from 0 to 10 A unless modified by user
-        step_size = max_current/ num_steps
-
-        harmonic_orders = list(range(1, 12))  # 2nd to 11th
-        harmonic_indices = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
 
-        self.i_dc = np.zeros(num_steps+1)
-        self.harmonics = {order: np.zeros(num_steps+1) for order in harmonic_orders}
-        self.phases = {order: np.zeros(num_steps+1) for order in harmonic_orders}
-        v_amplitude = 0  # start at 0...
+            settings = {
+                'sample_rate': self.sample_rate,  # no need for more than that for the 11th harmonic
+                'num_periods': int(self.num_periods),
+                'daq_signal': self.daq_signal_channel,
+                'daq_source': self.daq_current_channel,
+                'daq_trigger': self.daq_trigger_channel,
+                'num_averages': int(self.num_averages),
+                'continuous_average': not self.triggering_enabled,
+                'adaptive': self.adaptive_settings(self.sample_rate, float(self.frequency)),
+                'window': self.spectral_window,
+                'interpolation': self.bin_interpolation,
+                'gpib_address': 10,
+                'frequency': float(self.frequency),
+                'channel': int(self.channel),
+                'v_amplitude': v_amplitude,
+            }
 
-        sample_rate = self.sample_rate  # no need for more than that for the 11th harmonic
+            # setpoints: dc current per step, starting at 0
+            currents = [l * step_size for l in range(num_steps+1)]
+        else:
+            settings, currents = resume.parameters, resume.setpoints
+
+        num_steps = len(currents) - 1
+        sample_rate = settings['sample_rate']
+        num_periods = settings['num_periods']
+        daq_signal = settings['daq_signal']
+        daq_source = settings['daq_source']
+        daq_trigger = settings['daq_trigger']
+        num_averages = settings.get('num_averages', 1)  # not in checkpoints of older sweeps
+        continuous = settings.get('continuous_average', False)
+        snr = settings.get('adaptive')
+        window = settings.get('window')
+        interpolation = settings.get('interpolation', 'nominal')
+        gpib_address = settings['gpib_address']
+        frequency = settings['frequency']
+        channel = settings['channel']
+        v_amplitude = settings['v_amplitude']
+
+        def sweep(job):
+            self.mode = "auto mode static ac"
+            if resume is None:
+                # background per dc step from the library (interpolated between the measured dc currents), the last
+                # background scan is only used where the library has nothing for these settings. Taken when the job
+                # starts, so backgrounds queued before the sweep are used
+                backgrounds = [self.backgrounds.interpolate_dc(frequency, v_amplitude, current, sample_rate, num_periods)
+                               for current in currents]
+                print(f"Background library covers {sum(b is not None for b in backgrounds)} of {len(currents)} dc steps")
+                fallback = getattr(self, 'background_frequency_array_complex', None)
+                backgrounds = [fallback if b is None else b for b in backgrounds]
+                stored_backgrounds = None if any(b is None for b in backgrounds) else np.array(backgrounds)
+            else:
+                stored_backgrounds = resume.arrays.get('backgrounds')
+                backgrounds = [None] * len(currents) if stored_backgrounds is None else list(stored_backgrounds)
+
+            run, state = self.open_sweep(settings, currents, harmonic_orders, resume, backgrounds=stored_backgrounds)
+            if snr is not None:
+                run.set_attrs(snr_orders=np.asarray(snr['orders']), target_snr=snr['target_snr'])
+
+            self.i_dc = np.zeros(num_steps+1)
+            self.harmonics = {order: np.zeros(num_steps+1) for order in harmonic_orders}
+            self.phases = {order: np.zeros(num_steps+1) for order in harmonic_orders}
+            self.restore_sweep_data(state, harmonic_orders)
+            self.i_dc[:state.completed] = currents[:state.completed]
+
+            # Connect the waveform generator and send a signal for background measurement
+            waveform_generator = wave_gen.connect_waveform_generator(gpib_address)
+            if resume is None:
+                wave_gen.send_voltage(waveform_generator, v_amplitude, frequency, channel)
+                # dc current starting at 0:
+                power_supply = wave_gen.DC_offset(0)
+            else:
+                # re-establish the instruments: ac output again, dc current ramped up to the last finished step
+                wave_gen.restore_output(waveform_generator, v_amplitude, frequency, channel)
+                power_supply = wave_gen.connect_power_supply()
+                wave_gen.ramp_dc_current(power_supply, state.instrument.get('dc_current', 0))
+
+            def apply(step, current):
+                job.progress(step / len(currents), f"step {step + 1} of {len(currents)}")  # stops a cancelled sweep
+                wave_gen.send_dc_voltage(power_supply, voltage=12, current=current)
+
+            def acquire(step, current):
+                average = self.frame_average(num_averages, continuous, job, False, snr, backgrounds[step])
+                records = analyze.acquire_sample_records(daq_signal, daq_source, daq_trigger, sample_rate,
+                                                         num_periods, frequency, average=average)
+                return records, average
+
+            def process(step, current, acquired):
+                records, average = acquired
+                # get the sample's harmonics only (targeted DFT instead of a full spectrum):
+                num_samples, orders, sample_harmonics, i_rms = analyze.analyze_sample_harmonics(
+                    records, sample_rate, frequency, backgrounds[step], harmonic_orders, window, interpolation)
+
+                self.i_dc[step] = current
+                self.store_harmonics(step, orders, sample_harmonics)
+                self.store_sweep_step(run, state, step, {'ac_voltage': v_amplitude, 'dc_current': current},
+                                      harmonic_orders, orders, sample_harmonics, records, average, i_dc=current,
+                                      i_rms=i_rms)
+
+            complete = False
+            try:
+                sweep_engine.SweepEngine(apply, acquire, process).run(currents, start=state.completed)
+                complete = True
+            finally:
+                self.close_sweep(run, state, complete)
+                wave_gen.turn_off_dc_output(power_supply)
+                wave_gen.turn_off(waveform_generator, channel)
+
+        def show(_):
+            self.plot_harmonics(field = self.i_dc ,dc_static=False)
+
+        self.submit_job("auto mode static ac", sweep, show)
+
+    def resume_sweep(self):
+        # continues the automated sweep that was interrupted (crash, instrument error, closed App) from the first
+        # setpoint that was not finished, with the parameters and backgrounds of the interrupted sweep
+        state = checkpoint.SweepCheckpoint.load()
+        if state is None:
+            print("No interrupted sweep to resume")
+            return
+        if state.finished:
+            print(f"Nothing left to resume ({state.describe()})")
+            state.clear()
+            return
+        print(f"Resuming {state.describe()}")
+        if state.mode == "auto mode static dc":
+            self.auto_mode_static_dc(resume=state)
+        else:
+            self.auto_mode_static_ac(resume=state)
+
+    def open_sweep(self, settings, setpoints, harmonic_orders, resume, **arrays):
+        # results run and checkpoint of a new sweep, or those of the interrupted sweep when resuming
+        if resume is not None:
+            run = self.results.resume_run(resume.parameters['results_run'], resume.parameters['results_file'])
+            if run is not None:
+                run.truncate('raw_records', resume.completed)  # records of a step that was not finished
+                self.last_run = run.name
+                return run, resume
+            print("The results run of the interrupted sweep is missing, the remaining steps go to a new run")
+        run = self.start_results_run()
+        run.write('orders', harmonic_orders)
+        if resume is not None:
+            resume.parameters.update(results_file=self.results.path, results_run=run.name)
+            resume.save()
+            return run, resume
+        state = checkpoint.SweepCheckpoint(self.mode, dict(settings, results_file=self.results.path,
+                                                           results_run=run.name), setpoints, arrays)
+        state.save()
+        return run, state
+
+    def close_sweep(self, run, state, complete):
+        run.close(complete)
+        if complete:
+            state.clear()
+        else:
+            print(f"Sweep interrupted, {state.describe()}. 'Resume Sweep' continues it.")
+
+    def restore_sweep_data(self, state, harmonic_orders):
+        # harmonics of the steps that were finished before the sweep was interrupted (none for a new sweep)
+        harmonics = state.data.get('harmonics')
+        for step in range(state.completed if harmonics is not None else 0):
+            measured = ~np.isnan(harmonics[step])  # orders above nyquist were not measured
+            self.store_harmonics(step, np.array(harmonic_orders)[measured], harmonics[step][measured])
+
+    def measure_dc_backgrounds(self):
+        # background scans (no sample in the coil) at a few dc currents of the static ac sweep, stored in the library
+        # so auto_mode_static_ac can interpolate the background of every step
+        self.stop_live_stream()
+        sample_rate = self.sample_rate
         num_periods = int(self.num_periods)
-
-        for i in range(len(harmonic_indices)):                          #the frequency array varies based on the number of samples
-            harmonic_indices[i]= harmonic_indices[i] * int(num_periods)
-
-        daq_signal = self.daq_signal_channel
-        daq_source = self.daq_current_channel
-        daq_trigger = self.daq_trigger_channel
-        gpib_address = 10
-
         frequency = float(self.frequency)
-
         channel = int(self.channel)
         v_amplitude = (1 / self.slope) * float(self.statac_ac_amplitude)
         if v_amplitude > 4.5:
             v_amplitude = 0
 
-        # Connect the waveform generator and send a signal for background measurement
-        waveform_generator = wave_gen.connect_waveform_generator(gpib_address)
-        wave_gen.send_voltage(waveform_generator, v_amplitude, frequency, channel)
-
-        # dc current starting at 0:
-        dc_current = 0
-        power_supply = wave_gen.DC_offset(dc_current)
-        for l in range(num_steps+1):
-            wave_gen.send_dc_voltage(power_supply, voltage=12, current=dc_current)
-            background_complex = self.background_frequency_array_complex
-
-            # get the sample's data:
-            (num_samples, sample_magnitude, signal_frequency, signal_with_background, sample_phase, i_rms,
-             signal_with_background_complex, sample_complex) = analyze.get_sample_signal(
-                daq_signal, daq_source, daq_trigger, sample_rate, num_periods, gpib_address, amplitude=None,
-                frequency=frequency, channel=channel, dc_current=None, background_complex=background_complex,
-                isClean=False)
-
-            self.frequency_array_magnitude = sample_magnitude
-
-            self.i_dc[l] = dc_current
-
-            # Store all harmonics
-            for i, order in enumerate(harmonic_orders):
-                self.harmonics[order][l] = sample_magnitude[harmonic_indices[i]]
-                self.phases[order][l] = sample_phase[harmonic_indices[i]]
-
-            dc_current += step_size
-            time.sleep(0.01)
-        wave_gen.turn_off_dc_output(power_supply)
-        power_supply.close()
-        wave_gen.turn_off(waveform_generator, channel)
-        self.plot_harmonics(field = self.i_dc ,dc_static=False)
+        daq_channels = self.daq_signal_channel, self.daq_current_channel, self.daq_trigger_channel
+        dc_currents = np.linspace(0, self.statac_dc_offset, self.num_background_points)
+        num_averages = int(self.num_averages)
+        continuous = not self.triggering_enabled
+
+        def measure(job):
+            for k, dc_current in enumerate(dc_currents):
+                job.progress(k / len(dc_currents), f"{dc_current:.2f} A ({k + 1} of {len(dc_currents)})")
+                result = analyze.get_background(*daq_channels, sample_rate, num_periods, 10, v_amplitude,
+                                                frequency, channel, dc_current,
+                                                average=self.frame_average(num_averages, continuous, job, False))
+                self.backgrounds.store(frequency, v_amplitude, dc_current, sample_rate, num_periods, result[-1])
+            print(f"Stored backgrounds at {len(dc_currents)} dc currents up to {dc_currents[-1]} A")
+
+        self.submit_job("dc backgrounds", measure)
+
+    def adaptive_settings(self, sample_rate, frequency):
+        # arguments of coherent_average.AdaptiveAverage for the current settings, None when the SNR target is off
+        if not self.target_snr:
+            return None
+        return {'target_snr': float(self.target_snr), 'time_budget': float(self.snr_time_budget),
+                'sample_rate': sample_rate, 'frequency': frequency, 'orders': list(self.snr_orders)}
+
+    def frame_average(self, num_averages, continuous, job, progress=True, snr=None, background=None):
+        # coherent average of num_averages frames (None: a single record), or with snr (adaptive_settings) as many
+        # frames as the harmonics need to reach the target SNR over the background subtracted signal. Every frame is
+        # a cancel point of the job and, with progress, advances its progress up to the analysis (0.8)
+        def on_frame(average):
+            if progress:
+                job.progress(0.8 * average.progress, average.describe())
+            else:
+                job.check_cancelled()
+        if snr is not None:
+            return coherent_average.AdaptiveAverage(**snr, background=background, continuous=continuous,
+                                                    on_frame=on_frame)
+        if num_averages <= 1:
+            return None
+        return coherent_average.FrameAverage(num_averages, continuous, on_frame)
+
+    def store_average(self, run, name, average):
+        # standard error of the averaged record (first channel) and of its fourier coefficients
+        if average is not None:
+            run.write(name + '_standard_error', average.standard_error[0])
+            run.set_attrs(frames_averaged=average.count, spectrum_standard_error=float(average.spectrum_error()[0]))
+        if isinstance(average, coherent_average.AdaptiveAverage):
+            run.write(name + '_harmonic_snr', average.snr)
+            run.set_attrs(snr_orders=average.orders, achieved_snr=float(average.min_snr),
+                          acquisition_time=average.elapsed)
+            print(f"Achieved SNR {average.min_snr:.1f} (target {average.target_snr:g}) with {average.count} frames "
+                  f"in {average.elapsed:.1f} s")
+
+    def start_results_run(self):
+        # new run group in the HDF5 results file, with the current parameters as attributes
+        run = self.results.start_run(self.mode, self.run_parameters())
+        self.last_run = run.name
+        return run
+
+    def store_sweep_step(self, run, state, step, instrument, harmonic_orders, orders, sample_harmonics, records,
+                         average, **values):
+        # appends one sweep step to the results file (orders above nyquist stay NaN), then checkpoints it
+        harmonics = np.full(len(harmonic_orders), np.nan, dtype=complex)
+        harmonics[:len(orders)] = sample_harmonics
+        if average is not None:  # standard error of the step's harmonics (coherently averaged frames)
+            values['harmonics_standard_error'] = average.spectrum_error()[0]
+            values['frames_averaged'] = average.count
+        if isinstance(average, coherent_average.AdaptiveAverage):  # achieved SNR of average.orders
+            values['snr'] = average.snr
+        run.write_step(step, harmonics=harmonics, **values)
+        if self.store_raw_records:
+            run.append('raw_records', records[np.newaxis])
+        state.step_done(step, instrument, harmonics=harmonics, **values)
+
+    def store_harmonics(self, step, orders, sample_harmonics):
+        # Store all harmonics of one sweep step
+        for order, amplitude in zip(orders, sample_harmonics):
+            self.harmonics[order][step] = np.abs(amplitude)
+            self.phases[order][step] = np.angle(amplitude)
 
     def plot_harmonics(self, field, dc_static=False):
-        self.ax1.clear()
-        self.ax2.clear()
-        self.ax3.clear()
-        self.ax4.clear()
-        self.ax5.clear()
-        self.ax6.clear()
         if dc_static:
             field_txt = "μo H (mT)"
         else:
             field_txt = "I_DC (A)"
 
-        self.ax1.set_title("Odd Harmonics, Magnitude vs Field", fontsize=11)
-        self.ax1.set_xlabel(field_txt, fontsize=10)
-        self.ax1.set_ylabel("Magnitude", fontsize=10)
-
-        self.ax2.set_title("Even Harmonics, Magnitude vs Field", fontsize=11)
-        self.ax2.set_xlabel(field_txt, fontsize=10)
-        self.ax2.set_ylabel("Magnitude", fontsize=10)
+        def label(order):
+            return f'{order}rd Harmonic' if order == 3 else f'{order}nd Harmonic' if order == 2 else f'{order}th Harmonic'
 
-        for order in [3, 5, 7, 9, 11]: #odd harmonics
-            self.ax1.plot(field, self.harmonics[order],
-                          label=f'{order}rd Harmonic' if order == 3 else f'{order}th Harmonic')
+        odd_orders = [3, 5, 7, 9, 11]
+        even_orders = [2, 4, 6, 8, 10]
 
-        for order in [2, 4, 6, 8, 10]: #Even Harmonics
-            self.ax2.plot(field, self.harmonics[order],
-                          label=f'{order}nd Harmonic' if order == 2 else f'{order}th Harmonic')
-        self.ax1.legend()
-        self.ax2.legend()
-        self.canvas1.draw()
-        self.canvas2.draw()
+        self.panel1.update("Odd Harmonics, Magnitude vs Field", field_txt, "Magnitude",
+                           {order: (field, self.harmonics[order], label(order)) for order in odd_orders}, legend=True)
+        self.panel2.update("Even Harmonics, Magnitude vs Field", field_txt, "Magnitude",
+                           {order: (field, self.harmonics[order], label(order)) for order in even_orders}, legend=True)
 
         #Plot harmonic2/harmonic3:
-        self.ax3.set_title("2nd/3rd Harmonics, Magnitude vs Field", fontsize=11)
-        self.ax3.set_xlabel(field_txt, fontsize=10)
-        self.ax3.set_ylabel("Harmonics", fontsize=10)
-
-        self.ax3.plot(field, self.harmonics[2]/self.harmonics[3])
-        self.canvas3.draw()
+        self.panel3.update("2nd/3rd Harmonics, Magnitude vs Field", field_txt, "Harmonics",
+                           {"ratio": (field, self.harmonics[2]/self.harmonics[3])})
 
         #Plot Phases:
-        self.ax4.set_title("Odd Harmonics, Phase vs Field", fontsize=11)
-        self.ax4.set_xlabel(field_txt, fontsize=10)
-        self.ax4.set_ylabel("Phase (°)", fontsize=10)
-
-        self.ax5.set_title("Even Harmonics, Phase vs Field", fontsize=11)
-        self.ax5.set_xlabel(field_txt, fontsize=10)
-        self.ax5.set_ylabel("Phase (°)", fontsize=10)
-
-        for order in [3, 5, 7, 9, 11]: #odd harmonics
-            self.ax4.plot(field, self.phases[order]*(180/np.pi),
-                          label=f'{order}rd Harmonic' if order == 3 else f'{order}th Harmonic')
-
-        for order in [2, 4, 6, 8, 10]: #Even Harmonics
-            self.ax5.plot(field, self.phases[order]*(180/np.pi),
-                          label=f'{order}nd Harmonic' if order == 2 else f'{order}th Harmonic')
-        self.ax4.legend()
-        self.ax5.legend()
-        self.canvas4.draw()
-        self.canvas5.draw()
+        self.panel4.update("Odd Harmonics, Phase vs Field", field_txt, "Phase (°)",
+                           {order: (field, self.phases[order]*(180/np.pi), label(order)) for order in odd_orders},
+                           legend=True)
+        self.panel5.update("Even Harmonics, Phase vs Field", field_txt, "Phase (°)",
+                           {order: (field, self.phases[order]*(180/np.pi), label(order)) for order in even_orders},
+                           legend=True)
+        self.panel6.clear()
 
     def direct_update(self):
         if self.mode == "standard sample":
@@ -1228,98 +1704,72 @@ class App(ctk.CTk):
             fourier_magnitude = analyze.harmonics(fourier_magnitude, fourier_freq, self.frequency, self.sample_rate)
 
         # reconstruct the waveform over one period and get the magnetization (integral)
-        recon, integral = analyze.reconstruct_and_integrate(self.num_samples, fourier_freq, fourier_magnitude,
-                                                            self.frequency)
+        recon, integral = analyze.reconstruct_and_integrate_fast(self.num_samples, fourier_freq, fourier_magnitude,
+                                                                 self.frequency, np.angle(fourier_complex))
 
         self.magnetization = integral  # to save to .mat file
 
-        # Update Plots:
-        self.ax1.clear()
-        self.ax1.set_title("Daq Readout", fontsize=11)
-        self.ax1.set_xlabel("Number Of Samples", fontsize=10)
-        self.ax1.set_ylabel("Magnitude", fontsize=10)
-        self.fig1.tight_layout()
-        # self.ax1.set_facecolor('#505050')
-
+        # Update Plots (the daq readout is the same array as before, so canvas 1 is not redrawn):
         if self.mode == "standard sample":
-            self.ax1.plot(self.signal_with_background)
-        elif self.mode == "background":
-            self.ax1.plot(self.background)
-
-        self.canvas1.draw()
-
-        self.ax2.clear()
-        if self.mode == "standard sample":
-            self.ax2.set_title("Sample's Frequency Spectrum (Backsubtracted)", fontsize=11)
-        elif self.mode == "background":
-            self.ax2.set_title("Background Frequency Spectrum", fontsize=11)
-        self.ax2.set_xlabel("Frequency, kHz", fontsize=10)
-        self.ax2.set_ylabel("Magnitude", fontsize=10)
-        if self.zoom_to_11_enabled:
-            self.ax2.set_xlim(left=0, right=11)  # Zoom in to 11 harmonics
-            self.ax2.set_xticks(range(1, 12))  # Tick from 1 to 11
+            self.panel1.update("Daq Readout", "Number Of Samples", "Magnitude",
+                               {"readout": (None, self.signal_with_background)})
+            spectrum_title = "Sample's Frequency Spectrum (Backsubtracted)"
         else:
-            if self.sample_rate == 100000:
-                self.ax2.set_xticks([1, 5, 9, 13, 17, 21, 25, 29, 33, 37, 41, 45, 49])
-            elif self.sample_rate == 1000000:
-                self.ax2.set_xticks([25, 75, 125, 175, 225, 275, 325, 375, 425, 475])
-
-        self.ax2.plot(fourier_freq / 1000, fourier_magnitude)
+            self.panel1.update("Daq Readout", "Number Of Samples", "Magnitude", {"readout": (None, self.background)})
+            spectrum_title = "Background Frequency Spectrum"
 
-        self.canvas2.draw()
+        xlim, xticks = self.spectrum_xaxis(self.sample_rate)
+        self.panel2.update(spectrum_title, "Frequency, kHz", "Magnitude",
+                           {"spectrum": (fourier_freq / 1000, fourier_magnitude)}, xlim, xticks)
 
-        self.ax3.clear()
-        self.ax3.set_title("Reconstructed Waveform", fontsize=11)
-        self.ax3.set_xlabel("One Period", fontsize=10)
-        self.ax3.set_ylabel("Magnitude", fontsize=10)
-        # self.ax3.set_facecolor('#505050')
+        self.panel3.update("Reconstructed Waveform", "One Period", "Magnitude", {"recon": (None, recon)})
 
-        self.ax3.plot(recon)
-
-        self.canvas3.draw()
-
-        self.ax4.clear()
-        self.ax4.set_title("Magnetization", fontsize=11)
-        self.ax4.set_xlabel("One Period", fontsize=10)
-        self.ax4.set_ylabel("Magnitude", fontsize=10)
-        # self.ax3.set_facecolor('#505050')
-
-        self.ax4.plot(integral)
-
-        self.canvas4.draw()
+        self.panel4.update("Magnetization", "One Period", "Magnitude", {"magnetization": (None, integral)})
 
         if self.mode == "standard sample":
             H = self.H_field
 
-            self.ax5.clear()
-            self.ax5.set_title("dM/dH Curve", fontsize=11)
-            self.ax5.set_xlabel("H", fontsize=10)
-            self.ax5.set_ylabel("dM/dH", fontsize=10)
             # Need half of a period for MH and dM/dH:
             # integral = integral[:len(integral) // 2]
             # H = H[:len(H) // 2]
             dMdH = analyze.dMdH(integral, H)
+            self.panel5.update("dM/dH Curve", "H", "dM/dH", {"dMdH": (H, dMdH)})
 
-            self.ax5.plot(H, dMdH)
-
-            self.canvas5.draw()
-
-            self.ax6.set_title("MH Curve comparison", fontsize=11)
-            self.ax6.set_xlabel("H", fontsize=10)
-            self.ax6.set_ylabel("M", fontsize=10)
-            self.ax6.plot(H, integral, label='Run#' + str(self.run))
-
-            self.ax6.legend(loc='upper left')
-            self.canvas6.draw()
+            self.panel6.configure("MH Curve comparison", "H", "M")
+            self.panel6.add_line('Run#' + str(self.run), H, integral, legend=True, legend_loc='upper left')
 
     ####################### function to save results #########################
+    def run_parameters(self):
+        return {
+            'User information': getattr(self, 'additional_information', None),
+            'mode': getattr(self, 'mode', None),
+            'ac_amplitude': getattr(self, 'ac_amplitude', None),
+            'frequency': getattr(self, 'frequency', None),
+            'channel': getattr(self, 'channel', None),
+            'dc_offset': getattr(self, 'dc_offset', None),
+            'only_harmonics': getattr(self, 'only_harmonics', None),
+            'triggering_enabled': getattr(self, 'triggering_enabled', None),
+            'daq_signal_channel': getattr(self, 'daq_signal_channel', None),
+            'daq_current_channel': getattr(self, 'daq_current_channel', None),
+            'daq_trigger_channel': getattr(self, 'daq_trigger_channel', None),
+            'sample_rate': getattr(self, 'sample_rate', None),
+            'num_periods': getattr(self, 'num_periods', None),
+            'num_averages': getattr(self, 'num_averages', None),
+            'target_snr': getattr(self, 'target_snr', None),
+            'snr_time_budget': getattr(self, 'snr_time_budget', None),
+            'spectral_window': getattr(self, 'spectral_window', None),
+            'bin_interpolation': getattr(self, 'bin_interpolation', None),
+            'results_file': self.results.path,
+            'results_run': self.last_run,
+        }
+
     def save_input(self):
         save_window = ctk.CTkToplevel(self)
         save_window.title("Setup Analysis")
         save_window.geometry( "300x200" )
         save_window.attributes("-topmost", True)
 
-        time.sleep(0.02)  # I noticed that the window needed time to initialize, so I set a delay here of 20 ms
+        save_window.update_idletasks()  # the window needs to be initialized before its size can be read
         width = save_window.winfo_width()
         height = save_window.winfo_height()
 
@@ -1338,8 +1788,14 @@ class App(ctk.CTk):
 
     def save_results(self):
         filename = filedialog.asksaveasfilename(defaultextension=".mat",
-                                                filetypes=[("MATLAB files", "*.mat"), ("All files", "*.*")])
-        if filename:
+                                                filetypes=[("MATLAB files", "*.mat"), ("HDF5 files", "*.h5"),
+                                                           ("All files", "*.*")])
+        if filename and filename.lower().endswith(('.h5', '.hdf5')):
+            # the last run is already in the HDF5 results file (with its raw records), copy it out
+            if self.last_run is not None:
+                self.results.copy_run(self.last_run, filename,
+                                      {'User information': self.additional_information or ''})
+        elif filename:
 
             data = {} #empty dictionary to hold the data
 
@@ -1355,23 +1811,10 @@ class App(ctk.CTk):
             )
             data['instructions'] = instructions
 
-            parameters = {
-                'User information': getattr(self, 'additional_information', None),
-                'mode': getattr(self, 'mode', None),
-                'ac_amplitude': getattr(self, 'ac_amplitude', None),
-                'frequency': getattr(self, 'frequency', None),
-                'channel': getattr(self, 'channel', None),
-                'dc_offset': getattr(self, 'dc_offset', None),
-                'only_harmonics': getattr(self, 'only_harmonics', None),
-                'triggering_enabled': getattr(self, 'triggering_enabled', None),
-                'daq_signal_channel': getattr(self, 'daq_signal_channel', None),
-                'daq_current_channel': getattr(self, 'daq_current_channel', None),
-                'daq_trigger_channel': getattr(self, 'daq_trigger_channel', None),
-                'sample_rate': getattr(self, 'sample_rate', None),
-                'num_periods': getattr(self, 'num_periods', None)
-            }
+            parameters = self.run_parameters()
             clean_parameters = {k: v for k, v in parameters.items() if v is not None}
             data['parameters'] = clean_parameters
+            data['timing'] = timing.timer.summary() #stage timings and counters of the last run
 
             # Check and add each attribute if it exists and save based on the mode:
 
@@ -1446,6 +1889,7 @@ class App(ctk.CTk):
                         data['magnetization'] = self.magnetization
 
             # Save the dictionary to a MATLAB file
+            from scipy.io import savemat  # imported on first save (slow import, not needed at start up)
             savemat(filename, data)
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+import queue
+import threading
+import traceback
+
+#Acquisition worker: the runs of the App (DAQ acquisitions, instrument writes and the analysis) are queued as jobs and
+#executed one at a time on this thread instead of the Tk event thread. Jobs never touch Tk: progress, results and
+#errors go into an event queue that the GUI drains with dispatch() from an after() loop, so every callback runs on
+#the Tk thread. A job is cancelled cooperatively, it stops at its next progress() / check_cancelled() call.
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    def __init__(self, name, work, done=None, failed=None, events=None):
+        self.name = name
+        self.work = work #work(job) -> result, runs on the worker thread
+        self.done = done #done(result), on the Tk thread
+        self.failed = failed #failed(job, exception), on the Tk thread (JobCancelled for a cancelled job)
+        self.fraction = 0.0 #progress 0 .. 1
+        self.message = ''
+        self._events = events
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled(f"{self.name} cancelled")
+
+    def progress(self, fraction, message=''):
+        #called by work() to report progress, also a point where a cancelled job stops
+        self._events.put(('progress', self, (fraction, message)))
+        self.check_cancelled()
+
+class AcquisitionWorker:
+    def __init__(self, on_progress=None):
+        self.on_progress = on_progress #on_progress(job), on the Tk thread
+        self.current = None #job that is running
+        self._jobs = queue.Queue()
+        self._events = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='acquisition worker')
+        self._thread.start()
+
+    @property
+    def busy(self):
+        return self.current is not None or not self._jobs.empty()
+
+    def submit(self, name, work, done=None, failed=None):
+        job = Job(name, work, done, failed, self._events)
+        self._jobs.put(job)
+        return job
+
+    def cancel(self):
+        #cancels the running job and every queued one
+        with self._jobs.mutex:
+            jobs = list(self._jobs.queue)
+        current = self.current
+        if current is not None:
+            jobs.append(current)
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
+
+    def dispatch(self):
+        #Tk thread: runs the callbacks of everything the jobs reported since the last call
+        while True:
+            try:
+                kind, job, value = self._events.get_nowait()
+            except queue.Empty:
+                return
+            if kind == 'progress':
+                job.fraction, job.message = value
+                if self.on_progress is not None:
+                    self.on_progress(job)
+            elif kind == 'done':
+                if job.done is not None:
+                    job.done(value)
+            elif job.failed is not None:
+                job.failed(job, value)
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            self.current = job
+            try:
+                job.check_cancelled()
+                result = job.work(job)
+            except JobCancelled as e:
+                self._events.put(('failed', job, e))
+            except Exception as e:
+                traceback.print_exc()
+                self._events.put(('failed', job, e))
+            else:
+                self._events.put(('done', job, result))
+            finally:
+                self.current = None
@@ -0,0 +1,121 @@
+import glob
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+
+#Library of measured background spectra (complex fourier coefficients as returned by analyze.get_background).
+#Backgrounds are keyed by (drive frequency, ac amplitude, dc current, sample rate, num_periods), kept on disk (one .npz
+#per background, the key as plain numeric fields so loading never needs pickle) so they survive a restart, and dropped
+#once they are older than max_age (the background drifts with the coil temperature). Between two measured dc currents
+#the complex background is interpolated linearly.
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.mps_backgrounds')
+
+class BackgroundLibrary:
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_age=4 * 3600.0):
+        self.directory = directory
+        self.max_age = max_age #s
+        self._entries = {} #key -> (time measured, complex background)
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(frequency, amplitude, dc_current, sample_rate, num_periods):
+        return (round(float(frequency), 6), None if amplitude is None else round(float(amplitude), 6),
+                round(float(dc_current or 0), 6), round(float(sample_rate), 3), int(num_periods))
+
+    def store(self, frequency, amplitude, dc_current, sample_rate, num_periods, background_complex):
+        key = self.make_key(frequency, amplitude, dc_current, sample_rate, num_periods)
+        background_complex = np.array(background_complex, dtype=complex)
+        background_complex.flags.writeable = False
+        measured = time.time()
+        with self._lock:
+            self._load()
+            self._entries[key] = (measured, background_complex)
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+                np.savez(self._path(key), frequency=key[0], amplitude=np.nan if key[1] is None else key[1],
+                         dc_current=key[2], sample_rate=key[3], num_periods=key[4], measured=measured,
+                         background=background_complex)
+        return key
+
+    def get(self, frequency, amplitude, dc_current, sample_rate, num_periods):
+        #the background measured at exactly these settings, None if there is none (or it is stale)
+        key = self.make_key(frequency, amplitude, dc_current, sample_rate, num_periods)
+        with self._lock:
+            self._load()
+            self._evict()
+            entry = self._entries.get(key)
+        return None if entry is None else entry[1]
+
+    def interpolate_dc(self, frequency, amplitude, dc_current, sample_rate, num_periods):
+        #background at dc_current, linearly interpolated (real and imaginary part) between the two closest measured dc
+        #currents with the same other settings. None outside the measured range (no extrapolation).
+        key = self.make_key(frequency, amplitude, dc_current, sample_rate, num_periods)
+        with self._lock:
+            self._load()
+            self._evict()
+            measured = sorted((other[2], background) for other, (_, background) in self._entries.items()
+                              if other[:2] == key[:2] and other[3:] == key[3:])
+        if not measured:
+            return None
+        currents = [current for current, _ in measured]
+        i = int(np.searchsorted(currents, key[2]))
+        if i < len(currents) and currents[i] == key[2]:
+            return measured[i][1]
+        if i == 0 or i == len(currents):
+            return None
+        (current_0, background_0), (current_1, background_1) = measured[i - 1], measured[i]
+        weight = (key[2] - current_0) / (current_1 - current_0)
+        return (1 - weight) * background_0 + weight * background_1
+
+    def dc_currents(self, frequency, amplitude, sample_rate, num_periods):
+        #dc currents with a fresh background for these settings
+        key = self.make_key(frequency, amplitude, 0, sample_rate, num_periods)
+        with self._lock:
+            self._load()
+            self._evict()
+            return sorted(other[2] for other in self._entries if other[:2] == key[:2] and other[3:] == key[3:])
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def _path(self, key):
+        return os.path.join(self.directory, 'bg_' + hashlib.sha1(repr(key).encode()).hexdigest()[:16] + '.npz')
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.directory:
+            return
+        for path in glob.glob(os.path.join(self.directory, 'bg_*.npz')):
+            try:
+                with np.load(path, allow_pickle=False) as data:
+                    amplitude = float(data['amplitude'])
+                    key = self.make_key(float(data['frequency']), None if np.isnan(amplitude) else amplitude,
+                                        float(data['dc_current']), float(data['sample_rate']), int(data['num_periods']))
+                    background = data['background']
+                    background.flags.writeable = False
+                    self._entries[key] = (float(data['measured']), background)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Skipping unreadable background {path}: {e}")
+        self._evict()
+
+    def _evict(self):
+        oldest = time.time() - self.max_age
+        for key in [key for key, (measured, _) in self._entries.items() if measured < oldest]:
+            self._remove(key)
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        if self.directory:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,219 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import simulation
+simulation.install() #the benchmark never touches hardware, acquisitions come from the simulated bench
+import receive_and_analyze as analyze
+import sweep_engine
+import wave_gen
+
+#Benchmark of the receive_and_analyze pipeline at the configurations the MPS runs at, on synthetic MPS waveforms.
+#   python benchmark.py                              full grid, prints time and peak memory per stage
+#   python benchmark.py --save baseline.json         store the results as a JSON baseline
+#   python benchmark.py --compare baseline.json      compare against a baseline (exit code 1 on a regression)
+#Times are the best of a few repeats, peak memory is the largest traced allocation of one extra run (tracemalloc).
+
+SAMPLE_RATES = [100000, 1000000] #S/s
+NUM_PERIODS = [10, 100, 1000]
+DRIVE_FREQUENCIES = [1000, 5000, 25000] #Hz
+QUICK_NUM_PERIODS = [10, 100]
+QUICK_DRIVE_FREQUENCIES = [1000, 25000]
+
+NOISE_FLOOR = 0.5e-3 #s, smaller slowdowns are timer noise and never count as a regression
+REFERENCE_LIMIT = 20000 #samples, reconstruct_and_integrate (python loop) is only timed up to this record length
+
+SIGNAL, CURRENT, TRIGGER = 'Dev3/ai0', 'Dev3/ai1', '/Dev3/pfi0'
+AMPLITUDE = 2.0 #Vpp on the waveform generator (about 20 mT)
+COEFFICIENT = 5.0093 #mT/A of the drive coil
+
+def set_drive(frequency, amplitude=AMPLITUDE):
+    with simulation.bench.lock:
+        simulation.bench.generator = {'1': {'voltage': amplitude, 'frequency': frequency, 'output': True}}
+
+def synthetic_records(sample_rate, num_periods, frequency):
+    #(signal, current) records of a triggered acquisition with the sample in the coil
+    set_drive(frequency)
+    num_samples = int(num_periods * sample_rate / frequency)
+    t = np.arange(num_samples) / sample_rate
+    return simulation.bench.synthesize([SIGNAL, CURRENT], t)
+
+def measure(function, min_time=0.2, max_repeats=5):
+    #(best time in s, peak traced memory in MB, last result)
+    times = []
+    start = time.perf_counter()
+    while len(times) < max_repeats and (not times or time.perf_counter() - start < min_time):
+        t0 = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak / 1e6, result
+
+def quiet(function):
+    #the analysis functions print (e.g. I(rms)), keep the report readable
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function()
+    return run
+
+def stage_benchmarks(sample_rate, num_periods, frequency, reference=True):
+    #yields (stage, time, peak MB) for every pipeline stage at one configuration
+    records = synthetic_records(sample_rate, num_periods, frequency)
+    num_samples = records.shape[-1]
+    signal, current = records
+
+    elapsed, peak, result = measure(lambda: analyze.fourier(signal, sample_rate, num_samples))
+    yield 'fourier', elapsed, peak
+    magnitude, fourier_frequency, _, fourier_complex = result
+
+    elapsed, peak, _ = measure(lambda: analyze.harmonics(fourier_complex, fourier_frequency, frequency, sample_rate))
+    yield 'harmonics', elapsed, peak
+
+    elapsed, peak, _ = measure(lambda: analyze.harmonic_amplitudes(signal, sample_rate, frequency))
+    yield 'harmonic_amplitudes', elapsed, peak
+
+    elapsed, peak, result = measure(lambda: analyze.reconstruct_and_integrate_fast(
+        num_samples, fourier_frequency, magnitude, frequency))
+    yield 'reconstruct', elapsed, peak
+    _, integral = result
+
+    if reference and num_samples <= REFERENCE_LIMIT:
+        elapsed, peak, _ = measure(lambda: analyze.reconstruct_and_integrate(
+            num_samples, fourier_frequency, magnitude, frequency), max_repeats=1)
+        yield 'reconstruct_reference', elapsed, peak
+
+    elapsed, peak, H = measure(lambda: analyze.field_from_current(current, sample_rate, frequency, COEFFICIENT))
+    yield 'field', elapsed, peak
+
+    elapsed, peak, _ = measure(lambda: analyze.dMdH(integral, H))
+    yield 'dMdH', elapsed, peak
+
+    elapsed, peak, _ = measure(quiet(lambda: analyze.rms_current_from_voltage(current, num_samples)))
+    yield 'rms_current', elapsed, peak
+
+    elapsed, peak, _ = measure(quiet(lambda: analyze.get_rms_current(CURRENT, sample_rate, num_samples, TRIGGER)))
+    yield 'get_rms_current', elapsed, peak #includes the simulated acquisition
+
+def sample_run(sample_rate, num_periods, frequency):
+    #the analysis chain of App.run_with_sample, acquisitions and instruments simulated
+    num_samples, background_magnitude, _, _, _, background_complex = analyze.get_background(
+        SIGNAL, CURRENT, TRIGGER, sample_rate, num_periods, 10, AMPLITUDE, frequency, 1, 0)
+
+    def run():
+        (num_samples, sample_magnitude, signal_frequency, _, _, _, _, sample_complex,
+         current_voltage) = analyze.get_sample_signal(SIGNAL, CURRENT, TRIGGER, sample_rate, num_periods, 10,
+                                                      AMPLITUDE, frequency, 1, 0, background_complex, True)
+        recon, integral = analyze.reconstruct_and_integrate_fast(num_samples, signal_frequency, sample_magnitude,
+                                                                 frequency, np.angle(sample_complex))
+        H = analyze.field_from_current(current_voltage, sample_rate, frequency, COEFFICIENT)
+        return analyze.dMdH(integral, H)
+    return quiet(run)
+
+def sweep_run(sample_rate, num_periods, frequency, num_steps=50):
+    #App.auto_mode_static_dc: a 50 step ac amplitude sweep through the SweepEngine, instruments simulated
+    amplitudes = list(np.linspace(0.5, 4.5, num_steps))
+    orders = list(range(1, 12))
+
+    def run():
+        waveform_generator = wave_gen.connect_waveform_generator(10)
+        harmonics = np.zeros((num_steps, len(orders)), dtype=complex)
+
+        def apply(step, amplitude):
+            wave_gen.send_voltage(waveform_generator, amplitude, frequency, 1)
+
+        def acquire(step, amplitude):
+            return analyze.acquire_sample_records(SIGNAL, CURRENT, TRIGGER, sample_rate, num_periods, frequency)
+
+        def process(step, amplitude, records):
+            _, step_orders, sample_harmonics, _ = analyze.analyze_sample_harmonics(records, sample_rate, frequency,
+                                                                                   None, orders)
+            harmonics[step, :len(step_orders)] = sample_harmonics
+
+        sweep_engine.SweepEngine(apply, acquire, process).run(amplitudes)
+        wave_gen.turn_off(waveform_generator, 1)
+        return harmonics
+    return quiet(run)
+
+def run_benchmarks(sample_rates, num_periods_list, frequencies, reference=True, scenarios=True):
+    results = {}
+    for sample_rate in sample_rates:
+        for num_periods in num_periods_list:
+            for frequency in frequencies:
+                config = f"fs={sample_rate} periods={num_periods} f={frequency}"
+                for stage, elapsed, peak in stage_benchmarks(sample_rate, num_periods, frequency, reference):
+                    key = f"{stage} {config}"
+                    results[key] = {'time_s': elapsed, 'peak_mb': peak}
+                    print(f"{key:<58} {elapsed * 1e3:>10.3f} ms {peak:>9.2f} MB")
+
+    if scenarios:
+        for sample_rate in sample_rates:
+            config = f"fs={sample_rate} periods=100 f=1000"
+            for name, scenario, repeats in (('one_sample_run', sample_run(sample_rate, 100, 1000), 3),
+                                            ('sweep_50_steps', sweep_run(sample_rate, 100, 1000), 1)):
+                elapsed, peak, _ = measure(scenario, max_repeats=repeats)
+                key = f"{name} {config}"
+                results[key] = {'time_s': elapsed, 'peak_mb': peak}
+                print(f"{key:<58} {elapsed * 1e3:>10.3f} ms {peak:>9.2f} MB")
+    return results
+
+def compare(results, baseline, threshold):
+    #prints the stages that got slower than threshold x baseline, returns their number
+    regressions = 0
+    for key, result in results.items():
+        reference = baseline.get('results', {}).get(key)
+        if reference is None or reference['time_s'] <= 0:
+            continue
+        ratio = result['time_s'] / reference['time_s']
+        flag = ''
+        if ratio > threshold and result['time_s'] - reference['time_s'] > NOISE_FLOOR:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{key:<58} {ratio:>6.2f}x time {result['peak_mb'] - reference['peak_mb']:>+9.2f} MB{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the MPS analysis pipeline")
+    parser.add_argument('--quick', action='store_true', help="smaller grid (fewer periods and drive frequencies)")
+    parser.add_argument('--no-reference', action='store_true', help="skip the python loop reconstruct_and_integrate")
+    parser.add_argument('--no-scenarios', action='store_true', help="skip the sample run and sweep scenarios")
+    parser.add_argument('--time-scale', type=float, default=0.0,
+                        help="simulated acquisition/instrument time (1 = real time, default 0 = analysis only)")
+    parser.add_argument('--save', metavar='JSON', help="write the results as a baseline")
+    parser.add_argument('--compare', metavar='JSON', help="compare with a baseline")
+    parser.add_argument('--threshold', type=float, default=1.25, help="slowdown counted as a regression")
+    args = parser.parse_args(argv)
+
+    simulation.bench.time_scale = args.time_scale
+    periods = QUICK_NUM_PERIODS if args.quick else NUM_PERIODS
+    frequencies = QUICK_DRIVE_FREQUENCIES if args.quick else DRIVE_FREQUENCIES
+    results = run_benchmarks(SAMPLE_RATES, periods, frequencies, not args.no_reference, not args.no_scenarios)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'meta': {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+                                'numpy': np.__version__, 'machine': platform.platform(),
+                                'time_scale': args.time_scale},
+                       'results': results}, f, indent=1)
+        print(f"Saved {len(results)} results to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        print(f"{regressions} regression(s) above {args.threshold}x")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
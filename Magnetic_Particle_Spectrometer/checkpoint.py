@@ -0,0 +1,87 @@
+import json
+import os
+import time
+
+import numpy as np
+
+#Checkpoint of a running automated sweep (static ac / static dc). After every finished step the sweep is written to a
+#small .npz: mode, parameters, setpoints, fixed inputs (backgrounds), the per step results so far and the instrument
+#state of the last finished step. The file is written to a temporary name and renamed, so a crash while writing keeps
+#the previous checkpoint. SweepCheckpoint.load() returns the interrupted sweep, the App continues it from
+#the first unfinished setpoint (App.resume_sweep). The raw records stay in the HDF5 results run.
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.mps_checkpoints', 'sweep.npz')
+
+class SweepCheckpoint:
+    def __init__(self, mode, parameters, setpoints, arrays=None, path=DEFAULT_PATH):
+        self.mode = mode
+        self.parameters = dict(parameters) #plain python values (json)
+        self.setpoints = list(setpoints) #None = step without an instrument change
+        #fixed inputs of the sweep, e.g. the background of every step (None = not available)
+        self.arrays = {name: value for name, value in (arrays or {}).items() if value is not None}
+        self.data = {} #name -> (num setpoints,) + shape array of the finished steps (NaN for the others)
+        self.completed = 0 #steps 0 .. completed-1 are done
+        self.instrument = {} #instrument state after the last finished step
+        self.started = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.path = path
+
+    def step_done(self, step, instrument, **values):
+        #completed only counts the steps without a gap: a step processed after a failed one is redone on resume
+        for name, value in values.items():
+            value = np.asarray(np.nan if value is None else value)
+            if name not in self.data:
+                dtype = complex if np.iscomplexobj(value) else float
+                self.data[name] = np.full((len(self.setpoints),) + value.shape, np.nan, dtype=dtype)
+            self.data[name][step] = value
+        if step != self.completed:
+            return
+        self.completed = step + 1
+        self.instrument = dict(instrument)
+        self.save()
+
+    @property
+    def finished(self):
+        return self.completed >= len(self.setpoints)
+
+    def describe(self):
+        return f"{self.mode}: {self.completed} of {len(self.setpoints)} steps done (started {self.started})"
+
+    def save(self):
+        meta = {'mode': self.mode, 'parameters': self.parameters, 'completed': self.completed,
+                'instrument': self.instrument, 'started': self.started,
+                'setpoints': [None if s is None else float(s) for s in self.setpoints]}
+        arrays = {f'array_{name}': value for name, value in self.arrays.items()}
+        arrays.update({f'data_{name}': value for name, value in self.data.items()})
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as file:
+            np.savez(file, meta=np.array(json.dumps(meta, default=lambda value: value.item())), **arrays)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def load(cls, path=DEFAULT_PATH):
+        #the interrupted sweep, None if there is none (or the file is unreadable)
+        try:
+            with np.load(path) as file:
+                meta = json.loads(str(file['meta']))
+                arrays = {name[6:]: file[name] for name in file.files if name.startswith('array_')}
+                data = {name[5:]: file[name] for name in file.files if name.startswith('data_')}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Skipping unreadable sweep checkpoint {path}: {e}")
+            return None
+        checkpoint = cls(meta['mode'], meta['parameters'], meta['setpoints'], arrays, path)
+        checkpoint.data = data
+        checkpoint.completed = meta['completed']
+        checkpoint.instrument = meta['instrument']
+        checkpoint.started = meta['started']
+        return checkpoint
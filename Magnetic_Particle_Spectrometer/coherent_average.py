@@ -0,0 +1,149 @@
+import time
+
+import numpy as np
+
+import daq_session
+
+#Coherent averaging of acquisitions: instead of one long record (num_periods up, FFT size and memory up), M frames of
+#the same length are acquired with the same phase and averaged sample by sample. Coherent signals (the harmonics) stay,
+#uncorrelated noise drops by sqrt(M). The frames are either retriggered on the sync edge (one triggered read per frame)
+#or read back to back from a continuous acquisition, which keeps the phase only if a frame holds whole drive periods.
+#Every frame goes into a running mean and the Welford sum of squares in place, so M frames cost the memory of one
+#frame. Only the averaged frame goes on to fourier() / harmonic_amplitudes(), with its standard error.
+#AdaptiveAverage does not take a fixed number of frames: it stops once the requested harmonics stand out of the local
+#noise floor by the target SNR (or the time budget is used up), so strong samples finish early and weak ones get more.
+
+class FrameAverage:
+    def __init__(self, num_frames, continuous=False, on_frame=None):
+        self.num_frames = int(num_frames)
+        self.continuous = continuous #back to back frames of one acquisition instead of retriggered reads
+        self.on_frame = on_frame #on_frame(average) after every frame (progress, cancel point)
+        self.count = 0
+        self.mean = None
+        self._m2 = None #sum of squared deviations from the mean (Welford)
+        self._scratch = None
+
+    def add(self, frame):
+        if self.mean is None:
+            self.mean = np.zeros(np.shape(frame), dtype=np.float64)
+            self._m2 = np.zeros_like(self.mean)
+            self._scratch = np.empty_like(self.mean)
+        self.count += 1
+        n = self.count
+        delta = self._scratch
+        np.subtract(frame, self.mean, out=delta)
+        delta /= n
+        self.mean += delta #mean_n = mean_n-1 + (x - mean_n-1) / n
+        np.multiply(delta, delta, out=delta)
+        delta *= n * (n - 1)
+        self._m2 += delta #m2_n = m2_n-1 + (n-1)/n (x - mean_n-1)^2
+        done = self._done()
+        if self.on_frame is not None:
+            self.on_frame(self)
+        return done #True once no more frames are needed
+
+    def _done(self):
+        return self.count >= self.num_frames
+
+    @property
+    def progress(self):
+        return min(1.0, self.count / self.num_frames)
+
+    def describe(self):
+        return f"frame {self.count} of {self.num_frames}"
+
+    @property
+    def variance(self):
+        #variance of one frame, per sample (NaN below 2 frames)
+        if self.count < 2:
+            return np.full_like(self.mean, np.nan)
+        return self._m2 / (self.count - 1)
+
+    @property
+    def standard_error(self):
+        #standard error of the averaged frame, per sample
+        return np.sqrt(self.variance / self.count)
+
+    def spectrum_error(self):
+        #standard error of a fourier() coefficient of the averaged frame for every channel (rms of the complex error,
+        #the same for every bin when the noise is white)
+        num_samples = self.mean.shape[-1]
+        return np.sqrt(np.sum(self.variance / self.count, axis=-1)) / num_samples
+
+class AdaptiveAverage(FrameAverage):
+    #adds frames until every order reaches target_snr: |harmonic| (background subtracted) over the rms of the
+    #noise_bins bins on either side of it that are not harmonics (local noise floor of the averaged frame, the
+    #per bin standard error where there are no such bins), or until time_budget s or max_frames
+    def __init__(self, target_snr, time_budget, sample_rate, frequency, orders=(3, 5, 7), background=None,
+                 max_frames=10000, continuous=False, on_frame=None, noise_bins=5):
+        super().__init__(max_frames, continuous, on_frame)
+        self.target_snr = float(target_snr)
+        self.time_budget = float(time_budget)
+        self.sample_rate = float(sample_rate)
+        self.frequency = float(frequency)
+        self.orders = np.asarray(orders, dtype=np.intp)
+        self.background = background #complex fourier() coefficients of the background (frames of the same length)
+        self.noise_bins = int(noise_bins)
+        self.snr = np.full(len(self.orders), np.nan) #per order, after the last frame
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def min_snr(self):
+        return np.nanmin(self.snr) if np.any(np.isfinite(self.snr)) else np.nan
+
+    def _done(self):
+        self.snr = self.harmonic_snr()
+        return bool(np.all(self.snr >= self.target_snr) or self.elapsed >= self.time_budget
+                    or self.count >= self.num_frames)
+
+    def harmonic_snr(self):
+        signal = self.mean[0]
+        num_samples = len(signal)
+        spectrum = np.fft.rfft(signal)[:(num_samples + 1) // 2] / num_samples #normalized like fourier()
+        period_bins = self.frequency * num_samples / self.sample_rate #bins between two harmonics
+        bins = np.rint(self.orders * period_bins).astype(np.intp)
+        snr = np.full(len(self.orders), np.nan)
+        valid = bins < len(spectrum) #orders below nyquist
+        bins = bins[valid]
+
+        harmonics = spectrum[bins]
+        if self.background is not None:
+            harmonics = harmonics - self.background[bins]
+        offsets = np.concatenate((np.arange(-self.noise_bins, 0), np.arange(1, self.noise_bins + 1)))
+        neighbors = bins[:, np.newaxis] + offsets
+        distance = np.abs(neighbors - np.rint(neighbors / period_bins) * period_bins) #to the closest harmonic
+        usable = (neighbors > 0) & (neighbors < len(spectrum)) & (distance >= 0.5)
+        power = np.abs(spectrum[np.clip(neighbors, 0, len(spectrum) - 1)]) ** 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            noise = np.sqrt(np.sum(power * usable, axis=1) / np.sum(usable, axis=1))
+            noise = np.where(np.any(usable, axis=1), noise, self.spectrum_error()[0])
+            snr[valid] = np.abs(harmonics) / noise
+        return snr
+
+    @property
+    def progress(self):
+        snr = self.min_snr
+        return min(1.0, max(self.elapsed / self.time_budget, 0.0 if np.isnan(snr) else snr / self.target_snr))
+
+    def describe(self):
+        return f"frame {self.count}, SNR {self.min_snr:.1f} of {self.target_snr:g}"
+
+def acquire(daq_locations, sample_rate, n_samps, trigger_location, average, frequency=None):
+    #fills average with frames of the channels until it is done and returns the averaged (channels, n_samps) frame
+    n_samps = int(n_samps)
+    if average.continuous or trigger_location is None:
+        periods = n_samps * frequency / sample_rate if frequency else 0.5
+        if abs(periods - round(periods)) > 1e-6 * max(1.0, periods):
+            raise ValueError(f"Continuous averaging needs whole drive periods per frame ({periods:.3f} periods in "
+                             f"{n_samps} samples), use a start trigger or change num_periods / the sample rate")
+        daq_session.sessions.read_frames(list(daq_locations), sample_rate, n_samps, average.num_frames, average.add)
+    else:
+        for _ in range(average.num_frames): #retriggered: every read is re-armed and starts on the next sync edge
+            if average.add(daq_session.sessions.read(list(daq_locations), sample_rate, n_samps, trigger_location,
+                                                     copy=False)):
+                break
+    return average.mean
@@ -0,0 +1,101 @@
+import numpy as np
+
+#Vectorized analysis of the current sensor voltage (ACS712 hall sensor: Vout = VQ + sensitivity * I).
+#One pass over the samples gives the rms, peak and dc current and the amplitude/phase of the drive fundamental.
+#CurrentAccumulator takes the record in blocks (continuous acquisitions), analyze_current() a whole record.
+
+_CHUNK = 1 << 16 #samples per vectorized step (bounds the temporary arrays)
+
+class CurrentSensor:
+    def __init__(self, sensitivity, vcc=5.0, zero_offset=None, gain=1.0):
+        self.sensitivity = sensitivity #V/A
+        self.vcc = vcc
+        self.zero_offset = 0.5 * vcc if zero_offset is None else zero_offset #V at 0 A (VQ)
+        self.gain = gain #correction factor of the sensitivity, from a calibration against a reference
+
+    def to_current(self, voltage):
+        return (np.asarray(voltage, dtype=np.float64) - self.zero_offset) / (self.sensitivity * self.gain)
+
+    def calibrate_zero(self, voltage):
+        #sets VQ from a record taken with no current through the sensor
+        self.zero_offset = float(np.mean(voltage))
+        return self.zero_offset
+
+#ACS712 variants (datasheet sensitivities at Vcc = 5 V):
+SENSORS = {
+    'ACS712-5A': lambda: CurrentSensor(0.185),
+    'ACS712-20A': lambda: CurrentSensor(0.1),
+    'ACS712-30A': lambda: CurrentSensor(0.066),
+}
+DEFAULT_SENSOR = 'ACS712-20A' #the sensor in the drive coil circuit of the MPS
+
+_sensors = {}
+
+def get_sensor(sensor=None):
+    #sensor: CurrentSensor, a name from SENSORS or None (DEFAULT_SENSOR). Named sensors are shared, so a zero
+    #calibration of e.g. 'ACS712-5A' is used by every later analysis with that name.
+    if isinstance(sensor, CurrentSensor):
+        return sensor
+    name = DEFAULT_SENSOR if sensor is None else sensor
+    if name not in _sensors:
+        _sensors[name] = SENSORS[name]()
+    return _sensors[name]
+
+class CurrentStats:
+    def __init__(self, num_samples, rms, peak, dc, fundamental=None):
+        self.num_samples = num_samples
+        self.rms = rms #A, including dc
+        self.peak = peak #A, largest |I|
+        self.dc = dc #A, mean
+        self.ac_rms = np.sqrt(max(rms ** 2 - dc ** 2, 0.0)) #A
+        self.fundamental = fundamental #complex peak amplitude at f_drive (cosine phase, first sample = t 0)
+
+    @property
+    def amplitude(self):
+        return None if self.fundamental is None else abs(self.fundamental)
+
+    @property
+    def phase(self):
+        return None if self.fundamental is None else float(np.angle(self.fundamental))
+
+class CurrentAccumulator:
+    def __init__(self, sample_rate=None, f_drive=None, sensor=None):
+        if f_drive is not None and sample_rate is None:
+            raise ValueError("the fundamental needs the sample rate")
+        self.sample_rate = sample_rate
+        self.f_drive = f_drive
+        self.sensor = get_sensor(sensor)
+        self.reset()
+
+    def reset(self):
+        self.num_samples = 0
+        self._sum = 0.0
+        self._sum_squares = 0.0
+        self._peak = 0.0
+        self._fundamental = 0j
+
+    def add(self, voltage):
+        #adds the next block of sensor voltages (samples continue where the previous block ended)
+        voltage = np.ravel(voltage)
+        for start in range(0, len(voltage), _CHUNK):
+            current = self.sensor.to_current(voltage[start:start + _CHUNK])
+            self._sum += current.sum()
+            self._sum_squares += np.dot(current, current)
+            self._peak = max(self._peak, float(np.max(np.abs(current))))
+            if self.f_drive is not None:
+                step = 2 * np.pi * self.f_drive / self.sample_rate
+                start_phase = (step * self.num_samples) % (2 * np.pi) #stays accurate for long streams
+                self._fundamental += np.dot(current, np.exp(-1j * (start_phase + step * np.arange(len(current)))))
+            self.num_samples += len(current)
+        return self
+
+    def result(self):
+        n = self.num_samples
+        if n == 0:
+            return CurrentStats(0, 0.0, 0.0, 0.0, None if self.f_drive is None else 0j)
+        fundamental = None if self.f_drive is None else 2 * self._fundamental / n
+        return CurrentStats(n, float(np.sqrt(self._sum_squares / n)), self._peak, self._sum / n, fundamental)
+
+def analyze_current(voltage, sample_rate=None, f_drive=None, sensor=None):
+    #CurrentStats of one record of sensor voltages
+    return CurrentAccumulator(sample_rate, f_drive, sensor).add(voltage).result()
@@ -0,0 +1,143 @@
+import atexit
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import timing
+
+#Keeps configured nidaqmx tasks alive between reads so that the channel/timing/trigger setup is paid only once.
+#Tasks are keyed by (channels, sample rate, samples per channel, trigger) and re-armed with start()/stop() per read.
+#The tasks are never committed explicitly, so stop() releases the device for the other cached tasks.
+#Reads go through a stream reader straight into a preallocated (channels x samples) float64 buffer per task,
+#so no Python float lists are created at any sample rate.
+#nidaqmx is imported on first use (slow to import, not needed to bring the App window up).
+
+class _Session:
+    def __init__(self, task, num_channels, n_samps):
+        from nidaqmx.stream_readers import AnalogMultiChannelReader
+        self.task = task
+        self.reader = AnalogMultiChannelReader(task.in_stream)
+        self.buffer = np.zeros((num_channels, n_samps), dtype=np.float64)
+
+    def close(self):
+        self.task.close()
+
+class TaskSessionManager:
+    def __init__(self, max_tasks=8):
+        self.max_tasks = max_tasks #least recently used tasks are closed above this number
+        self._sessions = OrderedDict()
+        self._lock = threading.RLock() #the live loop and the button callbacks may share the manager
+
+    @staticmethod
+    def make_key(channels, sample_rate, n_samps, trigger_location=None):
+        if isinstance(channels, str):
+            channels = (channels,)
+        return tuple(channels), float(sample_rate), int(n_samps), trigger_location
+
+    def get_session(self, channels, sample_rate, n_samps, trigger_location=None):
+        key = self.make_key(channels, sample_rate, n_samps, trigger_location)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None:
+                self._sessions.move_to_end(key)
+                return session
+
+            session = _Session(self._create_task(*key), len(key[0]), key[2])
+            self._sessions[key] = session
+            while len(self._sessions) > self.max_tasks:
+                _, old_session = self._sessions.popitem(last=False)
+                old_session.close()
+            return session
+
+    def get_task(self, channels, sample_rate, n_samps, trigger_location=None):
+        return self.get_session(channels, sample_rate, n_samps, trigger_location).task
+
+    @timing.timed('daq_setup')
+    def _create_task(self, channels, sample_rate, n_samps, trigger_location):
+        import nidaqmx
+        from nidaqmx.constants import AcquisitionType, Edge
+        task = nidaqmx.Task()
+        try:
+            for channel in channels:
+                task.ai_channels.add_ai_voltage_chan(channel)
+            # Add a trigger source and set it to rising edge
+            if trigger_location is not None:
+                task.triggers.start_trigger.cfg_dig_edge_start_trig(trigger_location, Edge.RISING)
+            task.timing.cfg_samp_clk_timing(sample_rate, sample_mode=AcquisitionType.FINITE, samps_per_chan=n_samps)
+        except nidaqmx.DaqError:
+            task.close()
+            raise
+        return task
+
+    @timing.timed('daq_read')
+    def read(self, channels, sample_rate, n_samps, trigger_location=None, copy=True, timeout=None):
+        #returns a (num_channels, n_samps) array. With copy=False the session buffer itself is returned, which is
+        #overwritten by the next read with the same key (only use it when the data is consumed right away)
+        import nidaqmx
+        key = self.make_key(channels, sample_rate, n_samps, trigger_location)
+        if timeout is None:
+            timeout = 10.0 + key[2] / key[1] #long records at low sample rates need more than the default 10 s
+        with self._lock:
+            session = self.get_session(*key)
+            try:
+                session.task.start() #re-arm (waits for the start trigger if there is one)
+                session.reader.read_many_sample(session.buffer, number_of_samples_per_channel=key[2],
+                                                timeout=timeout)
+            except nidaqmx.DaqError:
+                self.discard(*key) #a failed task is rebuilt on the next read
+                raise
+            finally:
+                if key in self._sessions:
+                    session.task.stop()
+            timing.timer.count('daq_samples', len(key[0]) * key[2])
+            return session.buffer.copy() if copy else session.buffer
+
+    @timing.timed('daq_read')
+    def read_frames(self, channels, sample_rate, n_samps, num_frames, on_frame, timeout=None):
+        #continuous acquisition of up to num_frames back to back frames (no gaps, no trigger). on_frame(buffer) gets
+        #every frame in the same (num_channels, n_samps) buffer and has to consume it right away, the driver buffer
+        #holds 4 frames meanwhile. Stops early when on_frame returns True. The task is not cached, it is closed after
+        #the last frame (or on an error)
+        import nidaqmx
+        from nidaqmx.constants import AcquisitionType
+        from nidaqmx.stream_readers import AnalogMultiChannelReader
+        channels, sample_rate, n_samps, _ = self.make_key(channels, sample_rate, n_samps)
+        if timeout is None:
+            timeout = 10.0 + n_samps / sample_rate
+        with self._lock:
+            task = nidaqmx.Task()
+            try:
+                for channel in channels:
+                    task.ai_channels.add_ai_voltage_chan(channel)
+                task.timing.cfg_samp_clk_timing(sample_rate, sample_mode=AcquisitionType.CONTINUOUS,
+                                                samps_per_chan=4 * n_samps)
+                reader = AnalogMultiChannelReader(task.in_stream)
+                buffer = np.zeros((len(channels), n_samps), dtype=np.float64)
+                task.start()
+                frames = 0
+                while frames < int(num_frames):
+                    reader.read_many_sample(buffer, number_of_samples_per_channel=n_samps, timeout=timeout)
+                    frames += 1
+                    if on_frame(buffer):
+                        break
+            finally:
+                task.close()
+            timing.timer.count('daq_samples', len(channels) * n_samps * frames)
+
+    def discard(self, channels, sample_rate, n_samps, trigger_location=None):
+        key = self.make_key(channels, sample_rate, n_samps, trigger_location)
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is not None:
+                session.close()
+
+    def close_all(self):
+        with self._lock:
+            while self._sessions:
+                _, session = self._sessions.popitem()
+                session.close()
+
+#shared manager used by receive_and_analyze and the MPS App:
+sessions = TaskSessionManager()
+atexit.register(sessions.close_all)
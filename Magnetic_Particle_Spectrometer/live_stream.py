@@ -0,0 +1,136 @@
+import threading
+
+import numpy as np
+
+import receive_and_analyze as analyze
+
+#Continuous live spectrum: a producer thread streams the DAQ into a ring buffer, a worker thread turns the newest
+#frame into a spectrum and the GUI picks up only the latest finished frame (older frames are simply overwritten).
+
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self._data = np.zeros(self.capacity, dtype=np.float64)
+        self._written = 0 #total number of samples ever written
+        self._lock = threading.Lock()
+
+    @property
+    def written(self):
+        return self._written
+
+    def write(self, block):
+        block = block[-self.capacity:] #a block larger than the buffer only keeps its newest samples
+        with self._lock:
+            start = self._written % self.capacity
+            first = min(len(block), self.capacity - start)
+            self._data[start:start + first] = block[:first]
+            self._data[:len(block) - first] = block[first:]
+            self._written += len(block)
+
+    def latest(self, out):
+        #copies the len(out) newest samples (oldest first) into out and returns the write count they end at
+        n = len(out)
+        with self._lock:
+            end = self._written % self.capacity
+            if n <= end:
+                out[:] = self._data[end - n:end]
+            else:
+                out[:n - end] = self._data[self.capacity - (n - end):]
+                out[n - end:] = self._data[:end]
+            return self._written
+
+class LiveSpectrumStream:
+    def __init__(self, daq_location, sample_rate, frame_samples, frequency, harmonics_only=False, block_time=0.05,
+                 window=None, interpolation='nominal'):
+        self.daq_location = daq_location
+        self.sample_rate = sample_rate
+        self.frame_samples = int(frame_samples)
+        self.frequency = frequency
+        self.harmonics_only = harmonics_only
+        self.window = window #harmonics only: see analyze.windowed_harmonics
+        self.interpolation = interpolation
+        self.block_samples = max(1, min(self.frame_samples, int(sample_rate * block_time))) #read size per DAQ call
+        self.ring = RingBuffer(2 * self.frame_samples + self.block_samples)
+
+        self.error = None #exception raised in one of the threads, if any
+        self._task = None
+        self._stop = threading.Event()
+        self._new_data = threading.Event()
+        self._threads = []
+        self._latest = None #(frame id, frequency, magnitude), replaced by every new frame
+        self._frame_id = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        import nidaqmx #imported on first use, see daq_session
+        from nidaqmx.constants import AcquisitionType
+        self._task = nidaqmx.Task()
+        self._task.ai_channels.add_ai_voltage_chan(self.daq_location)
+        #the driver buffer holds several frames so a slow worker does not overflow it
+        self._task.timing.cfg_samp_clk_timing(self.sample_rate, sample_mode=AcquisitionType.CONTINUOUS,
+                                              samps_per_chan=4 * self.frame_samples)
+        self._task.start()
+        self._threads = [threading.Thread(target=self._produce, daemon=True),
+                         threading.Thread(target=self._analyze, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._new_data.set() #wake the worker up so it can exit
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=2)
+        if self._task is not None:
+            self._task.close()
+            self._task = None
+
+    def latest_frame(self, last_frame_id=0):
+        #newest (frame id, frequency, magnitude) if it is newer than last_frame_id, else None
+        with self._lock:
+            if self._latest is None or self._latest[0] <= last_frame_id:
+                return None
+            return self._latest
+
+    def _produce(self):
+        import nidaqmx
+        from nidaqmx.stream_readers import AnalogMultiChannelReader
+        reader = AnalogMultiChannelReader(self._task.in_stream)
+        block = np.zeros((1, self.block_samples), dtype=np.float64)
+        try:
+            while not self._stop.is_set():
+                reader.read_many_sample(block, number_of_samples_per_channel=self.block_samples, timeout=10.0)
+                self.ring.write(block[0])
+                self._new_data.set()
+        except nidaqmx.DaqError as e:
+            if not self._stop.is_set(): #closing the task while reading is expected on stop
+                self.error = e
+                self._stop.set()
+                self._new_data.set()
+
+    def _analyze(self):
+        frame = np.zeros(self.frame_samples, dtype=np.float64)
+        analyzed = 0
+        try:
+            while not self._stop.is_set():
+                self._new_data.wait(timeout=1.0)
+                self._new_data.clear()
+                if self._stop.is_set() or self.ring.written < self.frame_samples or self.ring.written == analyzed:
+                    continue
+                analyzed = self.ring.latest(frame) #always the newest samples, anything in between is dropped
+
+                if self.harmonics_only:
+                    orders, amplitudes = analyze.harmonic_amplitudes(frame, self.sample_rate, self.frequency,
+                                                                     window=self.window,
+                                                                     interpolation=self.interpolation)
+                    frequency, magnitude = orders * self.frequency, np.abs(amplitudes)
+                else:
+                    fourier_spectrum = analyze.spectrum(frame, self.sample_rate, self.frame_samples)
+                    frequency, magnitude = fourier_spectrum.frequency, fourier_spectrum.magnitude
+
+                with self._lock:
+                    self._frame_id += 1
+                    self._latest = (self._frame_id, frequency, magnitude)
+        except Exception as e:
+            self.error = e
+            self._stop.set()
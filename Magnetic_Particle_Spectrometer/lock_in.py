@@ -0,0 +1,251 @@
+import queue
+import threading
+from collections import deque
+
+import numpy as np
+
+import timing
+
+#Digital lock-in: tracks the complex amplitudes of the harmonics k*f_drive continuously instead of one spectrum per
+#finite acquisition. Every sample of the pickup coil signal is mixed with exp(-j k phi) of the reference phase phi,
+#averaged over a span of whole drive periods (this removes the other harmonics and the 2kf mixing products, and brings
+#the rate down to about f_drive), low pass filtered and decimated to output_rate. The span is the fewest periods that
+#hold a whole number of samples: one period when fs / f_drive is an integer, 3 periods (1000 samples) at 1 MS/s and
+#3 kHz. Averaging over a rounded period would leak the fundamental into every output, so a sample rate / frequency pair
+#without such a span of at most max_periods periods is refused (the same as continuous averaging).
+#The cost per sample is a few complex multiplications per order, the filter runs at the span rate, so the CPU load
+#does not depend on the time constant.
+#Reference:
+#   'sync'    - the acquisition starts on the rising edge of the waveform generator sync (trigger channel), phi is
+#               2 pi f n / fs from that edge (the same phase origin as the triggered acquisitions)
+#   'current' - free running acquisition, the harmonic phases are given relative to the drive current (theta_k - k
+#               theta_1 of the current channel fundamental), so a drifting generator phase does not show up
+#Low pass:
+#   'iir' - cascade of `poles` single pole stages with time_constant (6 dB/octave per stage, like an analog lock-in)
+#   'fir' - moving average over time_constant (rounded to whole spans)
+#The amplitudes are normalized like fourier() / harmonic_amplitudes(), so they compare to the finite acquisitions.
+
+REFERENCES = ('current', 'sync')
+FILTERS = ('iir', 'fir')
+
+class LockIn:
+    def __init__(self, sample_rate, frequency, orders=range(2, 12), time_constant=0.1, filter='iir', poles=4,
+                 output_rate=20.0, reference='current', max_periods=100):
+        if filter not in FILTERS:
+            raise ValueError(f"Unknown lock-in filter '{filter}', use one of {FILTERS}")
+        if reference not in REFERENCES:
+            raise ValueError(f"Unknown lock-in reference '{reference}', use one of {REFERENCES}")
+        self.sample_rate = float(sample_rate)
+        self.frequency = float(frequency)
+        orders = np.asarray(orders, dtype=np.intp)
+        self.orders = orders[orders * self.frequency < self.sample_rate / 2] #drop orders above nyquist
+        self.time_constant = float(time_constant)
+        self.filter = filter
+        self.poles = int(poles)
+        self.reference = reference
+        self.chunk_periods = _whole_periods(self.sample_rate / self.frequency, max_periods)
+        self.chunk_samples = int(round(self.chunk_periods * self.sample_rate / self.frequency)) #pre-average length
+        self.chunk_rate = self.sample_rate / self.chunk_samples #rate of the filter
+        self.decimation = max(1, int(round(self.chunk_rate / output_rate)))
+        self.output_rate = self.chunk_rate / self.decimation
+
+        rows = len(self.orders) + 1 #the last row is the fundamental of the current channel
+        if filter == 'iir':
+            alpha = np.exp(-1 / (self.time_constant * self.chunk_rate))
+            self._iir = ([1 - alpha], [1.0, -alpha])
+            self._state = np.zeros((self.poles, rows, 1), dtype=complex)
+            self.settle_chunks = int(np.ceil((self.poles + 3) * self.time_constant * self.chunk_rate))
+        else:
+            self.fir_length = max(1, int(round(self.time_constant * self.chunk_rate))) #in spans
+            self._sums = np.zeros((rows, self.fir_length), dtype=complex) #running sums of the last chunks
+            self.settle_chunks = self.fir_length
+        self._cycle = 0.0 #reference phase of the next sample, in periods (0 .. 1)
+        self._partial = np.zeros((rows, 0), dtype=complex) #mixed samples of an unfinished span
+        self._samples = 0 #samples consumed (processed or skipped)
+        self._chunks = 0 #spans filtered
+
+    def skip(self, num_samples):
+        #samples that were not processed (dropped block): the reference phase runs on, the filter holds its state
+        self._advance(num_samples)
+        self._partial = self._partial[:, :0]
+        self._samples += int(num_samples)
+
+    @timing.timed('lock_in')
+    def process(self, signal, current=None):
+        #one block of consecutive samples (current: the same samples of the current channel, None if not recorded).
+        #Returns (times s, harmonics (n, orders), reference (n,)) of the outputs that fall into the block, the
+        #reference is the complex amplitude of the current fundamental (NaN without current channel)
+        num_samples = len(signal)
+        base = np.exp(-2j * np.pi * self._advance(num_samples)) #exp(-j phi)
+        rows = np.empty((len(self.orders) + 1, num_samples), dtype=complex)
+        power = np.ones(num_samples, dtype=complex)
+        for order in range(1, int(self.orders.max(initial=0)) + 1): #exp(-j k phi) by recurrence, no exp per order
+            power *= base
+            rows[:-1][self.orders == order] = signal * power
+        rows[-1] = base * (current if current is not None else 0.0)
+
+        #average over spans of whole drive periods
+        start = self._samples - self._partial.shape[1] #sample index of the first mixed sample
+        rows = np.concatenate((self._partial, rows), axis=1)
+        count = rows.shape[1] // self.chunk_samples
+        self._partial = rows[:, count * self.chunk_samples:]
+        chunks = rows[:, :count * self.chunk_samples].reshape(len(rows), count, self.chunk_samples).mean(axis=-1)
+        self._samples += num_samples
+
+        filtered = self._filter(chunks)
+        index = self._chunks + np.arange(count)
+        self._chunks += count
+        keep = ((index + 1) % self.decimation == 0) & (index >= self.settle_chunks)
+        times = (start + (np.flatnonzero(keep) + 1) * self.chunk_samples) / self.sample_rate
+        harmonics, reference = filtered[:-1, keep].T, filtered[-1, keep]
+        if current is None:
+            reference = np.full(len(times), np.nan, dtype=complex)
+        elif self.reference == 'current':
+            harmonics = harmonics * np.exp(-1j * np.outer(np.angle(reference), self.orders))
+        return times, harmonics, reference
+
+    def _advance(self, num_samples):
+        #reference phase (in periods) of the next num_samples samples
+        step = self.frequency / self.sample_rate
+        cycles = self._cycle + np.arange(num_samples) * step
+        self._cycle = (self._cycle + num_samples * step) % 1.0
+        return cycles
+
+    def _filter(self, chunks):
+        if self.filter == 'iir':
+            from scipy.signal import lfilter
+            b, a = self._iir
+            for stage in range(self.poles):
+                chunks, self._state[stage] = lfilter(b, a, chunks, axis=-1, zi=self._state[stage])
+            return chunks
+        #moving average as a difference of running sums, rebased to the newest sum so they stay small
+        sums = self._sums[:, -1:] + np.cumsum(chunks, axis=-1)
+        extended = np.concatenate((self._sums, sums), axis=1)
+        self._sums = extended[:, -self.fir_length:] - extended[:, -1:]
+        return (sums - extended[:, :chunks.shape[1]]) / self.fir_length
+
+def _whole_periods(period, max_periods):
+    #fewest drive periods (period: samples per period) that span a whole number of samples
+    for count in range(1, int(max_periods) + 1):
+        if abs(count * period - round(count * period)) < 1e-6:
+            return count
+    raise ValueError(f"The lock-in needs a whole number of samples in at most {max_periods} drive periods "
+                     f"({period:.4f} samples per period), change the sample rate or the frequency")
+
+class LockInStream:
+    #continuous acquisition of the signal and current channels, a producer thread reads the DAQ and queues the
+    #blocks, a worker thread runs the lock-in. If the worker falls behind, blocks are dropped (the lock-in skips
+    #over them) instead of letting the load grow. The outputs are kept for history_time and appended to the
+    #results run of the writer. The writer is closed by the worker thread after its last append (by stop() if the
+    #worker is not running), so stop() never closes the file under a running append.
+    def __init__(self, signal_location, current_location, lock_in, trigger_location=None, writer=None,
+                 block_time=0.05, history_time=60.0, max_blocks=20):
+        self.signal_location = signal_location
+        self.current_location = current_location
+        self.lock_in = lock_in
+        self.sample_rate = lock_in.sample_rate
+        self.trigger_location = trigger_location #start on the sync edge ('sync' reference)
+        self.writer = writer
+        self.block_samples = max(lock_in.chunk_samples, int(self.sample_rate * block_time))
+
+        self.error = None #exception raised in one of the threads, if any
+        self.dropped_samples = 0
+        self._task = None
+        self._stop = threading.Event()
+        self._blocks = queue.Queue(maxsize=max_blocks) #(samples skipped before, (2, block_samples) block)
+        self._threads = []
+        self._history = deque(maxlen=max(1, int(history_time * lock_in.output_rate))) #(time, harmonics, reference)
+        self._count = 0 #outputs ever produced
+        self._lock = threading.Lock()
+
+    def start(self):
+        import nidaqmx #imported on first use, see daq_session
+        from nidaqmx.constants import AcquisitionType, Edge
+        self._task = nidaqmx.Task()
+        self._task.ai_channels.add_ai_voltage_chan(self.signal_location)
+        self._task.ai_channels.add_ai_voltage_chan(self.current_location)
+        if self.trigger_location is not None:
+            self._task.triggers.start_trigger.cfg_dig_edge_start_trig(self.trigger_location, Edge.RISING)
+        self._task.timing.cfg_samp_clk_timing(self.sample_rate, sample_mode=AcquisitionType.CONTINUOUS,
+                                              samps_per_chan=4 * self.block_samples)
+        self._task.start()
+        self._threads = [threading.Thread(target=self._produce, daemon=True),
+                         threading.Thread(target=self._analyze, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=2)
+        if self._task is not None:
+            self._task.close()
+            self._task = None
+        if not any(thread.is_alive() for thread in self._threads[1:]): #else the worker closes it when it exits
+            self._close_writer()
+
+    def _close_writer(self):
+        with self._lock:
+            writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.set_attrs(dropped_samples=self.dropped_samples)
+            writer.close()
+
+    def history(self, last_count=0):
+        #(count, times, harmonics (n, orders), reference) of the kept outputs if there are new ones since
+        #last_count, else None
+        with self._lock:
+            if self._count <= last_count:
+                return None
+            rows = list(self._history)
+            count = self._count
+        times = np.array([row[0] for row in rows])
+        harmonics = np.array([row[1] for row in rows]).reshape(len(rows), len(self.lock_in.orders))
+        reference = np.array([row[2] for row in rows])
+        return count, times, harmonics, reference
+
+    def _produce(self):
+        import nidaqmx
+        from nidaqmx.stream_readers import AnalogMultiChannelReader
+        reader = AnalogMultiChannelReader(self._task.in_stream)
+        skipped = 0
+        try:
+            while not self._stop.is_set():
+                block = np.empty((2, self.block_samples), dtype=np.float64)
+                reader.read_many_sample(block, number_of_samples_per_channel=self.block_samples, timeout=10.0)
+                try:
+                    self._blocks.put_nowait((skipped, block))
+                    skipped = 0
+                except queue.Full: #the lock-in is behind
+                    skipped += self.block_samples
+                    self.dropped_samples += self.block_samples
+        except nidaqmx.DaqError as e:
+            if not self._stop.is_set(): #closing the task while reading is expected on stop
+                self.error = e
+                self._stop.set()
+
+    def _analyze(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    skipped, block = self._blocks.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                if skipped:
+                    self.lock_in.skip(skipped)
+                times, harmonics, reference = self.lock_in.process(block[0], block[1])
+                if not len(times):
+                    continue
+                with self._lock:
+                    self._history.extend(zip(times, harmonics, reference))
+                    self._count += len(times)
+                if self.writer is not None:
+                    self.writer.append('lock_in_time', times)
+                    self.writer.append('lock_in_harmonics', harmonics, chunk_rows=256)
+                    self.writer.append('lock_in_reference', reference)
+        except Exception as e:
+            self.error = e
+            self._stop.set()
+        finally:
+            self._close_writer()
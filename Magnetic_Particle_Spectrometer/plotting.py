@@ -0,0 +1,165 @@
+import numpy as np
+from matplotlib.ticker import AutoLocator
+
+import timing
+
+#Retained mode plotting for the MPS canvases: the Line2D artists are created once and then only get new data with
+#set_data. A canvas is only redrawn when something on it changed, and the live spectrum is blitted.
+#The Tk canvas of a panel can be built later: make_canvas() is called the first time the canvas is needed.
+
+class PlotPanel:
+    def __init__(self, figure, ax, canvas=None, make_canvas=None):
+        self.figure = figure
+        self.ax = ax
+        self._canvas = None
+        self._make_canvas = make_canvas
+        self.lines = {} #name -> Line2D
+        self._data = {} #name -> (x, y) last arrays given, to skip unchanged data
+        self._labels = None
+        self._xaxis = None
+        self._legend = False
+        self._index_cache = np.arange(0)
+        self._background = None #cached pixels of the axes without the animated (blitted) lines
+        self.dirty = False
+        if canvas is not None:
+            self._attach(canvas)
+
+    @property
+    def canvas(self):
+        if self._canvas is None:
+            self._attach(self._make_canvas())
+        return self._canvas
+
+    @property
+    def has_canvas(self):
+        return self._canvas is not None
+
+    def _attach(self, canvas):
+        self._canvas = canvas
+        canvas.mpl_connect('draw_event', self._on_draw)
+        canvas.draw = timing.timed('canvas_draw')(canvas.draw) #also times the deferred draw_idle renders
+
+    def configure(self, title, xlabel, ylabel, xlim=None, xticks=None):
+        labels = (title, xlabel, ylabel)
+        if labels != self._labels:
+            self.ax.set_title(title, fontsize=11)
+            self.ax.set_xlabel(xlabel, fontsize=10)
+            self.ax.set_ylabel(ylabel, fontsize=10)
+            self._labels = labels
+            self.figure.tight_layout()
+            self.dirty = True
+
+        xaxis = (None if xlim is None else tuple(xlim), None if xticks is None else tuple(xticks))
+        if xaxis != self._xaxis:
+            if xlim is None:
+                self.ax.set_autoscalex_on(True)
+            else:
+                self.ax.set_xlim(left=xlim[0], right=xlim[1])
+            if xticks is None:
+                self.ax.xaxis.set_major_locator(AutoLocator())
+            else:
+                self.ax.set_xticks(list(xticks))
+            self._xaxis = xaxis
+            self.dirty = True
+
+    def set_line(self, name, x, y, label=None, animated=False):
+        #creates the line the first time, afterwards only swaps its data (no-op if the same arrays are given again)
+        if x is None:
+            x = self._index(len(y)) #plot against the sample number like ax.plot(y)
+        line = self.lines.get(name)
+        if line is None:
+            line, = self.ax.plot(x, y, label=label if label is not None else name, animated=animated)
+            self.lines[name] = line
+        elif name in self._data and self._data[name][0] is x and self._data[name][1] is y:
+            return
+        else:
+            line.set_data(x, y)
+            if label is not None:
+                line.set_label(label)
+        self._data[name] = (x, y)
+        self.dirty = True
+
+    def keep_lines(self, names):
+        #removes the lines that are not part of the new plot
+        for name in [name for name in self.lines if name not in names]:
+            self.lines.pop(name).remove()
+            self._data.pop(name, None)
+            self.dirty = True
+
+    def update(self, title, xlabel, ylabel, lines, xlim=None, xticks=None, legend=False, legend_loc='best'):
+        #lines: {name: (x, y)} or {name: (x, y, label)}, x=None plots against the sample number
+        self.configure(title, xlabel, ylabel, xlim, xticks)
+        for name, line in lines.items():
+            self.set_line(name, *line)
+        self.keep_lines(lines)
+        self.finish(legend, legend_loc)
+
+    def add_line(self, name, x, y, label=None, legend=False, legend_loc='best'):
+        #adds (or replaces) one line and keeps the others, e.g. the MH curve comparison
+        self.set_line(name, x, y, label)
+        self.finish(legend, legend_loc)
+
+    def finish(self, legend=False, legend_loc='best'):
+        if not self.dirty:
+            return
+        self.ax.relim()
+        self.ax.set_autoscaley_on(True) #the live spectrum fixes the y limits for blitting
+        self.ax.autoscale_view()
+        if legend:
+            self.ax.legend(loc=legend_loc)
+        elif self._legend and self.ax.get_legend() is not None:
+            self.ax.get_legend().remove()
+        self._legend = legend
+        self.draw()
+
+    def draw(self):
+        if self.dirty:
+            self.canvas.draw_idle()
+            self.dirty = False
+
+    def clear(self):
+        self.ax.clear()
+        self.lines = {}
+        self._data = {}
+        self._labels = None
+        self._xaxis = None
+        self._legend = False
+        self._background = None
+        self.canvas.draw_idle()
+        self.dirty = False
+
+    def blit_line(self, name, x, y, headroom=1.2):
+        #fast path for the live spectrum: only the line is redrawn on top of the cached background. A full redraw
+        #(which recaches the background) only happens for a new line or when the y range has to change.
+        line = self.lines.get(name)
+        bottom, top = self.ax.get_ylim()
+        peak = np.max(y) if len(y) else 0
+        if (self.dirty or line is None or self._background is None or peak > top
+                or peak < top / (4 * headroom)):
+            self.set_line(name, x, y, animated=True)
+            self.keep_lines([name])
+            self.ax.relim()
+            self.ax.autoscale_view(scaley=False) #x follows the data unless configure() fixed the limits
+            self.ax.set_ylim(0, peak * headroom if peak > 0 else 1)
+            self.canvas.draw() #draw_event recaches the background and draws the line
+            self.dirty = False
+            return
+        with timing.timer.stage('canvas_blit'):
+            line.set_data(x, y)
+            self.canvas.restore_region(self._background)
+            self.ax.draw_artist(line)
+            self.canvas.blit(self.ax.bbox)
+
+    def _on_draw(self, event):
+        animated = [line for line in self.lines.values() if line.get_animated()]
+        if not animated: #only the blitted (live) panel needs the background
+            self._background = None
+            return
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        for line in animated:
+            self.ax.draw_artist(line)
+
+    def _index(self, n):
+        if len(self._index_cache) != n:
+            self._index_cache = np.arange(n)
+        return self._index_cache
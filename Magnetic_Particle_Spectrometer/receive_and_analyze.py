@@ -1,8 +1,10 @@
 import numpy as np
-import nidaqmx
+from functools import cached_property, lru_cache
 import wave_gen
-from nidaqmx.constants import AcquisitionType, Edge
-import matplotlib.pyplot as plt
+import daq_session
+import current_analysis
+import coherent_average
+import timing
 
 ######################## USED IN main.py only (Example Code) #######################################
 def background_subtraction(daq_location, sense_location, sample_rate, num_samples, gpib_address, amplitude, frequency, channel, isclean):
@@ -15,8 +17,8 @@ def background_subtraction(daq_location, sense_location, sample_rate, num_sample
     background = receive_raw_voltage(daq_location, sample_rate, num_samples) #receive the background
     background_magnitude, background_frequency, sample_phase, background_complex = fourier(background, sample_rate, num_samples)
 
-    #Turn the waveform generator off:
-    waveform_generator.write(f"OUTPUT{channel} OFF")
+    #Turn the waveform generator off (through the driver so its cached output state stays correct):
+    wave_gen.turn_off(waveform_generator, channel)
 
     #Let user start the second signal to measure SPIO charactristics
     insert_sample = input("Did you insert the sample? ")
@@ -48,18 +50,20 @@ def background_subtraction(daq_location, sense_location, sample_rate, num_sample
 
 ################################# Used in MPS_app.py: ###############################################
 def receive_raw_voltage(daq_location, sample_rate, n_samps, trigger_location=None,):
-    with nidaqmx.Task() as task:
-        task.ai_channels.add_ai_voltage_chan(daq_location)
-        # Add a trigger source and set it to rising edge
-        if trigger_location is not None:
-            task.triggers.start_trigger.cfg_dig_edge_start_trig(trigger_location, Edge.RISING)
+    #the configured task is cached by daq_session and re-armed for every read (returns a float64 numpy array)
+    voltage_raw = daq_session.sessions.read(daq_location, sample_rate, int(n_samps), trigger_location)
+    return voltage_raw[0]
 
-        task.timing.cfg_samp_clk_timing(sample_rate, samps_per_chan=int(n_samps))
-        voltage_raw = task.read(number_of_samples_per_channel= int(n_samps))
-        return voltage_raw
+def receive_multi_channel(daq_locations, sample_rate, n_samps, trigger_location=None, reuse_buffer=False):
+    #all channels share one sample clock and trigger, so row i of the result is sample aligned with every other row
+    #reuse_buffer=True hands back the preallocated read buffer itself (valid until the next read of the same setup)
+    voltage_raw = daq_session.sessions.read(list(daq_locations), sample_rate, int(n_samps), trigger_location,
+                                            copy=not reuse_buffer)
+    return voltage_raw #shape (num_channels, n_samps)
 
 def get_background(daq_location, source_location, trigger_location, sample_rate, num_periods, gpib_address,
-                   amplitude, frequency, channel, dc_current):
+                   amplitude, frequency, channel, dc_current, average=None):
+    #average: coherent_average.FrameAverage to average its num_frames frames instead of taking one record
     num_pts_per_period = sample_rate/ frequency #Fs/F_drive
     num_samples = int(num_periods * num_pts_per_period)
 
@@ -72,36 +76,233 @@ def get_background(daq_location, source_location, trigger_location, sample_rate,
     #Connect to the DC power supply and send the current through the helmholtz coils:
     power_supply = wave_gen.DC_offset(dc_current)
 
-    background = receive_raw_voltage(daq_location, sample_rate, num_samples, trigger_location) #receive the background (raw daq readout)
+    if average is None:
+        background = receive_raw_voltage(daq_location, sample_rate, num_samples, trigger_location) #receive the background (raw daq readout)
+    else:
+        background = coherent_average.acquire([daq_location], sample_rate, num_samples, trigger_location, average,
+                                              frequency)[0]
 
     #Turn the waveform generator and power supply off:
     if waveform_generator is not None:
         wave_gen.turn_off(waveform_generator, channel)
     if power_supply:
-        wave_gen.turn_off_dc_output(power_supply)
-        power_supply.close()
+        wave_gen.turn_off_dc_output(power_supply) #the session stays open in wave_gen.pool
 
     background_magnitude, background_frequency, background_phase, background_complex = fourier(background, sample_rate, num_samples)
     #Apply a mask for the background magnitude if needed:
     #background_magnitude = cutoff(background_amplitude)
 
     return num_samples, background_magnitude, background_frequency, background_phase, background, background_complex
+@timing.timed('harmonic_dft')
+def harmonic_amplitudes(records, sample_rate, f_drive, orders=range(1, 12), window=None, interpolation='nominal'):
+    #complex amplitudes (normalized like fourier()) of only the requested harmonic orders, for one record (N,)
+    #or a stack of records (..., N). Returns (orders, amplitudes) with amplitudes of shape (..., len(orders)).
+    #window=None reads the closest integer bins (exact for whole drive periods), else see windowed_harmonics()
+    records = np.asarray(records, dtype=np.float64)
+    num_samples = records.shape[-1]
+    if window is not None:
+        orders, amplitudes, _ = windowed_harmonics(spectrum(records, sample_rate, num_samples).complex, num_samples,
+                                                   sample_rate, f_drive, orders, window, interpolation)
+        return orders, amplitudes
+    orders = np.asarray(orders, dtype=np.intp)
+    map_orders, map_bins = harmonic_bin_map(num_samples, sample_rate, f_drive, int(orders.max()))
+    orders = orders[np.isin(orders, map_orders)] #drop orders above nyquist
+    bins = map_bins[orders - 1]
+
+    #Fold the record onto the shortest length L that holds all requested bins an integer number of times
+    #(one drive period when the record holds whole periods), then do an L point targeted DFT: O(N + k*L)
+    fold = np.gcd.reduce(np.append(bins, num_samples))
+    length = num_samples // fold
+    if length * len(bins) <= _MAX_DFT_KERNEL:
+        folded = records.reshape(records.shape[:-1] + (fold, length)).sum(axis=-2)
+        amplitudes = folded @ _dft_kernel(length, tuple(bins // fold))
+    else:
+        amplitudes = _goertzel(records, bins, num_samples)
+    return orders, amplitudes / num_samples
+
+_MAX_DFT_KERNEL = 2 ** 21 #complex elements (32 MB)
+
+@lru_cache(maxsize=32)
+def _dft_kernel(length, bins):
+    n = np.arange(length)
+    kernel = np.exp(-2j * np.pi * np.outer(n, bins) / length) #shape (length, k)
+    kernel.flags.writeable = False
+    return kernel
+
+def _goertzel(records, bins, num_samples):
+    #second order Goertzel recurrence s[n] = x[n] + 2cos(w)s[n-1] - s[n-2] run by lfilter, one harmonic at a time
+    from scipy.signal import lfilter
+    amplitudes = np.empty(records.shape[:-1] + (len(bins),), dtype=complex)
+    for i, k in enumerate(bins):
+        w = 2 * np.pi * k / num_samples
+        s = lfilter([1.0], [1.0, -2 * np.cos(w), 1.0], records, axis=-1)
+        amplitudes[..., i] = np.exp(1j * w) * s[..., -1] - s[..., -2]
+    return amplitudes
+
+#Windowed harmonic estimation, for records that do not hold a whole number of drive periods (any sample rate /
+#frequency combination, short records). The window is applied to the one sided fourier() spectrum as a short
+#convolution (cosine sum windows), so stored spectra (backgrounds) can be windowed after the fact. A harmonic is read
+#at the bin m closest to its position m + delta and divided by the window response at delta, which corrects the
+#coherent gain, the scalloping loss and the phase of the off bin position. delta comes from:
+#   'nominal'   - the drive frequency, k f_drive N / fs (exact when the DAQ and generator clocks agree)
+#   'parabolic' - the vertex of a parabola through the log magnitudes of the three bins around the peak, mapped back
+#                 to delta through the window's own response (the plain vertex is biased for every window), falls
+#                 back to 'nominal' where the neighbours are numerically 0 (rectangular window on whole periods)
+#   'sinc'      - the closed form for the ratio of the two largest bins (rectangular and hann windows only)
+
+WINDOWS = {'rectangular': (1.0,),
+           'hann': (0.5, 0.5),
+           'blackmanharris': (0.35875, 0.48829, 0.14128, 0.01168),
+           'flattop': (0.21557895, 0.41663158, 0.277263158, 0.083578947, 0.006947368)}
+INTERPOLATIONS = ('nominal', 'parabolic', 'sinc')
+SINC_WINDOWS = ('rectangular', 'hann') #windows with a closed form 'sinc' estimator
+
+def windowed_spectrum(fourier_complex, window):
+    #spectrum of the windowed record from the fourier() spectrum (..., bins) of the record, w[n] = sum_i (-1)^i a_i
+    #cos(2 pi i n / N): X_w[m] = a_0 X[m] + sum_i (-1)^i a_i (X[m-i] + X[m+i]) / 2. Below DC X[-i] = conj(X[i]),
+    #the bins beyond the last one are taken as 0 (the last taps bins are approximate)
+    coefficients = WINDOWS[window]
+    taps = len(coefficients) - 1
+    fourier_complex = np.asarray(fourier_complex)
+    num_bins = fourier_complex.shape[-1]
+    padded = np.concatenate((np.conj(fourier_complex[..., taps:0:-1]), fourier_complex,
+                             np.zeros(fourier_complex.shape[:-1] + (taps,), dtype=complex)), axis=-1)
+    windowed = coefficients[0] * fourier_complex
+    for i, a in enumerate(coefficients[1:], 1):
+        windowed = windowed + (-1) ** i * a / 2 * (padded[..., taps - i:taps - i + num_bins] +
+                                                     padded[..., taps + i:taps + i + num_bins])
+    return windowed
+
+def window_response(delta, window, num_samples):
+    #windowed spectrum at the bin delta bins below a tone of complex amplitude 1 (the coherent gain a_0 at delta=0)
+    delta = np.asarray(delta, dtype=float)
+    coefficients = WINDOWS[window]
+    response = coefficients[0] * _dirichlet(delta, num_samples)
+    for i, a in enumerate(coefficients[1:], 1):
+        response = response + (-1) ** i * a / 2 * (_dirichlet(delta + i, num_samples) +
+                                                    _dirichlet(delta - i, num_samples))
+    return response
+
+def _dirichlet(nu, num_samples):
+    #sum_n exp(2j pi nu n / N) / N, the rectangular window response nu bins from a tone
+    denominator = num_samples * np.sin(np.pi * nu / num_samples)
+    small = np.abs(denominator) < 1e-12
+    ratio = np.sin(np.pi * nu) / np.where(small, 1.0, denominator)
+    return np.exp(1j * np.pi * nu * (num_samples - 1) / num_samples) * np.where(small, 1.0, ratio)
+
+@lru_cache(maxsize=32)
+def _parabolic_table(window, num_samples):
+    #log parabola vertex of a tone delta bins from the peak bin, over delta (increasing), for np.interp
+    delta = np.linspace(-0.5, 0.5, 2001)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        below, center, above = (np.log(np.abs(window_response(delta + offset, window, num_samples)))
+                                for offset in (1, 0, -1))
+        vertex = 0.5 * (below - above) / (below - 2 * center + above)
+    valid = np.isfinite(vertex)
+    return vertex[valid], delta[valid]
+
+def windowed_harmonics(fourier_complex, num_samples, sample_rate, f_drive, orders=range(1, 12), window='hann',
+                       interpolation='nominal'):
+    #complex amplitudes (normalized like fourier(), phase at the first sample) of the harmonic orders from the
+    #fourier() spectrum (..., bins) of a record of num_samples. Returns (orders, amplitudes, frequencies), both
+    #(..., len(orders)), frequencies are the estimated harmonic frequencies (Hz)
+    if window not in WINDOWS:
+        raise ValueError(f"Unknown window '{window}', use one of {list(WINDOWS)}")
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError(f"Unknown interpolation '{interpolation}', use one of {INTERPOLATIONS}")
+    if interpolation == 'sinc' and window not in SINC_WINDOWS:
+        raise ValueError(f"sinc interpolation is only defined for the {' and '.join(SINC_WINDOWS)} windows")
+    windowed = windowed_spectrum(fourier_complex, window)
+    num_bins = windowed.shape[-1]
+    orders = np.asarray(orders, dtype=np.intp)
+    position = orders * f_drive * num_samples / sample_rate #nominal bin position of every order
+    inside = np.rint(position) < num_bins - 1 #drop orders at or above nyquist
+    orders, position = orders[inside], position[inside]
+    shape = windowed.shape[:-1] + (len(orders),)
+    nominal = np.rint(position).astype(np.intp)
+
+    if interpolation == 'nominal':
+        peak = np.broadcast_to(nominal, shape)
+        delta = np.broadcast_to(position - nominal, shape)
+    else:
+        #the largest of the three bins around the nominal one is the peak, delta from it and its neighbours
+        candidates = np.clip(nominal[:, np.newaxis] + np.array([-1, 0, 1]), 1, num_bins - 2)
+        magnitude = np.abs(windowed[..., candidates]) #(..., orders, 3)
+        peak = np.take_along_axis(np.broadcast_to(candidates, magnitude.shape),
+                                  np.argmax(magnitude, axis=-1)[..., np.newaxis], axis=-1)[..., 0]
+        below, center, above = (np.abs(np.take_along_axis(windowed, peak + offset, axis=-1)) for offset in (-1, 0, 1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if interpolation == 'parabolic':
+                floor = np.maximum(below, above) <= 1e-9 * center #neighbours at the numerical noise floor
+                below, center, above = (np.log(v) for v in (below, center, above))
+                vertex = 0.5 * (below - above) / (below - 2 * center + above)
+                delta = np.interp(vertex, *_parabolic_table(window, num_samples))
+                delta = np.where(floor | ~np.isfinite(vertex), position - peak, delta)
+            else:
+                right = above >= below
+                ratio = np.where(right, above, below) / center
+                delta = ratio / (1 + ratio) if window == 'rectangular' else (2 * ratio - 1) / (ratio + 1)
+                delta = np.where(right, delta, -delta)
+        delta = np.clip(np.nan_to_num(delta), -0.5, 0.5)
+
+    amplitudes = np.take_along_axis(windowed, peak, axis=-1) / window_response(delta, window, num_samples)
+    frequencies = (peak + delta) * sample_rate / num_samples
+    return orders, amplitudes, frequencies
+
+def get_sample_harmonics(daq_location, sense_location, trigger_location, sample_rate, num_periods, frequency,
+                         background_complex, orders=range(1, 12)):
+    #sweep step version of get_sample_signal: one synchronized acquisition, only the requested harmonics are computed
+    records = acquire_sample_records(daq_location, sense_location, trigger_location, sample_rate, num_periods,
+                                     frequency, reuse_buffer=True) #consumed right away
+    return analyze_sample_harmonics(records, sample_rate, frequency, background_complex, orders)
+
+def acquire_sample_records(daq_location, sense_location, trigger_location, sample_rate, num_periods, frequency,
+                           reuse_buffer=False, average=None):
+    num_pts_per_period = sample_rate/ frequency #Fs/F_drive
+    num_samples = int(num_periods * num_pts_per_period)
+    if average is not None:
+        return coherent_average.acquire([daq_location, sense_location], sample_rate, num_samples, trigger_location,
+                                        average, frequency)
+    return receive_multi_channel([daq_location, sense_location], sample_rate, num_samples, trigger_location,
+                                 reuse_buffer)
+
+def analyze_sample_harmonics(records, sample_rate, frequency, background_complex, orders=range(1, 12), window=None,
+                             interpolation='nominal'):
+    #records: (signal, current) rows of one synchronized acquisition
+    num_samples = records.shape[-1]
+    i_rms = rms_current_from_voltage(records[1], num_samples)
+    if window is not None:
+        #background subtracted from the whole spectrum first, the window and the interpolation only see the sample
+        sample_spectrum = spectrum(records[0], sample_rate, num_samples).complex
+        if background_complex is not None:
+            sample_spectrum = sample_spectrum - background_complex
+        orders, sample_harmonics, _ = windowed_harmonics(sample_spectrum, num_samples, sample_rate, frequency, orders,
+                                                         window, interpolation)
+        return num_samples, orders, sample_harmonics, i_rms
+
+    orders, signal_harmonics = harmonic_amplitudes(records[0], sample_rate, frequency, orders)
+
+    # subtract background at the same bins:
+    sample_harmonics = signal_harmonics
+    if background_complex is not None:
+        _, bins = harmonic_bin_map(num_samples, sample_rate, frequency, int(orders.max()))
+        sample_harmonics = signal_harmonics - background_complex[bins[orders - 1]]
+
+    return num_samples, orders, sample_harmonics, i_rms
+
+@timing.timed('harmonics_mask')
 def harmonics(fourier, fourier_frequency, f_d, sample_rate):
-    # Convert fundamental to kHz
-    main_harmonic = f_d / 1000 #in kHz
-    max_harmonic = int((sample_rate / 2) // f_d) #this is based on the nyquist frequency
-    multiples = np.arange(1, max_harmonic + 1, 1)   #odd_multiples = np.arange(1, max_harmonic + 1, 2) #creates array of odd numbers
-
-    # Compute the exact odd harmonic frequencies in kHz
-    harmonic_freqs_kHz = main_harmonic * multiples
-    frequency_kHz = np.abs(fourier_frequency / 1000)
-    mask = np.isin(frequency_kHz, harmonic_freqs_kHz)
+    #keep only the bins of the harmonics of f_d (up to the nyquist frequency), using the cached integer bin map
+    num_samples = int(round(sample_rate / fourier_frequency[1]))
+    _, bins = harmonic_bin_map(num_samples, sample_rate, f_d)
+    mask = np.zeros(len(fourier))
+    mask[bins] = 1
 
     fourier = fourier*mask
     return fourier
 
 def get_sample_signal(daq_location, sense_location, trigger_location, sample_rate, num_periods, gpib_address, amplitude,
-                      frequency, channel, dc_current, background_complex, isClean):
+                      frequency, channel, dc_current, background_complex, isClean, reuse_buffer=False, average=None):
     num_pts_per_period = sample_rate/ frequency #Fs/F_drive
     num_samples = int(num_periods * num_pts_per_period)
 
@@ -116,18 +317,23 @@ def get_sample_signal(daq_location, sense_location, trigger_location, sample_rat
         waveform_generator = wave_gen.connect_waveform_generator(gpib_address)
         wave_gen.send_voltage(waveform_generator, amplitude, frequency, channel)
 
-    # Receive signal
-    signal_with_background = receive_raw_voltage(daq_location, sample_rate, num_samples, trigger_location)
+    # Receive signal and current in one hardware timed acquisition (or the coherent average of several)
+    if average is None:
+        records = receive_multi_channel([daq_location, sense_location], sample_rate, num_samples, trigger_location,
+                                        reuse_buffer)
+    else:
+        records = coherent_average.acquire([daq_location, sense_location], sample_rate, num_samples, trigger_location,
+                                           average, frequency)
+    signal_with_background = records[0]
 
-    # Get the rms current
-    i_rms = get_rms_current(sense_location, fs=sample_rate, num_samples=num_samples, trigger_location=trigger_location)
+    # Get the rms current from the same drive periods as the signal (records[1] is returned for the H(t) pipeline)
+    i_rms = rms_current_from_voltage(records[1], num_samples)
 
     #Turn off waveform generator and power supply and close:
     if waveform_generator is not None:
         wave_gen.turn_off(waveform_generator, channel)
     if power_supply is not None:
-        wave_gen.turn_off_dc_output(power_supply)
-        power_supply.close()
+        wave_gen.turn_off_dc_output(power_supply) #the session stays open in wave_gen.pool
 
     signal_with_background_magnitude, signal_frequency, sample_with_background_phase, signal_with_background_complex =\
                                     fourier(signal_with_background, sample_rate, num_samples)
@@ -143,25 +349,69 @@ def get_sample_signal(daq_location, sense_location, trigger_location, sample_rat
         sample_magnitude = harmonics(sample_magnitude, signal_frequency, frequency, sample_rate) #will give the magnitudes of the odd harmonics only
 
     return (num_samples, sample_magnitude, signal_frequency, signal_with_background, sample_phase,
-            i_rms, signal_with_background_complex, sample_complex)
+            i_rms, signal_with_background_complex, sample_complex, records[1])
 
 def fourier(waveform, sample_rate, num_samples):
-    #Find real and imaginary amplitudes
-    fourier_complex = np.fft.fft(waveform)/num_samples #dividing by num_samples for normalization
-
-    #Setup a frequency array for the amplitudes
-    fourier_frequency = np.fft.fftfreq(num_samples, d = 1/sample_rate) #array of length equal to the
-                                                                        # number of samples and spaced by
-                                                                        # the period = 1/sample rate
-    abs_mask = fourier_frequency>=0 #getting positive frequency data only (expected)
-    fourier_frequency = fourier_frequency[abs_mask]
-    fourier_complex = fourier_complex[abs_mask]
-
-    Cn= np.abs(fourier_complex)
-    phase = np.angle(fourier_complex)
-
-    return Cn, fourier_frequency, phase, fourier_complex
-
+    #Find real and imaginary amplitudes (positive frequencies only), magnitude Cn and phase
+    fourier_spectrum = spectrum(waveform, sample_rate, num_samples)
+    return (fourier_spectrum.magnitude, fourier_spectrum.frequency, fourier_spectrum.phase,
+            fourier_spectrum.complex)
+
+@timing.timed('fft')
+def spectrum(waveform, sample_rate, num_samples):
+    #rfft only computes the positive frequencies, which are the only ones we keep anyway
+    num_samples = int(num_samples)
+    frequency = frequency_axis(num_samples, sample_rate)
+    fourier_complex = np.fft.rfft(waveform, n=num_samples)[:len(frequency)] / num_samples #normalized like fft/N
+    return Spectrum(fourier_complex, frequency, num_samples, sample_rate)
+
+class Spectrum:
+    #positive frequency spectrum with the magnitude and phase only computed when they are asked for
+    def __init__(self, fourier_complex, frequency, num_samples, sample_rate):
+        self.complex = fourier_complex
+        self.frequency = frequency
+        self.num_samples = num_samples
+        self.sample_rate = sample_rate
+
+    @cached_property
+    def magnitude(self):
+        return np.abs(self.complex)
+
+    @cached_property
+    def phase(self):
+        return np.angle(self.complex)
+
+    def harmonic_bins(self, f_drive, max_order=None):
+        return harmonic_bin_map(self.num_samples, self.sample_rate, f_drive, max_order)
+
+    def harmonics(self, f_drive, max_order=None):
+        #complex amplitudes of the harmonics of f_drive (orders, values)
+        orders, bins = self.harmonic_bins(f_drive, max_order)
+        return orders, self.complex[bins]
+
+@lru_cache(maxsize=32)
+def frequency_axis(num_samples, sample_rate):
+    #same positive frequencies as fftfreq(num_samples)[fftfreq >= 0] (the nyquist bin of rfftfreq is dropped)
+    frequency = np.fft.rfftfreq(num_samples, d=1/sample_rate)[:(num_samples + 1) // 2]
+    frequency.flags.writeable = False #shared between callers through the cache
+    return frequency
+
+@lru_cache(maxsize=64)
+def harmonic_bin_map(num_samples, sample_rate, f_drive, max_order=None):
+    #integer index of the bin closest to every harmonic k*f_drive, k = 1..max_order (default: up to nyquist)
+    num_bins = (num_samples + 1) // 2
+    df = sample_rate / num_samples
+    if max_order is None:
+        max_order = int((sample_rate / 2) // f_drive)
+    orders = np.arange(1, max_order + 1)
+    bins = np.rint(orders * f_drive / df).astype(np.intp)
+    inside = bins < num_bins
+    orders, bins = orders[inside], bins[inside]
+    orders.flags.writeable = False
+    bins.flags.writeable = False
+    return orders, bins
+
+@timing.timed('reconstruct')
 def reconstruct_and_integrate(num_samples, frequency_array, cn, f_drive, phase=None):
     f = frequency_array[:num_samples]
     coeff = cn[:num_samples]
@@ -186,6 +436,91 @@ def reconstruct_and_integrate(num_samples, frequency_array, cn, f_drive, phase=N
     integral_half = integral[first_idx: second_idx] - np.mean(integral[first_idx: second_idx]) #get rid of DC offset
     return recon_half, integral_half
 
+@timing.timed('reconstruct')
+def reconstruct_and_integrate_fast(num_samples, frequency_array, cn, f_drive, phase=None, num_harmonics=None,
+                                   chunk_size=256):
+    #Same output as reconstruct_and_integrate, but only the returned period is evaluated and all bins are summed at once.
+    #num_harmonics = N restricts the sum to the first N harmonics of f_drive (ignores the noise between them)
+    f = np.asarray(frequency_array[:num_samples], dtype=float)
+    coeff = np.asarray(cn[:num_samples], dtype=float)
+    if phase is not None:
+        phase = np.asarray(phase[:num_samples], dtype=float)
+    else:
+        phase = np.zeros(len(coeff))
+
+    t_half = one_period_grid(f_drive)
+
+    if num_harmonics is not None:
+        bins = harmonic_bins(f, f_drive, num_harmonics)
+        f, coeff, phase = f[bins], coeff[bins], phase[bins]
+
+    keep = f != 0 #the DC term does not contribute (same as the loop)
+    f, coeff, phase = f[keep], coeff[keep], phase[keep]
+    omega = 2 * np.pi * f
+
+    # recon = Re(sum a_k e^(i w_k t)) and integral = Im(sum a_k/w_k e^(i w_k t)) with a_k = c_k e^(i phi_k)
+    weights = np.empty((2, len(f)), dtype=complex)
+    weights[0] = coeff * np.exp(1j * phase)
+    weights[1] = weights[0] / omega
+
+    if num_harmonics is None and _is_uniform_grid(f):
+        summed = _chirp_sum(weights, f, t_half)
+    else:
+        summed = np.zeros((2, len(t_half)), dtype=complex)
+        for start in range(0, len(f), chunk_size): #chunks keep the (time x bins) kernel small
+            kernel = np.exp(1j * np.outer(t_half, omega[start:start + chunk_size]))
+            summed += weights[:, start:start + chunk_size] @ kernel.T
+
+    recon_half = summed[0].real
+    integral_half = summed[1].imag - np.mean(summed[1].imag) #get rid of DC offset
+    return recon_half, integral_half
+
+@lru_cache(maxsize=16)
+def one_period_grid(f_drive):
+    #time points (s, from the first sample of the record) of the period returned by reconstruct_and_integrate(_fast)
+    t = np.linspace(0, 4 / f_drive, 40000)
+    first_idx = len(t)//8 +len(t)//16
+    second_idx = first_idx + len(t)//4 #so we can get 1 period
+    t_half = t[first_idx: second_idx]
+    t_half.flags.writeable = False #shared by every caller through the cache
+    return t_half
+
+@timing.timed('field')
+def field_from_current(current_voltage, sample_rate, f_drive, coefficient, num_harmonics=11, sensor=None, window=None,
+                       interpolation='nominal'):
+    #H(t) (mT) on the same one period grid (and time origin) as the magnetization of reconstruct_and_integrate_fast,
+    #rebuilt from the complex harmonics of the drive current recorded in the same acquisition as the signal
+    current = current_analysis.get_sensor(sensor).to_current(current_voltage)
+    orders, amplitudes = harmonic_amplitudes(current, sample_rate, f_drive, range(1, num_harmonics + 1), window,
+                                             interpolation)
+    t = one_period_grid(f_drive)
+    # amplitudes are normalized like fourier() (one sided, /N), so the peak current of harmonic k is 2|a_k|
+    kernel = np.exp(2j * np.pi * f_drive * np.outer(orders, t))
+    current_period = 2 * (amplitudes @ kernel).real
+    return coefficient * current_period
+
+def harmonic_bins(frequency_array, f_drive, num_harmonics):
+    #indices of the bins closest to f_drive, 2*f_drive, ... N*f_drive (on a uniform fft frequency grid)
+    df = frequency_array[1] - frequency_array[0]
+    orders = np.arange(1, num_harmonics + 1)
+    bins = np.rint((orders * f_drive - frequency_array[0]) / df).astype(int)
+    return bins[bins < len(frequency_array)]
+
+def _is_uniform_grid(f):
+    if len(f) < 2:
+        return False
+    steps = np.diff(f)
+    return np.allclose(steps, steps[0], rtol=1e-9, atol=0)
+
+def _chirp_sum(weights, f, t):
+    #evaluates sum_k w_k e^(i 2pi f_k t_n) for uniform f_k = f0 + k*df and t_n = t0 + n*dt with one chirp-z (FFT) transform
+    from scipy.signal import czt
+    df = f[1] - f[0]
+    dt = t[1] - t[0]
+    shifted = weights * np.exp(2j * np.pi * np.arange(len(f)) * df * t[0])
+    summed = czt(shifted, m=len(t), w=np.exp(2j * np.pi * df * dt), a=1, axis=-1)
+    return summed * np.exp(2j * np.pi * f[0] * t)
+
 def general_reconstruction(amplitude, frequency):
     t= np.linspace(0, 1/frequency, 10000)
 
@@ -195,6 +530,7 @@ def general_reconstruction(amplitude, frequency):
 
     return recon
 
+@timing.timed('dMdH')
 def dMdH(M, H): #differentiate M with respect to H and keep it the same length to plot
     dMdH = np.gradient(M, edge_order= 2)/np.gradient(H, edge_order= 2)
     dMdH[0]=0
@@ -202,29 +538,19 @@ def dMdH(M, H): #differentiate M with respect to H and keep it the same length t
 
     return dMdH
 
-def get_rms_current(daq_location, fs, num_samples, trigger_location):
-    # current sensing variables:
-    Vcc = 5.0
-    VQ = 0.5 * Vcc
-    sensitivity = 0.1
-    voltages_raw = np.zeros(num_samples)
-    currents = np.zeros(num_samples)
-    squares = np.zeros(num_samples)
-    squares_added = 0
-    i = 0
+def get_rms_current(daq_location, fs, num_samples, trigger_location, sensor=None):
     voltage = receive_raw_voltage(daq_location, fs, num_samples, trigger_location)
-    squares_added = 0
-
-    for i in range(num_samples):
-        voltages_raw[i] = voltage[i]
-        voltage_corrected = voltages_raw[i] - VQ
-        currents[i] = voltage_corrected / sensitivity
+    return rms_current_from_voltage(voltage, num_samples, sensor)
 
-        squares[i] = currents[i] ** 2
-        squares_added += squares[i]
+def get_current_stats(daq_location, fs, num_samples, trigger_location, f_drive=None, sensor=None):
+    #rms, peak, dc and fundamental (amplitude/phase at f_drive) of the drive current, see current_analysis
+    voltage = receive_raw_voltage(daq_location, fs, num_samples, trigger_location)
+    return current_analysis.analyze_current(voltage[:num_samples], fs, f_drive, sensor)
 
-    mean_square = squares_added / num_samples
-    rms_current = np.sqrt(mean_square)
+@timing.timed('rms_current')
+def rms_current_from_voltage(voltage, num_samples, sensor=None):
+    # sensor: name from current_analysis.SENSORS (default ACS712 20 A, 0.1 V/A around VQ = 2.5 V) or a CurrentSensor
+    rms_current = current_analysis.analyze_current(voltage[:num_samples], sensor=sensor).rms
 
     print(f"I(rms): {rms_current:.2f}")
 
@@ -286,8 +612,7 @@ def get_frequency_spectra(daq_location, sample_rate, num_samples, gpib_address,
     fourier_amplitude, fourier_frequency, phase, complex = fourier(wave, sample_rate, num_samples)
     print(fourier_amplitude)
 
-    waveform_generator.write(f"OUTPUT{channel} OFF")
-    waveform_generator.close()
+    wave_gen.turn_off(waveform_generator, channel) #the session stays open in the pool
 
     return fourier_amplitude, fourier_frequency
 
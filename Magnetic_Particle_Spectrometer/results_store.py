@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+
+import h5py
+import numpy as np
+
+#HDF5 results store. Every run (background, sample, sweep) is a group /run_NNNN in the results file, with the run
+#parameters as attributes. Data is written while it is produced: sweep steps and raw DAQ blocks are appended to
+#chunked, compressed datasets and the file is flushed after every write, so a crash only loses the step in flight.
+#Readers can slice single steps, harmonics or sample ranges without loading the rest of the file (read(),
+#read_harmonic()), export_mat() writes a run in the savemat layout of the App for MATLAB.
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), 'MPS_results')
+COMPRESSION = {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}
+RAW_CHUNK = 1 << 16 #samples per chunk along the record
+
+def daily_path(directory=DEFAULT_DIRECTORY):
+    #one results file per day
+    return os.path.join(directory, time.strftime('mps_results_%Y%m%d.h5'))
+
+def _as_array(value):
+    if value is None:
+        return np.array(np.nan)
+    return np.asarray(value)
+
+class RunWriter:
+    def __init__(self, file, group):
+        self.file = file
+        self.group = group
+        self.name = group.name
+        self.path = file.filename
+        self._lock = threading.Lock() #sweep steps are written from the sweep worker
+
+    def write(self, name, data):
+        #stores a whole array (spectra, reconstructions), replaces an existing dataset of that name
+        data = _as_array(data)
+        with self._lock:
+            if name in self.group:
+                del self.group[name]
+            if data.ndim == 0:
+                self.group.create_dataset(name, data=data)
+            else:
+                self.group.create_dataset(name, data=data, chunks=True, **COMPRESSION)
+            self.file.flush()
+
+    def append(self, name, block, chunk_rows=1):
+        #appends block along the first axis of a growing dataset (created by the first block). chunk_rows: rows per
+        #chunk of a 2D dataset (1 for raw records, more for many short rows like the lock-in outputs)
+        block = _as_array(block)
+        if block.ndim == 0:
+            block = block.reshape(1)
+        with self._lock:
+            dataset = self.group.get(name)
+            if dataset is None:
+                chunks = (chunk_rows,) + tuple(min(n, RAW_CHUNK) for n in block.shape[1:]) if block.ndim > 1 else (
+                    min(max(len(block), 64), RAW_CHUNK),)
+                dataset = self.group.create_dataset(name, shape=(0,) + block.shape[1:], dtype=block.dtype,
+                                                    maxshape=(None,) + block.shape[1:], chunks=chunks, **COMPRESSION)
+            start = dataset.shape[0]
+            dataset.resize(start + block.shape[0], axis=0)
+            dataset[start:] = block
+            self.file.flush()
+
+    def write_step(self, step, **values):
+        #row 'step' of every named per step dataset (steps can arrive out of order, missing rows are NaN)
+        with self._lock:
+            for name, value in values.items():
+                value = _as_array(value)
+                dataset = self.group.get(name)
+                if dataset is None:
+                    dtype = value.dtype if value.dtype.kind in 'fc' else np.float64
+                    dataset = self.group.create_dataset(name, shape=(0,) + value.shape, dtype=dtype,
+                                                        maxshape=(None,) + value.shape,
+                                                        chunks=(64,) + value.shape,
+                                                        fillvalue=np.array(np.nan, dtype=dtype), **COMPRESSION)
+                if dataset.shape[0] <= step:
+                    dataset.resize(step + 1, axis=0)
+                dataset[step] = value
+            self.group.attrs['steps_written'] = max(int(self.group.attrs.get('steps_written', 0)), step + 1)
+            self.file.flush()
+
+    def truncate(self, name, length):
+        #drops the rows from length on (e.g. raw records of a step that was not finished before a crash)
+        with self._lock:
+            dataset = self.group.get(name)
+            if dataset is not None and dataset.shape[0] > length:
+                dataset.resize(length, axis=0)
+                self.file.flush()
+
+    def set_attrs(self, **attrs):
+        with self._lock:
+            for key, value in attrs.items():
+                if value is not None:
+                    self.group.attrs[key] = value
+            self.file.flush()
+
+    def close(self, complete=True):
+        with self._lock:
+            self.group.attrs['complete'] = complete
+            self.group.attrs['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+            self.file.close()
+
+class ResultsStore:
+    def __init__(self, path=None, directory=DEFAULT_DIRECTORY):
+        self.fixed_path = path #None: one file per day in directory, picked when a run starts
+        self.directory = directory
+        self.path = path or daily_path(directory) #file of the last started or resumed run, used by the readers
+
+    def start_run(self, mode, parameters=None):
+        #opens the file and creates the next /run_NNNN group, write into it with the returned RunWriter
+        self.path = self.fixed_path or daily_path(self.directory) #a session past midnight goes on in the next file
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        file = h5py.File(self.path, 'a')
+        index = 1 + max([int(name[4:]) for name in file if name.startswith('run_')], default=0)
+        group = file.create_group(f'run_{index:04d}')
+        group.attrs['mode'] = mode or ''
+        group.attrs['started'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        group.attrs['complete'] = False
+        writer = RunWriter(file, group)
+        writer.set_attrs(**{key: value for key, value in (parameters or {}).items()
+                            if isinstance(value, (str, int, float, bool, np.number))})
+        #the parameters are taken before the run exists, its own file and name are added here
+        writer.set_attrs(results_file=self.path, results_run=writer.name)
+        return writer
+
+    def resume_run(self, run, path=None):
+        #reopens an existing run (of the file path) for writing (resumed sweep), None if the run is not in the file
+        if path is not None:
+            if not os.path.exists(path):
+                return None
+            self.path = path
+        file = h5py.File(self.path, 'a')
+        if run not in file:
+            file.close()
+            return None
+        group = file[run]
+        group.attrs['complete'] = False
+        group.attrs['resumed'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        return RunWriter(file, group)
+
+    def runs(self):
+        #[(run name, attributes)] of the runs in the file
+        with h5py.File(self.path, 'r') as file:
+            return [(name, dict(file[name].attrs)) for name in sorted(file) if name.startswith('run_')]
+
+    def read(self, run, name, index=()):
+        #partial read: only index (e.g. np.s_[10:20] or np.s_[3, :, :1000]) is loaded from the dataset
+        with h5py.File(self.path, 'r') as file:
+            return file[run][name][index]
+
+    def read_harmonic(self, run, order, steps=slice(None)):
+        #complex amplitude of one harmonic order over the (selected) sweep steps
+        with h5py.File(self.path, 'r') as file:
+            group = file[run]
+            column = int(np.flatnonzero(group['orders'][()] == order)[0])
+            return group['harmonics'][steps, column]
+
+    def export_mat(self, run, mat_path):
+        #writes the run in the layout of App.save_results (one variable per dataset, parameters as a struct)
+        from scipy.io import savemat
+        data = {}
+        with h5py.File(self.path, 'r') as file:
+            group = file[run]
+            for name, dataset in group.items():
+                data[name] = dataset[()]
+            parameters = {key: value for key, value in group.attrs.items()}
+        if 'harmonics' in data and 'orders' in data:
+            for column, order in enumerate(data['orders']):
+                data[f'harmonic_{int(order)}_magnitude'] = np.abs(data['harmonics'][:, column])
+                data[f'harmonic_{int(order)}_phase'] = np.angle(data['harmonics'][:, column])
+        data['parameters'] = {key.replace(' ', '_'): value for key, value in parameters.items()}
+        savemat(mat_path, data)
+
+    def copy_run(self, run, path, attrs=None):
+        #copies one run into another HDF5 file (e.g. to keep a single run next to its analysis)
+        run = run.strip('/')
+        with h5py.File(self.path, 'r') as source, h5py.File(path, 'a') as target:
+            name = run if run not in target else f'{run}_{time.strftime("%H%M%S")}'
+            source.copy(source[run], target, name=name)
+            target[name].attrs.update(attrs or {})
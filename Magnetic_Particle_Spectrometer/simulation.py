@@ -0,0 +1,366 @@
+import math
+import os
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+
+#Hardware free backend: fake nidaqmx and pyvisa modules that run on any machine.
+#   python MPS_app.py --simulate      (or MPS_SIMULATE=1)
+#install() has to run before receive_and_analyze / wave_gen / MPS_app are imported, they then run unchanged.
+#
+#The fake waveform generator and DC supply parse the SCPI the app sends and update a shared Bench. The fake DAQ
+#synthesizes from the Bench state: the pickup coil sees dM/dt of a Langevin particle model plus feedthrough of the
+#drive, a background (coil distortion, mains hum, offset) and white noise, the current channel sees the ACS712 output.
+#Triggered reads start on a drive period (sync rising edge) with sample clock jitter. Reads and instrument I/O take
+#a realistic time, scaled by time_scale (MPS_SIM_TIME_SCALE, 0 = as fast as possible).
+
+class Bench:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.time_scale = float(os.environ.get('MPS_SIM_TIME_SCALE', 1.0))
+        self.rng = np.random.default_rng()
+
+        # instrument state (written by the fake instruments)
+        self.generator = {} #channel -> {'voltage': Vpp, 'frequency': Hz, 'output': bool}
+        self.dc_current = 0.0 #A, only while the supply output is on
+        self.dc_output = False
+
+        # system constants (same as the App)
+        self.field_per_volt = 10.339 #mT per Vpp of the waveform generator (App.slope)
+        self.field_per_amp = 5.0093 #mT/A of the drive coil (App.coefficient, big MPS)
+        self.dc_field_per_amp = 1.0 #mT/A of the helmholtz coils
+        self.sensor_offset = 2.5 #V, ACS712 output at 0 A (Vcc/2)
+        self.sensor_sensitivity = 0.1 #V/A (20 A ACS712)
+
+        # particle model and pickup coil
+        self.sample_present = True
+        self.saturation_field = 2.0 #mT, Langevin field scale
+        self.magnetization_gain = 2e-6 #V per (normalized M per s)
+        self.feedthrough = 2e-7 #V per (mT/s) that the cancellation coil does not remove
+        self.distortion = 0.002 #3rd harmonic of the drive relative to the feedthrough
+        self.hum_amplitude = 1e-3 #V at hum_frequency
+        self.hum_frequency = 60.0
+        self.offset = 1e-3 #V
+        self.noise_rms = 5e-4 #V on the pickup coil
+        self.sensor_noise_rms = 2e-3 #V on the current sensor
+        self.trigger_jitter = 10e-9 #s rms, on top of the sample clock quantization
+
+        self.channel_roles = {'ai0': 'pickup', 'ai1': 'current'} #by channel suffix, other channels only see noise
+
+    def sleep(self, seconds):
+        if self.time_scale > 0 and seconds > 0:
+            time.sleep(seconds * self.time_scale)
+
+    def now(self):
+        return time.monotonic()
+
+    def drive(self):
+        #(peak field mT, frequency Hz) of all enabled generator channels (the drive coil sees their sum)
+        with self.lock:
+            enabled = [c for c in self.generator.values() if c.get('output') and c.get('frequency')]
+            dc_field = self.dc_field_per_amp * self.dc_current if self.dc_output else 0.0
+        return [(self.field_per_volt * c.get('voltage', 0.0), c['frequency']) for c in enabled], dc_field
+
+    def trigger_time(self, after, sample_rate):
+        #next rising edge of the sync output after 'after', with jitter
+        _, frequency = (self.drive()[0] or [(0, None)])[0]
+        if frequency is None:
+            return after #no sync signal: the real DAQ would time out, start right away instead
+        start = math.ceil(after * frequency) / frequency
+        return start + self.rng.uniform(0, 1 / sample_rate) + self.rng.normal(0, self.trigger_jitter)
+
+    def synthesize(self, channels, t):
+        #(len(channels), len(t)) voltages at the absolute times t
+        drives, dc_field = self.drive()
+        field = np.full(len(t), dc_field)
+        field_rate = np.zeros(len(t))
+        distortion = np.zeros(len(t))
+        for peak, frequency in drives:
+            omega = 2 * np.pi * frequency
+            field += peak * np.sin(omega * t)
+            field_rate += peak * omega * np.cos(omega * t)
+            distortion += peak * omega * np.cos(3 * omega * t + 0.3)
+
+        out = np.empty((len(channels), len(t)))
+        for i, channel in enumerate(channels):
+            role = self.channel_roles.get(channel.split('/')[-1].lower())
+            if role == 'pickup':
+                voltage = self.feedthrough * (field_rate + self.distortion * distortion)
+                if self.sample_present: #pickup polarity such that the integrated signal is +M (as the App plots it)
+                    x = field / self.saturation_field
+                    voltage += self.magnetization_gain * _langevin_slope(x) * field_rate / self.saturation_field
+                voltage += self.hum_amplitude * np.sin(2 * np.pi * self.hum_frequency * t) + self.offset
+                voltage += self.rng.normal(0, self.noise_rms, len(t))
+            elif role == 'current':
+                current = (field - dc_field) / self.field_per_amp #the sensor is in the drive coil circuit
+                voltage = self.sensor_offset + self.sensor_sensitivity * current
+                voltage += self.rng.normal(0, self.sensor_noise_rms, len(t))
+            else:
+                voltage = self.rng.normal(0, self.noise_rms, len(t))
+            out[i] = voltage
+        return out
+
+def _langevin_slope(x):
+    #dL/dx of the Langevin function L(x) = coth(x) - 1/x (1/3 at x = 0)
+    x = np.asarray(x, dtype=float)
+    small = np.abs(x) < 1e-3
+    safe = np.where(small, 1.0, x)
+    slope = 1 / safe ** 2 - 1 / np.sinh(safe) ** 2
+    return np.where(small, 1 / 3 - x ** 2 / 15, slope)
+
+bench = Bench()
+
+################################################################################################################################################
+#Fake nidaqmx:
+
+class DaqError(Exception):
+    pass
+
+class AcquisitionType:
+    FINITE = 'finite'
+    CONTINUOUS = 'continuous'
+
+class Edge:
+    RISING = 'rising'
+    FALLING = 'falling'
+
+class _Channels:
+    def __init__(self):
+        self.names = []
+
+    def add_ai_voltage_chan(self, physical_channel, *args, **kwargs):
+        self.names.extend(name.strip() for name in physical_channel.split(','))
+
+class _StartTrigger:
+    def __init__(self):
+        self.source = None
+
+    def cfg_dig_edge_start_trig(self, trigger_source, trigger_edge=Edge.RISING):
+        self.source = trigger_source
+
+class _Triggers:
+    def __init__(self):
+        self.start_trigger = _StartTrigger()
+
+class _Timing:
+    def __init__(self):
+        self.rate = None
+        self.mode = AcquisitionType.FINITE
+        self.samps_per_chan = 1000
+
+    def cfg_samp_clk_timing(self, rate, source='', active_edge=Edge.RISING, sample_mode=AcquisitionType.FINITE,
+                            samps_per_chan=1000):
+        self.rate = float(rate)
+        self.mode = sample_mode
+        self.samps_per_chan = int(samps_per_chan)
+
+class Task:
+    def __init__(self, new_task_name=''):
+        self.ai_channels = _Channels()
+        self.triggers = _Triggers()
+        self.timing = _Timing()
+        self.in_stream = self
+        self._running = False
+        self._next_time = None #start time of the next sample
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        if self._closed:
+            raise DaqError("Task has been closed")
+        if self.timing.rate is None:
+            raise DaqError("Sample clock timing is not configured")
+        self._running = True
+        now = bench.now()
+        if self.triggers.start_trigger.source is not None:
+            self._next_time = bench.trigger_time(now, self.timing.rate)
+        else:
+            self._next_time = now
+
+    def stop(self):
+        self._running = False
+
+    def close(self):
+        self._running = False
+        self._closed = True
+
+    def read_into(self, data, n):
+        #fills data (channels x n) with the next n samples of the running acquisition
+        auto_started = not self._running
+        if auto_started:
+            self.start()
+        if self.timing.mode == AcquisitionType.FINITE and n > self.timing.samps_per_chan:
+            raise DaqError("Requested more samples than the finite acquisition holds")
+        rate = self.timing.rate
+        t = self._next_time + np.arange(n) / rate
+        self._next_time = t[-1] + 1 / rate
+        bench.sleep(self._next_time - bench.now()) #samples arrive in real time
+        data[:, :n] = bench.synthesize(self.ai_channels.names, t)
+        if auto_started or self.timing.mode == AcquisitionType.FINITE:
+            self._running = self.timing.mode == AcquisitionType.CONTINUOUS and not auto_started
+
+    def read(self, number_of_samples_per_channel=1, timeout=10.0):
+        n = int(number_of_samples_per_channel)
+        data = np.empty((len(self.ai_channels.names), n))
+        self.read_into(data, n)
+        if len(self.ai_channels.names) == 1:
+            return data[0].tolist()
+        return data.tolist()
+
+class AnalogMultiChannelReader:
+    def __init__(self, task_in_stream):
+        self._task = task_in_stream
+
+    def read_many_sample(self, data, number_of_samples_per_channel=1, timeout=10.0):
+        self._task.read_into(data, int(number_of_samples_per_channel))
+        return int(number_of_samples_per_channel)
+
+################################################################################################################################################
+#Fake pyvisa:
+
+class VisaError(Exception):
+    pass
+
+class _Instrument:
+    write_latency = 1e-3 #s per write (GPIB)
+    char_time = 1e-5 #s per character
+
+    def __init__(self, resource_name):
+        self.resource_name = resource_name
+        self._open = True
+        self._reply = ''
+        self.timeout = 2000
+
+    @property
+    def session(self):
+        if not self._open:
+            raise VisaError("Invalid session")
+        return 1
+
+    def _io(self, message):
+        if not self._open:
+            raise VisaError("Invalid session")
+        bench.sleep(self.write_latency + self.char_time * (len(message) + 1))
+
+    def write(self, message):
+        self._io(message)
+        for command in message.split(';'):
+            command = command.strip().lstrip(':').upper()
+            if command:
+                self._reply = self.handle(command)
+        return len(message)
+
+    def read(self):
+        self._io(self._reply)
+        return self._reply
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    def handle(self, command):
+        if command == '*OPC?':
+            return '1'
+        if command == '*IDN?':
+            return f"Simulated,{type(self).__name__},0,1.0"
+        return ''
+
+    def close(self):
+        self._open = False
+
+class SimulatedKeysight33500B(_Instrument):
+    def handle(self, command):
+        header, _, argument = command.partition(' ')
+        argument = argument.replace('VPP', '').replace('HZ', '').strip()
+        with bench.lock:
+            if header.startswith('SOURCE') and header.endswith(':VOLTAGE'):
+                channel = header[len('SOURCE'):-len(':VOLTAGE')] or '1'
+                bench.generator.setdefault(channel, {})['voltage'] = float(argument)
+            elif header.startswith('SOURCE') and header.endswith(':FREQUENCY'):
+                channel = header[len('SOURCE'):-len(':FREQUENCY')] or '1'
+                bench.generator.setdefault(channel, {})['frequency'] = float(argument)
+            elif header.startswith('OUTPUT') and ':' not in header:
+                channel = header[len('OUTPUT'):] or '1'
+                bench.generator.setdefault(channel, {})['output'] = argument == 'ON'
+        return super().handle(command)
+
+class SimulatedPFR100L(_Instrument):
+    write_latency = 2e-3
+    char_time = 10 / 9600 #9600 baud, 10 bits per character
+
+    def __init__(self, resource_name):
+        super().__init__(resource_name)
+        self.baud_rate = 9600
+        self.data_bits = 8
+        self._current = 0.0
+
+    def handle(self, command):
+        header, _, argument = command.partition(' ')
+        with bench.lock:
+            if header == 'SOURCE:CURRENT:LEVEL':
+                self._current = float(argument)
+            elif header == 'OUTPUT:STATE':
+                bench.dc_output = argument.strip() == 'ON'
+            if bench.dc_output:
+                bench.dc_current = self._current
+            else:
+                bench.dc_current = 0.0
+        return super().handle(command)
+
+class ResourceManager:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def list_resources(self, query='?*::INSTR'):
+        return ('GPIB0::10::INSTR', 'ASRL5::INSTR')
+
+    def open_resource(self, resource_name, **kwargs):
+        if resource_name.upper().startswith('GPIB'):
+            return SimulatedKeysight33500B(resource_name)
+        if resource_name.upper().startswith('ASRL'):
+            return SimulatedPFR100L(resource_name)
+        raise VisaError(f"Resource not found: {resource_name}")
+
+    def close(self):
+        pass
+
+################################################################################################################################################
+#Installation:
+
+def install():
+    #replaces nidaqmx and pyvisa in sys.modules with the simulated backend
+    nidaqmx = types.ModuleType('nidaqmx')
+    nidaqmx.Task = Task
+    nidaqmx.DaqError = DaqError
+    constants = types.ModuleType('nidaqmx.constants')
+    constants.AcquisitionType = AcquisitionType
+    constants.Edge = Edge
+    stream_readers = types.ModuleType('nidaqmx.stream_readers')
+    stream_readers.AnalogMultiChannelReader = AnalogMultiChannelReader
+    nidaqmx.constants = constants
+    nidaqmx.stream_readers = stream_readers
+
+    pyvisa = types.ModuleType('pyvisa')
+    pyvisa.ResourceManager = ResourceManager
+    pyvisa.Error = VisaError
+    pyvisa.VisaIOError = VisaError
+
+    sys.modules.update({'nidaqmx': nidaqmx, 'nidaqmx.constants': constants,
+                        'nidaqmx.stream_readers': stream_readers, 'pyvisa': pyvisa})
+    print("MPS simulation backend active (no hardware is used)")
+    return bench
+
+def install_if_requested(argv=None):
+    argv = sys.argv if argv is None else argv
+    if '--simulate' in argv or os.environ.get('MPS_SIMULATE', '') not in ('', '0'):
+        install()
+        return True
+    return False
@@ -0,0 +1,30 @@
+import importlib
+import threading
+import time
+
+#Startup of the App: the window has to be usable right away. The hardware libraries (nidaqmx, pyvisa's VISA library
+#and the resource scan) and the heavy analysis modules are therefore not loaded at import, warm_up() loads them on a
+#background thread once the window is up, and time_to_interactive() is measured from the import of this module
+#(the first import of MPS_app).
+
+started = time.perf_counter()
+
+#imported in the background after the window is shown (the first acquisition would otherwise pay for them)
+WARM_UP_MODULES = ['nidaqmx', 'nidaqmx.stream_readers', 'scipy.signal', 'scipy.io']
+
+def time_to_interactive():
+    return time.perf_counter() - started
+
+def warm_up(modules=WARM_UP_MODULES, discover=None):
+    #imports modules and then runs discover() (hardware discovery) on a daemon thread
+    def run():
+        for name in modules:
+            try:
+                importlib.import_module(name)
+            except ImportError as e:
+                print(f"Warm up skipped {name}: {e}")
+        if discover is not None:
+            discover()
+    thread = threading.Thread(target=run, daemon=True, name='warm up')
+    thread.start()
+    return thread
@@ -0,0 +1,47 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+#Pipelined sweep: while the worker analyzes and stores step n, the main loop already sets the instruments for step
+#n+1 and acquires it. A sweep is a list of setpoints plus three callbacks:
+#   apply(step, setpoint)            -> sets the instruments (runs in the calling thread)
+#   acquire(step, setpoint)          -> returns the raw records (must not be reused by the next acquisition)
+#   process(step, setpoint, records) -> analysis and storage of one step (runs on the worker)
+
+class SweepEngine:
+    def __init__(self, apply, acquire, process, max_pending=2):
+        self.apply = apply
+        self.acquire = acquire
+        self.process = process
+        self.max_pending = max_pending #steps waiting for analysis before acquisition waits (bounds memory)
+
+    def run(self, setpoints, start=0):
+        #start: first step to run (resuming a sweep, steps keep their index in setpoints)
+        pending = deque()
+        stopped = threading.Event() #set on the first error, the steps already on the worker are then skipped
+        def process(step, setpoint, records):
+            if stopped.is_set():
+                return
+            try:
+                self.process(step, setpoint, records)
+            except BaseException:
+                stopped.set()
+                raise
+
+        with ThreadPoolExecutor(max_workers=1) as worker: #one worker keeps the steps stored in order
+            try:
+                for step in range(start, len(setpoints)):
+                    setpoint = setpoints[step]
+                    self.apply(step, setpoint)
+                    records = self.acquire(step, setpoint)
+                    pending.append(worker.submit(process, step, setpoint, records))
+
+                    while pending and (len(pending) > self.max_pending or pending[0].done()):
+                        pending.popleft().result() #re-raises an analysis error and stops the sweep
+                while pending:
+                    pending.popleft().result()
+            except BaseException:
+                stopped.set() #steps after a failed one are not stored, not even the one the worker picks up next
+                for future in pending:
+                    future.cancel()
+                raise
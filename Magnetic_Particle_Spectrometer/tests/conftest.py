@@ -0,0 +1,11 @@
+import os
+import sys
+
+#the tests run on the simulated backend (no NI-DAQmx or VISA needed) and without the simulated acquisition delays,
+#install() has to run before receive_and_analyze / wave_gen are imported
+os.environ.setdefault('MPS_SIM_TIME_SCALE', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simulation
+
+simulation.install()
@@ -0,0 +1,88 @@
+import threading
+import time
+
+import pytest
+
+import acquisition_worker
+
+def wait_until(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+def drain(worker, events, count, timeout=5.0):
+    #Tk side: dispatch() until count callbacks ran
+    wait_until(lambda: worker.dispatch() or len(events) >= count, timeout)
+
+def test_jobs_run_in_order_and_callbacks_run_on_the_dispatching_thread():
+    events = []
+    worker = acquisition_worker.AcquisitionWorker(on_progress=lambda job: events.append(('progress', job.name,
+                                                                                          job.fraction, job.message)))
+    def work(name):
+        def run(job):
+            assert threading.current_thread() is not threading.main_thread()
+            job.progress(0.5, 'half')
+            return name.upper()
+        return run
+    def done(result):
+        assert threading.current_thread() is threading.main_thread()
+        events.append(('done', result))
+
+    worker.submit('a', work('a'), done)
+    worker.submit('b', work('b'), done)
+    drain(worker, events, 4)
+    assert events == [('progress', 'a', 0.5, 'half'), ('done', 'A'), ('progress', 'b', 0.5, 'half'), ('done', 'B')]
+    wait_until(lambda: not worker.busy)
+
+def test_nothing_runs_on_the_tk_side_before_dispatch():
+    events = []
+    worker = acquisition_worker.AcquisitionWorker()
+    worker.submit('a', lambda job: 1, events.append)
+    wait_until(lambda: not worker.busy)
+    assert events == []
+    worker.dispatch()
+    assert events == [1]
+
+def test_failure_is_reported_and_the_next_job_runs(capsys):
+    events = []
+    worker = acquisition_worker.AcquisitionWorker()
+    def fail(job):
+        raise OSError("GPIB timeout")
+    worker.submit('broken', fail, failed=lambda job, error: events.append((job.name, error)))
+    worker.submit('next', lambda job: 'ok', events.append)
+    drain(worker, events, 2)
+    assert isinstance(events[0][1], OSError) and events[0][0] == 'broken'
+    assert events[1] == 'ok'
+    assert 'GPIB timeout' in capsys.readouterr().err #traceback printed for unexpected errors
+
+def test_cancel_stops_the_running_job_and_the_queued_ones():
+    events = []
+    worker = acquisition_worker.AcquisitionWorker()
+    started = threading.Event()
+    def long_job(job):
+        started.set()
+        while True:
+            job.progress(0.1) #cancel point
+            time.sleep(0.001)
+    def failed(job, error):
+        events.append((job.name, type(error)))
+    worker.submit('sweep', long_job, failed=failed)
+    worker.submit('queued', lambda job: events.append('ran'), failed=failed)
+    assert started.wait(5)
+    assert worker.cancel() == 2
+    drain(worker, events, 2)
+    assert events == [('sweep', acquisition_worker.JobCancelled), ('queued', acquisition_worker.JobCancelled)]
+
+    worker.submit('after', lambda job: 'ok', events.append) #the worker keeps running
+    drain(worker, events, 3)
+    assert events[-1] == 'ok'
+
+def test_check_cancelled():
+    job = acquisition_worker.Job('a', lambda job: None)
+    job.check_cancelled()
+    job.cancel()
+    assert job.cancelled
+    with pytest.raises(acquisition_worker.JobCancelled):
+        job.check_cancelled()
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pytest
+
+import background_library
+
+#settings of the measured backgrounds: frequency, ac amplitude, sample rate, num_periods
+SETTINGS = (1000.0, 2.0, 100000.0, 10)
+
+def background(dc_current, num_bins=8):
+    return (1 + dc_current) * np.exp(1j * np.arange(num_bins))
+
+def test_get_exact_settings(tmp_path):
+    library = background_library.BackgroundLibrary(str(tmp_path))
+    library.store(1000.0, 2.0, 1.0, 100000.0, 10, background(1.0))
+    np.testing.assert_array_equal(library.get(1000.0, 2.0, 1.0, 100000.0, 10), background(1.0))
+    assert library.get(1000.0, 2.0, 1.5, 100000.0, 10) is None
+    assert library.get(2000.0, 2.0, 1.0, 100000.0, 10) is None
+
+def test_interpolate_dc(tmp_path):
+    library = background_library.BackgroundLibrary(str(tmp_path))
+    frequency, amplitude, sample_rate, num_periods = SETTINGS
+    for dc_current in (0.0, 2.0, 4.0):
+        library.store(frequency, amplitude, dc_current, sample_rate, num_periods, background(dc_current))
+    library.store(frequency, 3.0, 1.0, sample_rate, num_periods, background(10.0)) #other amplitude, not used
+
+    np.testing.assert_allclose(library.interpolate_dc(frequency, amplitude, 1.0, sample_rate, num_periods),
+                               background(1.0))
+    np.testing.assert_allclose(library.interpolate_dc(frequency, amplitude, 3.5, sample_rate, num_periods),
+                               background(3.5))
+    np.testing.assert_array_equal(library.interpolate_dc(frequency, amplitude, 2.0, sample_rate, num_periods),
+                                  background(2.0))
+    assert library.interpolate_dc(frequency, amplitude, -1.0, sample_rate, num_periods) is None #no extrapolation
+    assert library.interpolate_dc(frequency, amplitude, 5.0, sample_rate, num_periods) is None
+    assert library.dc_currents(frequency, amplitude, sample_rate, num_periods) == [0.0, 2.0, 4.0]
+
+def test_stale_backgrounds_are_evicted(tmp_path, monkeypatch):
+    library = background_library.BackgroundLibrary(str(tmp_path), max_age=60.0)
+    now = 1000000.0
+    monkeypatch.setattr(background_library.time, 'time', lambda: now)
+    library.store(1000.0, 2.0, 0.0, 100000.0, 10, background(0.0))
+    now += 30.0
+    library.store(1000.0, 2.0, 1.0, 100000.0, 10, background(1.0))
+    now += 40.0 #the first one is 70 s old
+    assert library.dc_currents(1000.0, 2.0, 100000.0, 10) == [1.0]
+    assert library.get(1000.0, 2.0, 0.0, 100000.0, 10) is None
+    assert len(os.listdir(tmp_path)) == 1 #its file is removed too
+
+def test_backgrounds_survive_a_restart_without_pickle(tmp_path):
+    background_library.BackgroundLibrary(str(tmp_path)).store(1000.0, None, 0.5, 100000.0, 10, background(0.5))
+    (path,) = tmp_path.iterdir()
+    with np.load(path, allow_pickle=False) as data: #plain numeric fields only
+        assert {key: data[key].dtype.kind for key in data.files} == {
+            'frequency': 'f', 'amplitude': 'f', 'dc_current': 'f', 'sample_rate': 'f', 'num_periods': 'i',
+            'measured': 'f', 'background': 'c'}
+
+    restarted = background_library.BackgroundLibrary(str(tmp_path))
+    np.testing.assert_array_equal(restarted.get(1000.0, None, 0.5, 100000.0, 10), background(0.5))
+    assert restarted.get(1000.0, 0.0, 0.5, 100000.0, 10) is None #amplitude None stays distinct
+
+def test_pickled_files_are_skipped(tmp_path):
+    np.savez(tmp_path / 'bg_0123456789abcdef.npz', key=np.array((1000.0, None, 0.0, 100000.0, 10), dtype=object),
+             measured=1e12, background=background(0.0))
+    library = background_library.BackgroundLibrary(str(tmp_path))
+    assert library.dc_currents(1000.0, None, 100000.0, 10) == []
+
+@pytest.mark.parametrize('directory', [None, ''])
+def test_memory_only(directory):
+    library = background_library.BackgroundLibrary(directory)
+    library.store(1000.0, 2.0, 0.0, 100000.0, 10, background(0.0))
+    np.testing.assert_array_equal(library.get(1000.0, 2.0, 0.0, 100000.0, 10), background(0.0))
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+
+import checkpoint
+
+SETPOINTS = [0.0, 0.5, None, 1.5]
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'checkpoints' / 'sweep.npz')
+
+def new_sweep(path):
+    return checkpoint.SweepCheckpoint('auto mode static dc', {'frequency': 1000.0, 'num_periods': np.int64(10)},
+                                      SETPOINTS, {'background': np.arange(3) * 1j, 'missing': None}, path)
+
+def test_save_and_load(path):
+    state = new_sweep(path)
+    state.step_done(0, {'ac_voltage': 0.0}, harmonics=np.array([1j, 2j]), i_rms=1.0)
+    state.step_done(1, {'ac_voltage': 0.5}, harmonics=np.array([3j, 4j]), i_rms=None)
+
+    loaded = checkpoint.SweepCheckpoint.load(path)
+    assert loaded.mode == 'auto mode static dc' and loaded.started == state.started
+    assert loaded.parameters == {'frequency': 1000.0, 'num_periods': 10}
+    assert loaded.setpoints == SETPOINTS
+    assert loaded.completed == 2 and not loaded.finished
+    assert loaded.instrument == {'ac_voltage': 0.5}
+    assert list(loaded.arrays) == ['background']
+    np.testing.assert_array_equal(loaded.arrays['background'], np.arange(3) * 1j)
+    np.testing.assert_array_equal(loaded.data['harmonics'][:2], [[1j, 2j], [3j, 4j]])
+    assert np.all(np.isnan(loaded.data['harmonics'][2:]))
+    assert loaded.data['i_rms'][0] == 1.0 and np.isnan(loaded.data['i_rms'][1])
+    assert "2 of 4 steps" in loaded.describe()
+
+def test_a_step_after_a_gap_is_redone(path):
+    state = new_sweep(path)
+    state.step_done(0, {'ac_voltage': 0.0}, i_rms=1.0)
+    state.step_done(2, {'ac_voltage': 1.0}, i_rms=3.0) #step 1 failed, step 2 was already processed
+    assert state.completed == 1 and state.instrument == {'ac_voltage': 0.0}
+    loaded = checkpoint.SweepCheckpoint.load(path)
+    assert loaded.completed == 1 and np.isnan(loaded.data['i_rms'][2]) #only saved on the next gapless step
+
+    state.step_done(1, {'ac_voltage': 0.5}, i_rms=2.0)
+    assert state.completed == 2
+    state.step_done(2, {'ac_voltage': 1.0}, i_rms=3.0)
+    state.step_done(3, {'ac_voltage': 1.5}, i_rms=4.0)
+    loaded = checkpoint.SweepCheckpoint.load(path)
+    assert loaded.finished
+    np.testing.assert_array_equal(loaded.data['i_rms'], [1.0, 2.0, 3.0, 4.0])
+
+def test_a_crash_while_writing_keeps_the_previous_checkpoint(path, monkeypatch):
+    state = new_sweep(path)
+    state.step_done(0, {'ac_voltage': 0.0}, i_rms=1.0)
+
+    def crash(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(checkpoint.os, 'replace', crash)
+    with pytest.raises(OSError):
+        state.step_done(1, {'ac_voltage': 0.5}, i_rms=2.0)
+    assert checkpoint.SweepCheckpoint.load(path).completed == 1
+
+def test_missing_and_unreadable(path):
+    assert checkpoint.SweepCheckpoint.load(path) is None
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as file:
+        file.write(b'not a checkpoint')
+    assert checkpoint.SweepCheckpoint.load(path) is None
+
+def test_clear(path):
+    state = new_sweep(path)
+    state.save()
+    state.clear()
+    state.clear() #no file any more
+    assert checkpoint.SweepCheckpoint.load(path) is None
@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+import pyvisa
+
+import coherent_average
+import daq_session
+import simulation
+
+@pytest.fixture
+def bench(monkeypatch):
+    #1 kHz drive, no noise and no hum: the frames differ only by the trigger quantization
+    bench = simulation.bench
+    monkeypatch.setattr(bench, 'generator', {})
+    monkeypatch.setattr(bench, 'dc_output', False)
+    monkeypatch.setattr(bench, 'noise_rms', 0.0)
+    monkeypatch.setattr(bench, 'sensor_noise_rms', 0.0)
+    monkeypatch.setattr(bench, 'trigger_jitter', 0.0)
+    monkeypatch.setattr(bench, 'hum_amplitude', 0.0)
+    generator = pyvisa.ResourceManager().open_resource('GPIB0::10::INSTR')
+    generator.write('SOURCE1:FREQUENCY 1000;SOURCE1:VOLTAGE 2;OUTPUT1 ON')
+    return bench
+
+def test_welford_matches_numpy():
+    frames = np.random.default_rng(1).normal(3.0, 0.5, size=(50, 2, 400))
+    average = coherent_average.FrameAverage(len(frames))
+    done = [average.add(frame) for frame in frames]
+    assert done == [False] * 49 + [True]
+    np.testing.assert_allclose(average.mean, frames.mean(axis=0), rtol=1e-12)
+    np.testing.assert_allclose(average.variance, frames.var(axis=0, ddof=1), rtol=1e-10)
+    np.testing.assert_allclose(average.standard_error, frames.std(axis=0, ddof=1) / np.sqrt(50), rtol=1e-10)
+    assert average.progress == 1.0 and average.describe() == "frame 50 of 50"
+
+def test_variance_needs_two_frames():
+    average = coherent_average.FrameAverage(3)
+    average.add(np.ones(8))
+    assert np.all(np.isnan(average.variance))
+
+def test_spectrum_error_of_white_noise():
+    #the standard error of a fourier() coefficient against the scatter of the coefficients over many averages
+    rng = np.random.default_rng(2)
+    num_frames, num_samples, sigma = 16, 256, 1.0
+    coefficients, errors = [], []
+    for _ in range(400):
+        average = coherent_average.FrameAverage(num_frames)
+        for frame in rng.normal(0.0, sigma, size=(num_frames, 1, num_samples)):
+            average.add(frame)
+        coefficients.append(np.fft.fft(average.mean[0])[10] / num_samples)
+        errors.append(average.spectrum_error()[0])
+    expected = sigma / np.sqrt(num_frames * num_samples)
+    np.testing.assert_allclose(np.mean(errors), expected, rtol=0.02)
+    np.testing.assert_allclose(np.sqrt(np.mean(np.abs(coefficients) ** 2)), expected, rtol=0.1)
+
+def test_on_frame_sees_every_frame():
+    counts = []
+    average = coherent_average.FrameAverage(4, on_frame=lambda average: counts.append(average.count))
+    for _ in range(4):
+        average.add(np.zeros(8))
+    assert counts == [1, 2, 3, 4]
+
+def test_retriggered_frames_average_to_one_frame(bench):
+    channels, sample_rate, n_samps = ['Dev1/ai0', 'Dev1/ai1'], 100000, 500
+    single = daq_session.sessions.read(channels, sample_rate, n_samps, 'Dev1/PFI0')
+    average = coherent_average.FrameAverage(5)
+    mean = coherent_average.acquire(channels, sample_rate, n_samps, 'Dev1/PFI0', average)
+    assert average.count == 5 and mean.shape == (2, n_samps)
+    #the frames start on the sync edge within one sample clock period, so the fundamental is not washed out
+    ratio = np.fft.rfft(mean)[:, 5] / np.fft.rfft(single)[:, 5]
+    np.testing.assert_allclose(np.abs(ratio), 1.0, rtol=1e-2)
+    assert np.max(np.abs(np.angle(ratio))) <= 2 * np.pi * 1000 / sample_rate
+
+def test_continuous_frames_of_whole_periods(bench):
+    average = coherent_average.FrameAverage(6, continuous=True)
+    mean = coherent_average.acquire(['Dev1/ai0'], 100000, 500, None, average, frequency=1000.0)
+    assert average.count == 6 and mean.shape == (1, 500)
+    assert np.max(average.standard_error) < 1e-9
+
+def test_continuous_refuses_partial_periods(bench):
+    average = coherent_average.FrameAverage(6, continuous=True)
+    with pytest.raises(ValueError):
+        coherent_average.acquire(['Dev1/ai0'], 100000, 450, None, average, frequency=1000.0)
+    with pytest.raises(ValueError): #without a frequency the phase of the frames is unknown
+        coherent_average.acquire(['Dev1/ai0'], 100000, 500, None, average)
+    assert average.count == 0
+
+def test_read_frames_stops_when_on_frame_returns_true(bench):
+    frames = []
+    def on_frame(buffer):
+        frames.append(buffer.copy())
+        return len(frames) == 3
+    daq_session.sessions.read_frames(['Dev1/ai0'], 100000, 500, 10, on_frame)
+    assert len(frames) == 3
+    np.testing.assert_allclose(frames[1], frames[0], atol=1e-9) #back to back frames of whole periods
+
+def harmonic_frame(rng, amplitude, num_samples=1000, sample_rate=100000, frequency=1000.0, noise=1.0):
+    #one channel: odd harmonics 3, 5, 7 of equal amplitude in white noise
+    t = np.arange(num_samples) / sample_rate
+    signal = sum(amplitude * np.cos(2 * np.pi * k * frequency * t) for k in (3, 5, 7))
+    return (signal + rng.normal(0.0, noise, num_samples))[np.newaxis]
+
+def test_adaptive_stops_at_the_target_snr():
+    rng = np.random.default_rng(3)
+    average = coherent_average.AdaptiveAverage(20, 60.0, 100000, 1000.0, max_frames=1000)
+    while not average.add(harmonic_frame(rng, 0.5)):
+        pass
+    assert np.all(average.snr >= 20) and average.count < 1000
+    assert average.progress == 1.0
+    #a weaker signal needs more frames for the same target
+    weak = coherent_average.AdaptiveAverage(20, 60.0, 100000, 1000.0, max_frames=1000)
+    while not weak.add(harmonic_frame(rng, 0.1)):
+        pass
+    assert weak.count > average.count and np.all(weak.snr >= 20)
+
+def test_adaptive_stops_at_the_time_budget(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(coherent_average.time, 'perf_counter', lambda: clock[0])
+    rng = np.random.default_rng(4)
+    average = coherent_average.AdaptiveAverage(1e6, 2.0, 100000, 1000.0)
+    assert not average.add(harmonic_frame(rng, 0.1))
+    clock[0] += 1.0
+    assert not average.add(harmonic_frame(rng, 0.1))
+    assert average.progress == pytest.approx(0.5)
+    clock[0] += 1.0
+    assert average.add(harmonic_frame(rng, 0.1))
+    assert average.count == 3 and average.min_snr < 1e6
+
+def test_adaptive_stops_at_max_frames():
+    rng = np.random.default_rng(5)
+    average = coherent_average.AdaptiveAverage(1e6, 60.0, 100000, 1000.0, max_frames=4)
+    assert [average.add(harmonic_frame(rng, 0.0)) for _ in range(4)] == [False, False, False, True]
+
+def test_adaptive_snr_is_background_subtracted():
+    rng = np.random.default_rng(6)
+    frame = harmonic_frame(rng, 0.5, noise=0.01)
+    background = np.fft.rfft(harmonic_frame(rng, 0.5, noise=0.0)[0]) / 1000 #the harmonics are all background
+    plain = coherent_average.AdaptiveAverage(20, 60.0, 100000, 1000.0)
+    subtracted = coherent_average.AdaptiveAverage(20, 60.0, 100000, 1000.0, background=background)
+    assert plain.add(frame)
+    assert not subtracted.add(frame)
+    assert np.all(subtracted.snr < 5)
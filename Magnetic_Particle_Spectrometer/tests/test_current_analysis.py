@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+import current_analysis
+
+SAMPLE_RATE = 100000.0
+F_DRIVE = 1000.0
+
+def sensor_voltage(sensor, num_samples=10000, amplitude=3.0, phase=0.4, dc=0.5):
+    t = np.arange(num_samples) / SAMPLE_RATE
+    current = dc + amplitude * np.cos(2 * np.pi * F_DRIVE * t + phase)
+    return current, sensor.zero_offset + sensor.sensitivity * current
+
+def test_stats_of_a_record():
+    sensor = current_analysis.CurrentSensor(0.1)
+    current, voltage = sensor_voltage(sensor)
+    stats = current_analysis.analyze_current(voltage, SAMPLE_RATE, F_DRIVE, sensor)
+    assert stats.num_samples == len(current)
+    assert stats.rms == pytest.approx(np.sqrt(np.mean(current ** 2)), rel=1e-12)
+    assert stats.dc == pytest.approx(0.5, abs=1e-12)
+    assert stats.peak == pytest.approx(np.max(np.abs(current)), rel=1e-12)
+    assert stats.ac_rms == pytest.approx(3.0 / np.sqrt(2), rel=1e-12)
+    assert stats.amplitude == pytest.approx(3.0, rel=1e-12)
+    assert stats.phase == pytest.approx(0.4, abs=1e-12)
+
+def test_blocks_give_the_same_result_as_the_whole_record(monkeypatch):
+    monkeypatch.setattr(current_analysis, '_CHUNK', 1000) #several vectorized steps per block
+    sensor = current_analysis.CurrentSensor(0.185)
+    _, voltage = sensor_voltage(sensor, num_samples=25000)
+    whole = current_analysis.analyze_current(voltage, SAMPLE_RATE, F_DRIVE, sensor)
+    accumulator = current_analysis.CurrentAccumulator(SAMPLE_RATE, F_DRIVE, sensor)
+    for start in range(0, len(voltage), 3333):
+        accumulator.add(voltage[start:start + 3333])
+    blocks = accumulator.result()
+    assert blocks.num_samples == whole.num_samples
+    for name in ('rms', 'dc', 'peak'):
+        assert getattr(blocks, name) == pytest.approx(getattr(whole, name), rel=1e-12)
+    assert blocks.fundamental == pytest.approx(whole.fundamental, rel=1e-9)
+
+def test_without_drive_frequency():
+    sensor = current_analysis.CurrentSensor(0.1)
+    _, voltage = sensor_voltage(sensor)
+    stats = current_analysis.analyze_current(voltage, sensor=sensor)
+    assert stats.fundamental is None and stats.amplitude is None and stats.phase is None
+    with pytest.raises(ValueError):
+        current_analysis.CurrentAccumulator(f_drive=F_DRIVE)
+
+def test_empty_and_reset():
+    accumulator = current_analysis.CurrentAccumulator(SAMPLE_RATE, F_DRIVE, current_analysis.CurrentSensor(0.1))
+    assert accumulator.result().rms == 0.0 and accumulator.result().fundamental == 0j
+    accumulator.add(np.full(100, 3.0))
+    accumulator.reset()
+    assert accumulator.num_samples == 0
+
+def test_zero_calibration_and_gain():
+    sensor = current_analysis.CurrentSensor(0.1, gain=1.02)
+    assert sensor.calibrate_zero(np.full(1000, 2.47)) == pytest.approx(2.47)
+    np.testing.assert_allclose(sensor.to_current([2.47, 2.572]), [0.0, 1.0])
+
+def test_named_sensors_are_shared():
+    assert current_analysis.get_sensor() is current_analysis.get_sensor(current_analysis.DEFAULT_SENSOR)
+    assert current_analysis.get_sensor('ACS712-5A').sensitivity == 0.185
+    sensor = current_analysis.CurrentSensor(0.066)
+    assert current_analysis.get_sensor(sensor) is sensor
+    with pytest.raises(KeyError):
+        current_analysis.get_sensor('ACS758')
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import lock_in
+import receive_and_analyze as analyze
+
+#the settled lock-in outputs against harmonic_amplitudes() of a whole period record of the same signal
+
+AMPLITUDES = {1: 1.0, 3: 0.2, 5: 0.05, 7: 0.01} #no even harmonics, H2 has to come out as 0
+
+def drive_signal(sample_rate, frequency, num_samples):
+    t = np.arange(num_samples) / sample_rate
+    signal = 0.01 + sum(a * np.cos(2 * np.pi * k * frequency * t + 0.3 * k) for k, a in AMPLITUDES.items())
+    current = 2.5 + 0.5 * np.cos(2 * np.pi * frequency * t + 0.7)
+    return signal, current
+
+def run_lock_in(demodulator, signal, current, block_samples):
+    outputs = [demodulator.process(signal[start:start + block_samples], current[start:start + block_samples])
+               for start in range(0, len(signal), block_samples)]
+    times = np.concatenate([output[0] for output in outputs])
+    harmonics = np.concatenate([output[1] for output in outputs])
+    reference = np.concatenate([output[2] for output in outputs])
+    return times, harmonics, reference
+
+@pytest.mark.parametrize('sample_rate, frequency, chunk_periods', [(100000, 1000.0, 1), (1000000, 3000.0, 3),
+                                                                   (1000000, 2500.0, 1), (200000, 7000.0, 7)])
+@pytest.mark.parametrize('filter', lock_in.FILTERS)
+def test_matches_harmonic_amplitudes(sample_rate, frequency, chunk_periods, filter):
+    demodulator = lock_in.LockIn(sample_rate, frequency, orders=range(1, 8), time_constant=0.005, filter=filter,
+                                 reference='sync')
+    assert demodulator.chunk_periods == chunk_periods
+    num_samples = int(0.3 * sample_rate)
+    signal, current = drive_signal(sample_rate, frequency, num_samples)
+    times, harmonics, _ = run_lock_in(demodulator, signal, current, 4999) #blocks do not line up with the spans
+    assert len(times)
+
+    whole = demodulator.chunk_samples * (num_samples // demodulator.chunk_samples)
+    orders, expected = analyze.harmonic_amplitudes(signal[:whole], sample_rate, frequency, range(1, 8))
+    np.testing.assert_array_equal(orders, demodulator.orders)
+    np.testing.assert_allclose(harmonics[-1], expected, rtol=0, atol=1e-9)
+    assert np.max(np.abs(harmonics[:, 1])) < 1e-9 #even harmonics stay 0 in every output
+
+def test_current_reference_removes_the_drive_phase():
+    sample_rate, frequency = 1000000, 3000.0
+    demodulator = lock_in.LockIn(sample_rate, frequency, orders=[3, 5], time_constant=0.005, reference='current')
+    signal, current = drive_signal(sample_rate, frequency, int(0.3 * sample_rate))
+    _, harmonics, reference = run_lock_in(demodulator, signal, current, 10000)
+    np.testing.assert_allclose(np.angle(reference[-1]), 0.7, atol=1e-9)
+    #theta_k - k theta_1 of the current fundamental
+    np.testing.assert_allclose(np.angle(harmonics[-1]), [0.9 - 3 * 0.7, 1.5 - 5 * 0.7], atol=1e-9)
+    np.testing.assert_allclose(np.abs(harmonics[-1]), [0.1, 0.025], rtol=1e-9)
+
+def test_skip_keeps_the_phase():
+    sample_rate, frequency = 100000, 1000.0
+    demodulator = lock_in.LockIn(sample_rate, frequency, orders=[3], time_constant=0.005, filter='fir',
+                                 reference='sync')
+    signal, current = drive_signal(sample_rate, frequency, 30000)
+    demodulator.process(signal[:10000], current[:10000])
+    demodulator.skip(5050) #a dropped block that ends mid period
+    times, harmonics, _ = demodulator.process(signal[15050:], current[15050:])
+    assert times[0] > 0.15
+    np.testing.assert_allclose(harmonics[-1], 0.1 * np.exp(0.9j), atol=1e-9)
+
+def test_refuses_spans_that_are_not_whole_samples():
+    with pytest.raises(ValueError):
+        lock_in.LockIn(1000000, 2718.2818)
+
+class SlowWriter:
+    #results run stand in: append() can be slower than the join timeout of stop()
+    def __init__(self, append_time=0.0):
+        self.append_time = append_time
+        self.appending = threading.Event()
+        self.closed = False
+        self.attrs = {}
+        self.rows = 0
+
+    def append(self, name, block, chunk_rows=1):
+        assert not self.closed, "append to a closed results file"
+        self.appending.set()
+        time.sleep(self.append_time)
+        assert not self.closed, "results file closed during an append"
+        self.rows += len(block)
+
+    def set_attrs(self, **attrs):
+        self.attrs.update(attrs)
+
+    def close(self):
+        self.closed = True
+
+def test_stream_writes_and_closes_the_run():
+    writer = SlowWriter()
+    demodulator = lock_in.LockIn(100000, 1000.0, time_constant=0.001, output_rate=200.0)
+    stream = lock_in.LockInStream('Dev1/ai0', 'Dev1/ai1', demodulator, writer=writer, block_time=0.01)
+    stream.start()
+    assert writer.appending.wait(5)
+    stream.stop()
+    assert stream.error is None
+    assert writer.closed and writer.rows and 'dropped_samples' in writer.attrs
+    assert stream.history()[1].size
+
+def test_stop_does_not_close_the_run_under_a_running_append():
+    writer = SlowWriter(append_time=2.5) #longer than the 2 s join timeout of stop()
+    demodulator = lock_in.LockIn(100000, 1000.0, time_constant=0.001, output_rate=200.0)
+    stream = lock_in.LockInStream('Dev1/ai0', 'Dev1/ai1', demodulator, writer=writer, block_time=0.01)
+    stream.start()
+    assert writer.appending.wait(5)
+    stream.stop() #returns with the worker still in append()
+    assert not writer.closed
+    stream._threads[1].join(10)
+    assert writer.closed and stream.error is None
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+import receive_and_analyze as analyze
+
+#reconstruct_and_integrate_fast against the loop of reconstruct_and_integrate, on MPS like records (odd harmonics of
+#the drive plus a background and noise between them)
+
+def mps_record(sample_rate, f_drive, num_periods, seed=0):
+    rng = np.random.default_rng(seed)
+    num_samples = int(round(num_periods * sample_rate / f_drive))
+    t = np.arange(num_samples) / sample_rate
+    signal = sum(np.cos(2 * np.pi * k * f_drive * t + 0.3 * k) / k ** 2 for k in range(1, 12, 2))
+    signal += 1e-3 + 1e-3 * np.sin(2 * np.pi * 60 * t) + 1e-3 * rng.normal(size=num_samples)
+    magnitude, frequency, phase, _ = analyze.fourier(signal, sample_rate, num_samples)
+    return num_samples, frequency, magnitude, phase
+
+@pytest.mark.parametrize('sample_rate, f_drive, num_periods', [(100000, 1000.0, 10), (100000, 2500.0, 20),
+                                                               (1000000, 10000.0, 10), (1000000, 25000.0, 20),
+                                                               (1000000, 10000.0, 100)]) #production sized record
+def test_fast_matches_loop(sample_rate, f_drive, num_periods):
+    num_samples, frequency, magnitude, phase = mps_record(sample_rate, f_drive, num_periods)
+    recon, integral = analyze.reconstruct_and_integrate(num_samples, frequency, magnitude, f_drive, phase)
+    recon_fast, integral_fast = analyze.reconstruct_and_integrate_fast(num_samples, frequency, magnitude, f_drive,
+                                                                       phase)
+    assert recon_fast.shape == recon.shape and integral_fast.shape == integral.shape
+    np.testing.assert_allclose(recon_fast, recon, rtol=0, atol=1e-9 * np.max(np.abs(recon)))
+    np.testing.assert_allclose(integral_fast, integral, rtol=0, atol=1e-9 * np.max(np.abs(integral)))
+
+@pytest.mark.parametrize('sample_rate, f_drive, num_periods', [(100000, 1000.0, 10), (1000000, 10000.0, 10)])
+@pytest.mark.parametrize('num_harmonics', [1, 5, 11])
+def test_num_harmonics_matches_loop_on_harmonics(sample_rate, f_drive, num_periods, num_harmonics):
+    #restricted to N harmonics = the loop over a spectrum that is zero everywhere else
+    num_samples, frequency, magnitude, phase = mps_record(sample_rate, f_drive, num_periods)
+    bins = analyze.harmonic_bins(frequency, f_drive, num_harmonics)
+    harmonics_only = np.zeros_like(magnitude)
+    harmonics_only[bins] = magnitude[bins]
+    recon, integral = analyze.reconstruct_and_integrate(num_samples, frequency, harmonics_only, f_drive, phase)
+    recon_fast, integral_fast = analyze.reconstruct_and_integrate_fast(num_samples, frequency, magnitude, f_drive,
+                                                                       phase, num_harmonics=num_harmonics)
+    np.testing.assert_allclose(recon_fast, recon, rtol=0, atol=1e-9 * np.max(np.abs(recon)))
+    np.testing.assert_allclose(integral_fast, integral, rtol=0, atol=1e-9 * np.max(np.abs(integral)))
+
+def test_without_phase():
+    num_samples, frequency, magnitude, _ = mps_record(100000, 1000.0, 10)
+    recon, integral = analyze.reconstruct_and_integrate(num_samples, frequency, magnitude, 1000.0)
+    recon_fast, integral_fast = analyze.reconstruct_and_integrate_fast(num_samples, frequency, magnitude, 1000.0)
+    np.testing.assert_allclose(recon_fast, recon, rtol=0, atol=1e-9 * np.max(np.abs(recon)))
+    np.testing.assert_allclose(integral_fast, integral, rtol=0, atol=1e-9 * np.max(np.abs(integral)))
+
+def test_phases_keep_the_acquisition_time_base():
+    #with the phases the reconstructed period is the signal itself at the times of one_period_grid
+    sample_rate, f_drive, num_periods = 100000, 1000.0, 10
+    num_samples = int(num_periods * sample_rate / f_drive)
+    t = np.arange(num_samples) / sample_rate
+    signal = np.cos(2 * np.pi * f_drive * t + 0.4) + 0.2 * np.cos(2 * np.pi * 3 * f_drive * t - 1.1)
+    magnitude, frequency, _, complex_spectrum = analyze.fourier(signal, sample_rate, num_samples)
+    recon, _ = analyze.reconstruct_and_integrate_fast(num_samples, frequency, magnitude, f_drive,
+                                                      np.angle(complex_spectrum))
+    grid = analyze.one_period_grid(f_drive)
+    expected = np.cos(2 * np.pi * f_drive * grid + 0.4) + 0.2 * np.cos(2 * np.pi * 3 * f_drive * grid - 1.1)
+    np.testing.assert_allclose(recon, expected / 2, rtol=0, atol=1e-9) #one sided amplitudes
+
+@pytest.mark.parametrize('window', [None, 'hann'])
+def test_field_from_current_of_a_sinusoidal_drive(window):
+    #ACS712-20A: 2.5 V at 0 A, 0.1 V/A. 3 A peak at 1 kHz with a 0.7 rad phase, 5.0093 mT/A
+    sample_rate, f_drive, coefficient = 100000, 1000.0, 5.0093
+    t = np.arange(2000) / sample_rate
+    current_voltage = 2.5 + 0.1 * 3.0 * np.cos(2 * np.pi * f_drive * t + 0.7)
+    H = analyze.field_from_current(current_voltage, sample_rate, f_drive, coefficient, sensor='ACS712-20A',
+                                   window=window)
+    grid = analyze.one_period_grid(f_drive)
+    assert H.shape == grid.shape
+    np.testing.assert_allclose(H, coefficient * 3.0 * np.cos(2 * np.pi * f_drive * grid + 0.7), rtol=0, atol=1e-6)
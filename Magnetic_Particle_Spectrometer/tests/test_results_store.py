@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+
+import results_store
+
+def test_run_attributes_name_their_own_run(tmp_path):
+    store = results_store.ResultsStore(str(tmp_path / 'results.h5'))
+    first = store.start_run('background', {'frequency': 1000.0, 'results_run': None, 'skipped': [1, 2]})
+    first.close()
+    second = store.start_run('sample', {'frequency': 2000.0, 'results_run': first.name})
+    second.close()
+    runs = dict(store.runs())
+    assert list(runs) == ['run_0001', 'run_0002']
+    assert runs['run_0001']['results_run'] == '/run_0001' and runs['run_0002']['results_run'] == '/run_0002'
+    assert runs['run_0002']['results_file'] == store.path
+    assert runs['run_0002']['frequency'] == 2000.0 and 'skipped' not in runs['run_0001']
+    assert runs['run_0001']['complete'] and runs['run_0001']['mode'] == 'background'
+
+def test_daily_file_is_picked_when_a_run_starts(tmp_path, monkeypatch):
+    day = ['20260101']
+    monkeypatch.setattr(results_store, 'daily_path',
+                        lambda directory: os.path.join(directory, f'mps_results_{day[0]}.h5'))
+    store = results_store.ResultsStore(directory=str(tmp_path))
+    store.start_run('sample').close()
+    day[0] = '20260102' #the session runs past midnight
+    run = store.start_run('sample')
+    run.close()
+    assert run.path == store.path == str(tmp_path / 'mps_results_20260102.h5')
+    assert sorted(os.listdir(tmp_path)) == ['mps_results_20260101.h5', 'mps_results_20260102.h5']
+    assert [name for name, _ in store.runs()] == ['run_0001'] #numbering starts again in the new file
+
+def test_sweep_steps_append_and_truncate(tmp_path):
+    store = results_store.ResultsStore(str(tmp_path / 'results.h5'))
+    run = store.start_run('sweep')
+    run.write('orders', np.arange(1, 4))
+    run.write_step(0, harmonics=np.array([1, 2, 3], dtype=complex), i_rms=1.0)
+    run.write_step(2, harmonics=np.array([7, 8, 9], dtype=complex), i_rms=3.0) #out of order, step 1 is missing
+    for step in range(3):
+        run.append('raw_records', np.full((1, 2, 5), step, dtype=float))
+    run.truncate('raw_records', 2) #records of a step that was not finished
+    run.close(complete=False)
+
+    name = run.name
+    i_rms = store.read(name, 'i_rms')
+    assert i_rms[0] == 1.0 and np.isnan(i_rms[1]) and i_rms[2] == 3.0
+    np.testing.assert_array_equal(store.read_harmonic(name, 3), [3, np.nan + 0j, 9])
+    assert store.read(name, 'raw_records').shape == (2, 2, 5)
+    np.testing.assert_array_equal(store.read(name, 'raw_records', np.s_[1, 0, :2]), [1.0, 1.0])
+    assert dict(store.runs())['run_0001']['steps_written'] == 3
+
+def test_resume_run(tmp_path):
+    path = str(tmp_path / 'results.h5')
+    run = results_store.ResultsStore(path).start_run('sweep')
+    run.write_step(0, i_rms=1.0)
+    run.close(complete=False)
+
+    store = results_store.ResultsStore(str(tmp_path / 'other.h5'))
+    assert store.resume_run('/run_0009', path) is None
+    assert store.resume_run('/run_0001', str(tmp_path / 'missing.h5')) is None
+    resumed = store.resume_run('/run_0001', path)
+    assert store.path == path #the readers follow the resumed run
+    resumed.write_step(1, i_rms=2.0)
+    resumed.close()
+    np.testing.assert_array_equal(store.read('/run_0001', 'i_rms'), [1.0, 2.0])
+    attrs = dict(store.runs())['run_0001']
+    assert attrs['complete'] and 'resumed' in attrs
+
+def test_copy_and_export(tmp_path):
+    store = results_store.ResultsStore(str(tmp_path / 'results.h5'))
+    run = store.start_run('sweep', {'User information': 'coil 2'})
+    run.write('orders', np.array([3, 5]))
+    run.write_step(0, harmonics=np.array([1j, 2.0]))
+    run.close()
+    store.copy_run(run.name, str(tmp_path / 'copy.h5'), {'note': 'kept'})
+    copied = results_store.ResultsStore(str(tmp_path / 'copy.h5'))
+    assert dict(copied.runs())['run_0001']['note'] == 'kept'
+
+    from scipy.io import loadmat
+    store.export_mat(run.name, str(tmp_path / 'run.mat'))
+    data = loadmat(str(tmp_path / 'run.mat'))
+    np.testing.assert_allclose(data['harmonic_3_magnitude'].ravel(), [1.0])
+    np.testing.assert_allclose(data['harmonic_5_phase'].ravel(), [0.0])
@@ -0,0 +1,104 @@
+import pytest
+import pyvisa
+
+import simulation
+import wave_gen
+
+#the stateful SCPI drivers against the simulated 33500B and PFR-100L, every write to the instrument is recorded
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(simulation.bench, 'generator', {})
+    monkeypatch.setattr(simulation.bench, 'dc_output', False)
+    monkeypatch.setattr(simulation.bench, 'dc_current', 0.0)
+    pool = wave_gen.InstrumentPool()
+    monkeypatch.setattr(wave_gen, 'pool', pool)
+    yield pool
+    pool.close_all()
+
+def recorded(inst):
+    #query() goes through write() too, so the *OPC? shows up in the same list
+    writes = []
+    write = inst.write
+    def record(message):
+        writes.append(message)
+        return write(message)
+    inst.write = record
+    return writes
+
+def test_first_apply_sends_one_joined_write_and_waits_for_completion(pool):
+    inst = wave_gen.connect_waveform_generator(10)
+    writes = recorded(inst)
+    assert pool.driver(inst, wave_gen.Keysight33500B).set_output(1, 0.5, 1000)
+    assert writes == [":SOURCE1:VOLTage 0.5Vpp;:SOURCE1:FREQuency 1000 HZ;:OUTPUT1 ON;:OUTPUT:SYNC1 ON;"
+                      ":TRIGger:MODE:SOURCE1 IMM;:TRIGger:SOURCE1 BUS", "*OPC?"]
+    assert simulation.bench.generator['1'] == {'voltage': 0.5, 'frequency': 1000.0, 'output': True}
+
+def test_repeated_apply_sends_nothing(pool):
+    inst = wave_gen.connect_waveform_generator(10)
+    wave_gen.send_voltage(inst, 0.5, 1000, 1)
+    writes = recorded(inst)
+    assert not pool.driver(inst, wave_gen.Keysight33500B).set_output(1, 0.5, 1000)
+    wave_gen.send_voltage(inst, 0.5, 1000, 1)
+    assert writes == []
+
+def test_changed_setting_sends_only_its_command(pool):
+    inst = wave_gen.connect_waveform_generator(10)
+    wave_gen.send_voltage(inst, 0.5, 1000, 1)
+    writes = recorded(inst)
+    wave_gen.send_voltage(inst, 0.8, 1000, 1)
+    assert writes == [":SOURCE1:VOLTage 0.8Vpp", "*OPC?"]
+    wave_gen.turn_off(inst, 1)
+    wave_gen.turn_off(inst, 1)
+    assert writes[2:] == [":OUTPUT1 OFF", "*OPC?"]
+    assert simulation.bench.generator['1']['output'] is False
+    wave_gen.send_voltage(inst, 0.8, 1000, 1) #output back on, nothing else changed
+    assert writes[4:] == [":OUTPUT1 ON", "*OPC?"]
+
+def test_invalidate_sends_everything_again(pool):
+    inst = wave_gen.connect_waveform_generator(10)
+    wave_gen.send_voltage(inst, 0.5, 1000, 1)
+    writes = recorded(inst)
+    wave_gen.restore_output(inst, 0.5, 1000, 1)
+    assert len(writes) == 2 and writes[0].count(';') == 5
+
+def test_failed_write_forgets_the_state_and_the_session(pool):
+    inst = wave_gen.connect_waveform_generator(10)
+    wave_gen.send_voltage(inst, 0.5, 1000, 1)
+    driver = pool.driver(inst, wave_gen.Keysight33500B)
+    inst.close() #session lost
+    with pytest.raises(pyvisa.Error):
+        driver.set_output(1, 0.8, 1000)
+    assert driver.state == {} #unknown what was applied
+    wave_gen.send_voltage(inst, 0.8, 1000, 1) #error printed, the session is dropped from the pool
+    new = wave_gen.connect_waveform_generator(10)
+    assert new is not inst
+    assert pool.driver(new, wave_gen.Keysight33500B) is not driver
+    writes = recorded(new)
+    wave_gen.send_voltage(new, 0.8, 1000, 1)
+    assert len(writes) == 2 and writes[0].count(';') == 5
+
+def test_power_supply_waits_settle_time_only_after_a_change(pool, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(wave_gen.time, 'sleep', sleeps.append)
+    inst = wave_gen.connect_power_supply()
+    assert inst.baud_rate == 9600
+    writes = recorded(inst)
+    wave_gen.send_dc_voltage(inst, 12, 1.5)
+    wave_gen.send_dc_voltage(inst, 12, 1.5)
+    assert writes == [":SOURce:VOLTage:LEVel 12;:SOURce:CURRent:LEVel 1.5;:OUTPut:STATe ON", "*OPC?"]
+    assert sleeps == [wave_gen.PFR100L.settle_time]
+    assert simulation.bench.dc_current == 1.5
+    wave_gen.send_dc_voltage(inst, 12, 2.0)
+    assert writes[2:] == [":SOURce:CURRent:LEVel 2.0", "*OPC?"]
+    assert sleeps == [wave_gen.PFR100L.settle_time] * 2
+
+def test_ramp_steps_the_current_up_from_zero(pool):
+    inst = wave_gen.connect_power_supply()
+    wave_gen.send_dc_voltage(inst, 12, 2.5) #state before the crash
+    writes = recorded(inst)
+    wave_gen.ramp_dc_current(inst, 2.5)
+    currents = [float(command.split('LEVel ')[1]) for write in writes for command in write.split(';')
+                if 'CURRent' in command]
+    assert currents == [0.0, 2.5 / 3, 2 * 2.5 / 3, 2.5]
+    assert simulation.bench.dc_current == 2.5
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+import simulation
+
+import nidaqmx #the simulated modules, see conftest
+import pyvisa
+from nidaqmx.constants import AcquisitionType
+
+import receive_and_analyze as analyze
+
+@pytest.fixture
+def bench(monkeypatch):
+    bench = simulation.bench
+    monkeypatch.setattr(bench, 'generator', {})
+    monkeypatch.setattr(bench, 'dc_current', 0.0)
+    monkeypatch.setattr(bench, 'dc_output', False)
+    monkeypatch.setattr(bench, 'noise_rms', 0.0)
+    monkeypatch.setattr(bench, 'sensor_noise_rms', 0.0)
+    monkeypatch.setattr(bench, 'trigger_jitter', 0.0)
+    monkeypatch.setattr(bench, 'sample_present', True)
+    return bench
+
+def drive(voltage=2.0, frequency=1000.0):
+    generator = pyvisa.ResourceManager().open_resource('GPIB0::10::INSTR')
+    generator.write(f'SOURCE1:FREQUENCY {frequency};SOURCE1:VOLTAGE {voltage};OUTPUT1 ON')
+    return generator
+
+def read(channels, sample_rate, n_samps, trigger=None):
+    with nidaqmx.Task() as task:
+        task.ai_channels.add_ai_voltage_chan(','.join(channels))
+        if trigger is not None:
+            task.triggers.start_trigger.cfg_dig_edge_start_trig(trigger)
+        task.timing.cfg_samp_clk_timing(sample_rate, samps_per_chan=n_samps)
+        return np.array(task.read(number_of_samples_per_channel=n_samps))
+
+def test_generator_commands_update_the_bench(bench):
+    drive(2.0, 1000.0)
+    assert bench.generator['1'] == {'frequency': 1000.0, 'voltage': 2.0, 'output': True}
+    assert bench.drive() == ([(bench.field_per_volt * 2.0, 1000.0)], 0.0)
+
+def test_power_supply_current_only_while_the_output_is_on(bench):
+    supply = pyvisa.ResourceManager().open_resource('ASRL5::INSTR')
+    supply.write('SOURCE:CURRENT:LEVEL 2.5')
+    assert bench.dc_current == 0.0
+    supply.write('OUTPUT:STATE ON')
+    assert bench.dc_current == 2.5
+    supply.write('OUTPUT:STATE OFF')
+    assert bench.dc_current == 0.0
+
+def test_current_channel_sees_the_drive_current(bench):
+    drive(2.0, 1000.0)
+    voltage = read(['Dev1/ai1'], 100000, 10000)
+    current = (voltage - bench.sensor_offset) / bench.sensor_sensitivity
+    _, (fundamental,) = analyze.harmonic_amplitudes(current, 100000, 1000.0, [1])
+    np.testing.assert_allclose(2 * abs(fundamental), bench.field_per_volt * 2.0 / bench.field_per_amp, rtol=1e-9)
+
+def test_triggered_reads_start_on_the_sync_edge(bench):
+    drive(2.0, 1000.0)
+    for _ in range(3):
+        voltage = read(['Dev1/ai1'], 100000, 10000, trigger='/Dev1/PFI0')
+        _, (fundamental,) = analyze.harmonic_amplitudes(voltage, 100000, 1000.0, [1])
+        #sin drive: cosine phase -pi/2 at the edge, the start falls within one sample clock after it
+        phase_step = 2 * np.pi * 1000.0 / 100000
+        assert -np.pi / 2 - 1e-9 <= np.angle(fundamental) <= -np.pi / 2 + phase_step
+
+def test_sample_adds_odd_harmonics(bench):
+    drive(2.0, 1000.0)
+    with_sample = analyze.harmonic_amplitudes(read(['Dev1/ai0'], 100000, 10000), 100000, 1000.0, [3])[1]
+    bench.sample_present = False
+    empty = analyze.harmonic_amplitudes(read(['Dev1/ai0'], 100000, 10000), 100000, 1000.0, [3])[1]
+    assert abs(with_sample[0]) > 10 * abs(empty[0])
+
+def test_finite_task_refuses_longer_reads(bench):
+    with nidaqmx.Task() as task:
+        task.ai_channels.add_ai_voltage_chan('Dev1/ai0')
+        task.timing.cfg_samp_clk_timing(100000, sample_mode=AcquisitionType.FINITE, samps_per_chan=100)
+        with pytest.raises(nidaqmx.DaqError):
+            task.read(number_of_samples_per_channel=200)
+
+def test_unknown_resource():
+    with pytest.raises(pyvisa.Error):
+        pyvisa.ResourceManager().open_resource('TCPIP0::1.2.3.4::INSTR')
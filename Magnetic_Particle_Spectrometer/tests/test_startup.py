@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+
+import startup
+import wave_gen
+
+def test_warm_up_imports_and_then_discovers(capsys):
+    order = []
+    thread = startup.warm_up(['json', 'no_such_module_xyz'], discover=lambda: order.append('json' in sys.modules))
+    thread.join(5)
+    assert not thread.is_alive() and thread.daemon
+    assert order == [True] #discover runs after the imports
+    assert 'Warm up skipped no_such_module_xyz' in capsys.readouterr().out
+
+def test_time_to_interactive_counts_from_the_import():
+    first = startup.time_to_interactive()
+    assert 0 < first <= startup.time_to_interactive()
+
+def test_instrument_pool_opens_nothing_until_used():
+    pool = wave_gen.InstrumentPool()
+    assert pool._rm is None and pool.resources is None
+    assert 'GPIB0::10::INSTR' in pool.discover()
+    assert pool._rm is not None
+
+def test_heavy_modules_are_not_imported_with_the_analysis():
+    #a fresh interpreter: importing the analysis modules (what the App window needs) leaves scipy's signal and io
+    #modules to the warm up thread
+    directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = ("import sys, simulation; simulation.install(); "
+            "import receive_and_analyze, daq_session, lock_in, coherent_average, results_store; "
+            "print('scipy.signal' in sys.modules, 'scipy.io' in sys.modules)")
+    output = subprocess.run([sys.executable, '-c', code], cwd=directory, capture_output=True, text=True, check=True)
+    assert output.stdout.strip().splitlines()[-1] == 'False False'
+
+def test_wave_gen_imports_pyvisa_on_first_use():
+    #a fresh interpreter without the simulated backend: pyvisa is not needed (nor has to be installed) to import
+    #wave_gen, the first session imports it
+    directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys, wave_gen; print('pyvisa' in sys.modules, wave_gen.pool._rm)"
+    output = subprocess.run([sys.executable, '-c', code], cwd=directory, capture_output=True, text=True, check=True)
+    assert output.stdout.strip().splitlines()[-1] == 'False None'
@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+import acquisition_worker
+import sweep_engine
+
+class Recorder:
+    #apply / acquire / process callbacks that log what ran, in which thread
+    def __init__(self, cancel_at=None, fail_at=None, process_gate=None):
+        self.events = []
+        self.cancel_at = cancel_at
+        self.fail_at = fail_at
+        self.process_gate = process_gate #process waits for it (a slow analysis)
+        self.lock = threading.Lock()
+        self.unprocessed = 0 #acquired steps that were not processed yet
+        self.max_unprocessed = 0
+
+    def log(self, *event):
+        with self.lock:
+            self.events.append(event)
+
+    def apply(self, step, setpoint):
+        assert threading.current_thread() is threading.main_thread()
+        if step == self.cancel_at:
+            raise acquisition_worker.JobCancelled() #job.progress() in the App's apply
+        self.log('apply', step, setpoint)
+
+    def acquire(self, step, setpoint):
+        with self.lock:
+            self.unprocessed += 1
+            self.max_unprocessed = max(self.max_unprocessed, self.unprocessed)
+        self.log('acquire', step)
+        return [setpoint * 10]
+
+    def process(self, step, setpoint, records):
+        assert threading.current_thread() is not threading.main_thread()
+        if self.process_gate is not None:
+            assert self.process_gate.wait(5)
+        if step == self.fail_at:
+            raise ValueError("analysis failed")
+        with self.lock:
+            self.unprocessed -= 1
+        self.log('process', step, records)
+
+    def steps(self, kind):
+        return [event[1] for event in self.events if event[0] == kind]
+
+def test_steps_are_processed_in_order():
+    recorder = Recorder()
+    setpoints = [1, 2, 3, 4, 5]
+    sweep_engine.SweepEngine(recorder.apply, recorder.acquire, recorder.process).run(setpoints)
+    assert recorder.steps('apply') == recorder.steps('acquire') == recorder.steps('process') == [0, 1, 2, 3, 4]
+    assert [event[2] for event in recorder.events if event[0] == 'process'] == [[10], [20], [30], [40], [50]]
+    for step, setpoint in enumerate(setpoints): #every step is set before it is acquired
+        assert recorder.events.index(('apply', step, setpoint)) < recorder.events.index(('acquire', step))
+
+def test_resume_starts_at_the_first_unfinished_step():
+    recorder = Recorder()
+    sweep_engine.SweepEngine(recorder.apply, recorder.acquire, recorder.process).run([1, 2, 3, 4], start=2)
+    assert recorder.steps('apply') == recorder.steps('process') == [2, 3]
+
+def test_acquisition_waits_for_a_slow_analysis():
+    gate = threading.Event()
+    recorder = Recorder(process_gate=gate)
+    engine = sweep_engine.SweepEngine(recorder.apply, recorder.acquire, recorder.process, max_pending=2)
+    thread = threading.Timer(0.2, gate.set)
+    thread.start()
+    engine.run(list(range(10)))
+    thread.join()
+    assert recorder.steps('process') == list(range(10))
+    assert recorder.max_unprocessed <= engine.max_pending + 1 #the queue of raw records stays bounded
+
+def test_cancel_stops_cleanly_after_the_finished_steps():
+    recorder = Recorder(cancel_at=3)
+    with pytest.raises(acquisition_worker.JobCancelled):
+        sweep_engine.SweepEngine(recorder.apply, recorder.acquire, recorder.process).run(list(range(6)))
+    #the stored steps are the first ones without a gap (a resume repeats the rest), nothing runs after run() returned
+    assert recorder.steps('apply') == recorder.steps('acquire') == [0, 1, 2]
+    processed = recorder.steps('process')
+    assert processed == list(range(len(processed)))
+    events = list(recorder.events)
+    threading.Event().wait(0.05)
+    assert recorder.events == events
+
+def test_analysis_error_stops_the_sweep():
+    recorder = Recorder(fail_at=1)
+    with pytest.raises(ValueError):
+        sweep_engine.SweepEngine(recorder.apply, recorder.acquire, recorder.process, max_pending=1).run(list(range(8)))
+    assert recorder.steps('process') == [0]
+    assert max(recorder.steps('acquire')) <= 3 #stopped within max_pending steps of the failed one
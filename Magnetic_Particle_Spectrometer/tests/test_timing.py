@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+import timing
+
+@pytest.fixture
+def timer(monkeypatch):
+    timer = timing.StageTimer()
+    monkeypatch.setattr(timing, 'timer', timer) #timed() records into the module timer
+    return timer
+
+def test_timed_stages_add_up(timer, monkeypatch):
+    clock = iter([0.0, 0.5, 1.0, 1.25, 2.0, 2.1])
+    monkeypatch.setattr(timing.time, 'perf_counter', lambda: next(clock))
+
+    @timing.timed('fft')
+    def work(fail=False):
+        if fail:
+            raise ValueError
+        return 42
+
+    assert work() == 42
+    with pytest.raises(ValueError):
+        work(fail=True) #a failed call is recorded too
+    with timer.stage('daq_read'):
+        pass
+    assert timer.stages == {'fft': [2, 0.75, 0.5], 'daq_read': [1, pytest.approx(0.1), pytest.approx(0.1)]}
+
+def test_runs_start_from_zero(timer):
+    timer.start_run('sample')
+    timer.record('fft', 0.2)
+    timer.count('frames', 3)
+    timer.count('frames')
+    summary = timer.finish_run()
+    assert summary['run'] == 'sample' and summary['run_time_s'] >= 0
+    assert summary['stages'] == {'fft': {'count': 1, 'total_s': 0.2, 'max_s': 0.2}}
+    assert summary['counters'] == {'frames': 4}
+
+    timer.start_run('sweep')
+    assert timer.stages == {} and timer.counters == {}
+
+def test_status_line_and_report_list_the_most_expensive_stages(timer):
+    timer.start_run('sweep')
+    for stage, seconds in [('fft', 0.1), ('daq_read', 2.0), ('gpib_write', 0.5), ('fft', 0.3)]:
+        timer.record(stage, seconds)
+    timer.finish_run()
+    line = timer.status_line(max_stages=2)
+    assert line.startswith('sweep: ') and line.index('daq_read') < line.index('gpib_write') and 'fft' not in line
+    report = timer.report()
+    assert 'fft' in report and report.index('daq_read') < report.index('fft')
+
+def test_records_from_several_threads(timer):
+    def work():
+        for _ in range(1000):
+            timer.record('analysis', 0.001)
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert timer.stages['analysis'][0] == 4000
+
+def test_profile(timer, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    timer.start_run('sample run', profile=True)
+    sum(range(1000))
+    summary = timer.finish_run()
+    assert summary['profile_file'].startswith('mps_profile_sample_run_')
+    assert (tmp_path / summary['profile_file']).exists() and timer.profile_text
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+import receive_and_analyze as analyze
+
+#windowed_harmonics() on records with a known harmonic content, whole and non-integer numbers of drive periods
+
+SAMPLE_RATE = 100000.0
+NUM_SAMPLES = 10000
+AMPLITUDES = {1: 1.0, 3: 0.3, 5: 0.1, 7: 0.05}
+ORDERS = list(AMPLITUDES)
+
+def record(frequency, num_samples=NUM_SAMPLES):
+    t = np.arange(num_samples) / SAMPLE_RATE
+    return 0.01 + sum(a * np.cos(2 * np.pi * k * frequency * t + 0.3 * k) for k, a in AMPLITUDES.items())
+
+def expected():
+    #normalized like fourier(): half the amplitude, phase at the first sample
+    return np.array([a / 2 * np.exp(0.3j * k) for k, a in AMPLITUDES.items()])
+
+def relative_error(amplitudes):
+    return np.max(np.abs(amplitudes - expected()) / np.abs(expected()))
+
+@pytest.mark.parametrize('window, interpolation, tolerance', [('hann', 'nominal', 1e-6), ('hann', 'sinc', 1e-6),
+                                                              ('hann', 'parabolic', 1e-5),
+                                                              ('blackmanharris', 'nominal', 1e-4),
+                                                              ('blackmanharris', 'parabolic', 1e-4),
+                                                              ('flattop', 'nominal', 1e-4),
+                                                              ('flattop', 'parabolic', 1e-2)])
+def test_non_integer_periods(window, interpolation, tolerance):
+    orders, amplitudes = analyze.harmonic_amplitudes(record(1234.5), SAMPLE_RATE, 1234.5, ORDERS, window,
+                                                     interpolation) #123.45 periods
+    np.testing.assert_array_equal(orders, ORDERS)
+    assert relative_error(amplitudes) < tolerance
+
+def test_closest_bins_leak_on_non_integer_periods():
+    _, amplitudes = analyze.harmonic_amplitudes(record(1234.5), SAMPLE_RATE, 1234.5, ORDERS)
+    assert relative_error(amplitudes) > 0.1
+
+@pytest.mark.parametrize('window', list(analyze.WINDOWS))
+@pytest.mark.parametrize('interpolation', analyze.INTERPOLATIONS)
+def test_whole_periods_are_exact(window, interpolation):
+    if interpolation == 'sinc' and window not in analyze.SINC_WINDOWS:
+        pytest.skip("sinc is not defined for this window")
+    _, amplitudes = analyze.harmonic_amplitudes(record(1000.0), SAMPLE_RATE, 1000.0, ORDERS, window, interpolation)
+    assert relative_error(amplitudes) < 1e-9
+
+def test_rectangular_nominal_matches_closest_bins_on_whole_periods():
+    signal = record(1000.0) + np.random.default_rng(0).normal(scale=0.1, size=NUM_SAMPLES)
+    _, closest = analyze.harmonic_amplitudes(signal, SAMPLE_RATE, 1000.0)
+    _, windowed = analyze.harmonic_amplitudes(signal, SAMPLE_RATE, 1000.0, window='rectangular')
+    np.testing.assert_allclose(windowed, closest, rtol=0, atol=1e-12)
+
+@pytest.mark.parametrize('window, interpolation', [('hann', 'parabolic'), ('hann', 'sinc'),
+                                                   ('blackmanharris', 'parabolic')])
+def test_interpolation_follows_a_detuned_generator(window, interpolation):
+    #the generator runs 0.05 % fast: the nominal position is off, the interpolated one follows the peak
+    true_frequency = 1234.5 * 1.0005
+    spectrum = analyze.spectrum(record(true_frequency), SAMPLE_RATE, NUM_SAMPLES).complex
+    _, amplitudes, frequencies = analyze.windowed_harmonics(spectrum, NUM_SAMPLES, SAMPLE_RATE, 1234.5, ORDERS,
+                                                            window, interpolation)
+    np.testing.assert_allclose(frequencies, np.array(ORDERS) * true_frequency, rtol=1e-5)
+    np.testing.assert_allclose(np.abs(amplitudes), np.abs(expected()), rtol=1e-3)
+    _, nominal, _ = analyze.windowed_harmonics(spectrum, NUM_SAMPLES, SAMPLE_RATE, 1234.5, ORDERS, window)
+    assert np.max(np.abs(np.abs(nominal) - np.abs(expected())) / np.abs(expected())) > 1e-3
+
+def test_stacked_records():
+    records = np.stack([record(1234.5), 2 * record(1234.5)])
+    _, amplitudes = analyze.harmonic_amplitudes(records, SAMPLE_RATE, 1234.5, ORDERS, 'hann', 'parabolic')
+    assert amplitudes.shape == (2, len(ORDERS))
+    np.testing.assert_allclose(amplitudes[1], 2 * amplitudes[0], rtol=1e-12)
+
+def test_background_is_subtracted_before_the_window():
+    t = np.arange(NUM_SAMPLES) / SAMPLE_RATE
+    background = 0.5 * np.cos(2 * np.pi * 1234.5 * t + 1.0) + 0.2 * np.sin(2 * np.pi * 60 * t)
+    sample = record(1234.5)
+    background_complex = analyze.spectrum(background, SAMPLE_RATE, NUM_SAMPLES).complex
+    records = np.stack([sample + background, 2.5 + np.cos(2 * np.pi * 1234.5 * t)])
+    num_samples, orders, amplitudes, _ = analyze.analyze_sample_harmonics(records, SAMPLE_RATE, 1234.5,
+                                                                          background_complex, ORDERS, 'hann')
+    assert num_samples == NUM_SAMPLES
+    assert relative_error(amplitudes) < 1e-6
+
+def test_invalid_combinations():
+    spectrum = analyze.spectrum(record(1000.0), SAMPLE_RATE, NUM_SAMPLES).complex
+    with pytest.raises(ValueError):
+        analyze.windowed_harmonics(spectrum, NUM_SAMPLES, SAMPLE_RATE, 1000.0, window='blackmanharris',
+                                   interpolation='sinc')
+    with pytest.raises(ValueError):
+        analyze.windowed_harmonics(spectrum, NUM_SAMPLES, SAMPLE_RATE, 1000.0, window='kaiser')
+    with pytest.raises(ValueError):
+        analyze.windowed_harmonics(spectrum, NUM_SAMPLES, SAMPLE_RATE, 1000.0, interpolation='cubic')
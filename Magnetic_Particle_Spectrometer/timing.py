@@ -0,0 +1,133 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+#Lightweight per run instrumentation: every timed stage (instrument writes, DAQ reads, analysis, canvas draws) adds
+#its duration to the current run, the App shows the summary and saves it with the results.
+#A run can optionally be profiled with cProfile (only the thread that starts the run is profiled).
+
+class StageTimer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.label = None
+        self.stages = {} #stage -> [count, total s, max s]
+        self.counters = {} #name -> count
+        self.run_time = 0.0
+        self.profile_path = None
+        self.profile_text = None
+        self._started = None
+        self._profiler = None
+
+    def start_run(self, label, profile=False):
+        self._stop_profiler()
+        with self._lock:
+            self.label = label
+            self.stages = {}
+            self.counters = {}
+            self.run_time = 0.0
+            self.profile_path = None
+            self.profile_text = None
+            self._started = time.perf_counter()
+        if profile:
+            self._profiler = cProfile.Profile()
+            try:
+                self._profiler.enable()
+            except ValueError: #another profiler is already active
+                self._profiler = None
+
+    def finish_run(self):
+        #ends the run (and its profile) and returns the summary
+        with self._lock:
+            if self._started is not None:
+                self.run_time = time.perf_counter() - self._started
+                self._started = None
+        profiler = self._stop_profiler()
+        if profiler is not None:
+            self.profile_path = time.strftime(f"mps_profile_{self.label or 'run'}_%Y%m%d_%H%M%S.prof").replace(' ', '_')
+            profiler.dump_stats(self.profile_path)
+            text = io.StringIO()
+            pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(25)
+            self.profile_text = text.getvalue()
+            print(self.profile_text)
+        return self.summary()
+
+    def _stop_profiler(self):
+        profiler, self._profiler = self._profiler, None
+        if profiler is not None:
+            profiler.disable()
+        return profiler
+
+    def record(self, stage, seconds):
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                self.stages[stage] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def summary(self):
+        #{'run': label, 'run_time_s': s, 'stages': {stage: {...}}, 'counters': {...}} (MATLAB friendly names)
+        with self._lock:
+            summary = {'run': self.label or '', 'run_time_s': self.run_time,
+                       'stages': {stage: {'count': count, 'total_s': total, 'max_s': longest}
+                                  for stage, (count, total, longest) in self.stages.items()},
+                       'counters': dict(self.counters)}
+        if self.profile_path:
+            summary['profile_file'] = self.profile_path
+        return summary
+
+    def status_line(self, max_stages=5):
+        #one line for the status panel: run time and the most expensive stages
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda item: item[1][1], reverse=True)[:max_stages]
+            parts = [f"{self.label or 'run'}: {self.run_time:.2f} s"]
+            parts += [f"{stage} {total:.3f} s ({count}x)" for stage, (count, total, _) in stages]
+        return "  |  ".join(parts)
+
+    def report(self):
+        #full table of the last run (stages by total time, then the counters)
+        with self._lock:
+            lines = [f"Run: {self.label or '-'}    total {self.run_time:.3f} s", "",
+                     f"{'stage':<22}{'count':>7}{'total (s)':>12}{'mean (ms)':>12}{'max (ms)':>12}"]
+            for stage, (count, total, longest) in sorted(self.stages.items(), key=lambda item: item[1][1],
+                                                         reverse=True):
+                lines.append(f"{stage:<22}{count:>7}{total:>12.4f}{1e3 * total / count:>12.3f}{1e3 * longest:>12.3f}")
+            if self.counters:
+                lines.append("")
+                lines += [f"{name:<22}{value:>7}" for name, value in sorted(self.counters.items())]
+            if self.profile_path:
+                lines += ["", f"cProfile saved to {self.profile_path}"]
+        return "\n".join(lines)
+
+timer = StageTimer()
+
+def timed(stage):
+    #decorator: adds the duration of every call to stage
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timer.record(stage, time.perf_counter() - start)
+        return wrapper
+    return decorate
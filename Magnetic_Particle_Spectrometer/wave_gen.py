@@ -1,33 +1,206 @@
-import pyvisa
+import atexit
+import math
+import threading
 import time
 
+import timing
+
+################################################################################################################################################
+#Instrument pool: one ResourceManager for the whole app and one long lived session per address.
+#Sessions are health checked (at most every health_check_interval seconds) and reopened if they were lost.
+#Nothing is opened at import: pyvisa is imported and the ResourceManager (VISA library) is created on first use,
+#discover() lists the instruments (seconds on GPIB/serial systems) and is run by the App on a background thread after
+#start up. The other functions import pyvisa locally for its exceptions (already loaded once a session exists).
+
+class InstrumentPool:
+    def __init__(self, health_check_interval=30.0):
+        self.health_check_interval = health_check_interval
+        self._rm = None
+        self.resources = None #addresses found by discover()
+        self._sessions = {} #address -> [instrument, time of the last successful check]
+        self._drivers = {} #address -> stateful SCPI driver of that session
+        self._lock = threading.RLock()
+
+    @property
+    def resource_manager(self):
+        with self._lock:
+            if self._rm is None:
+                import pyvisa #imported on first use, see daq_session
+                self._rm = pyvisa.ResourceManager()
+            return self._rm
+
+    def discover(self):
+        #a get() while the discovery is running waits for it (same lock)
+        with self._lock:
+            self.resources = self.resource_manager.list_resources()
+        print(f"VISA resources: {self.resources}")
+        return self.resources
+
+    def get(self, address, configure=None):
+        #borrow the session for address (opened and configured on first use, reopened if it went bad)
+        with self._lock:
+            entry = self._sessions.get(address)
+            if entry is not None:
+                if self._is_healthy(entry):
+                    return entry[0]
+                self.discard(address)
+
+            inst = self.resource_manager.open_resource(address)
+            if configure is not None:
+                configure(inst)
+            self._sessions[address] = [inst, time.monotonic()]
+            return inst
+
+    def driver(self, inst, driver_class):
+        #stateful driver bound to the session of inst (its cached state is dropped with the session)
+        with self._lock:
+            address = inst.resource_name
+            driver = self._drivers.get(address)
+            if driver is None or driver.inst is not inst:
+                driver = driver_class(inst)
+                self._drivers[address] = driver
+            return driver
+
+    def _is_healthy(self, entry):
+        import pyvisa
+        inst, last_check = entry
+        try:
+            inst.session #raises if the session was closed
+            if time.monotonic() - last_check > self.health_check_interval:
+                inst.query("*IDN?")
+                entry[1] = time.monotonic()
+            return True
+        except (pyvisa.Error, AttributeError):
+            return False
+
+    def discard(self, inst_or_address):
+        #drop a broken session, the next get() reconnects
+        import pyvisa
+        with self._lock:
+            address = getattr(inst_or_address, 'resource_name', inst_or_address)
+            self._drivers.pop(address, None)
+            entry = self._sessions.pop(address, None)
+            if entry is not None:
+                try:
+                    entry[0].close()
+                except pyvisa.Error:
+                    pass
+
+    def close_all(self):
+        with self._lock:
+            for address in list(self._sessions):
+                self.discard(address)
+            if self._rm is not None:
+                self._rm.close()
+                self._rm = None
+
+pool = InstrumentPool()
+atexit.register(pool.close_all)
+
+################################################################################################################################################
+#Stateful SCPI drivers: remember what was last set, only send the settings that changed (as one ';' joined write)
+#and wait for the instrument with *OPC? instead of sleeping a fixed time.
+
+class SCPIDriver:
+    settle_time = 0.0 #extra wait (s) after a change has completed, for hardware that lags the instrument
+
+    def __init__(self, inst):
+        self.inst = inst
+        self.state = {} #setting -> last command sent for it
+
+    def apply(self, settings):
+        #settings: list of (setting, command). Returns True if anything had to be sent.
+        import pyvisa
+        commands = []
+        changed = {}
+        for setting, command in settings:
+            if self.state.get(setting) != command:
+                commands.append(command if command.startswith(':') else ':' + command) #';:' restarts at the root
+                changed[setting] = command
+        if not commands:
+            return False
+        try:
+            self.inst.write(';'.join(commands))
+            self.inst.query("*OPC?") #returns once every command above has been executed
+        except pyvisa.Error:
+            self.state.clear() #unknown what was applied
+            raise
+        self.state.update(changed)
+        if self.settle_time:
+            time.sleep(self.settle_time)
+        return True
+
+    def invalidate(self):
+        self.state.clear()
+
+class Keysight33500B(SCPIDriver):
+    def set_output(self, channel, voltage, frequency):
+        return self.apply([
+            (('voltage', channel), f"SOURCE{channel}:VOLTage {voltage}Vpp"),
+            (('frequency', channel), f"SOURCE{channel}:FREQuency {frequency} HZ"),
+            (('output', channel), f"OUTPUT{channel} ON"),
+            (('sync', channel), f"OUTPUT:SYNC{channel} ON"),  # Enable synchronization for the channel
+            (('trigger_mode', channel), f"TRIGger:MODE:SOURCE{channel} IMM"),  # Set trigger mode to immediate
+            (('trigger_source', channel), f"TRIGger:SOURCE{channel} BUS"),  # Set trigger source to bus
+        ])
+
+    def output_off(self, channel):
+        return self.apply([(('output', channel), f"OUTPUT{channel} OFF")])
+
+class PFR100L(SCPIDriver):
+    settle_time = 0.01 #the helmholtz coil current needs a moment after the supply reports completion
+
+    def set_dc(self, voltage, current):
+        return self.apply([
+            ('voltage', f":SOURce:VOLTage:LEVel {voltage}"),  # Set the voltage level
+            ('current', f":SOURce:CURRent:LEVel {current}"),
+            ('output', ":OUTPut:STATe ON"),  # Turn on the output
+        ])
+
+    def output_off(self):
+        return self.apply([('output', ":OUTPut:STATe OFF")])
+
+################################################################################################################################################
+#For the Waveform Generator:
+
+@timing.timed('instrument_connect')
 def connect_waveform_generator(gpib_address):
+    import pyvisa
     try:
-        rm = pyvisa.ResourceManager()
-        inst = rm.open_resource(f'GPIB::{gpib_address}')
+        inst = pool.get(f'GPIB::{gpib_address}')
         return inst
     except pyvisa.Error as e:
         print(f"Error connecting to the waveform generator: {e}")
         return None
 
+@timing.timed('gpib_write')
 def send_voltage(inst, voltage, frequency, channel):
+    #only the changed settings are sent, *OPC? replaces the fixed sleep (see Keysight33500B)
+    import pyvisa
     try:
-        inst.write(f"SOURCE{channel}:VOLTage {voltage}Vpp")
-        inst.write(f"SOURCE{channel}:FREQuency {frequency} HZ")
-        inst.write(f"OUTPUT{channel} ON")
-        inst.write(f"OUTPUT:SYNC{channel} ON")  # Enable synchronization for the channel
-        inst.write(f"TRIGger:MODE:SOURCE{channel} IMM")  # Set trigger mode to immediate for the channel
-        inst.write(f"TRIGger:SOURCE{channel} BUS")  # Set trigger source to bus for the channel
-        print(f"Voltage set to {voltage} V")
-        print(f"Output on Channel {channel} enabled with synchronization and triggering.")
+        if pool.driver(inst, Keysight33500B).set_output(channel, voltage, frequency):
+            print(f"Voltage set to {voltage} V")
+            print(f"Output on Channel {channel} enabled with synchronization and triggering.")
     except pyvisa.Error as e:
         print(f"Error: {e}")
-    time.sleep(0.01) #to receive better data (allows time for system to adapt)
+        pool.discard(inst) #reconnect on the next use
 
-#Turn off:
+#Turn off (the session stays open in the pool):
+@timing.timed('gpib_write')
 def turn_off(inst, channel):
-    inst.write(f"OUTPUT{channel} OFF")
-    inst.close()
+    import pyvisa
+    try:
+        pool.driver(inst, Keysight33500B).output_off(channel)
+    except pyvisa.Error as e:
+        print(f"Error: {e}")
+        pool.discard(inst)
+def restore_output(inst, voltage, frequency, channel):
+    #resumed sweep: the remembered settings may not match the instrument any more, send all of them again
+    if inst is None:
+        return
+    pool.driver(inst, Keysight33500B).invalidate()
+    send_voltage(inst, voltage, frequency, channel)
+
 #example
 #waveform_generator = connect_waveform_generator(10)
 #send_voltage(waveform_generator, 0.1, 1000,1)
@@ -40,41 +213,46 @@ def turn_off(inst, channel):
 ################################################################################################################################################
 #For DC Power Supply:
 
-rm = pyvisa.ResourceManager()
-print(rm.list_resources())
+POWER_SUPPLY_ADDRESS = 'ASRL5::INSTR' #connecting via usb
 
-def connect_power_supply(serial_address):
+def configure_serial(inst):
+    inst.baud_rate = 9600  # Set the baud rate (example: 9600)
+    inst.data_bits = 8
+    #inst.parity = pyvisa.constants.Parity.none  # Set parity (example: none)
+    #inst.stop_bits = pyvisa.constants.StopBits.one  # Set stop bits (example: one)
+    #inst.timeout = 5000  # Set timeout (example: 5000 ms)
+
+@timing.timed('instrument_connect')
+def connect_power_supply(serial_address=POWER_SUPPLY_ADDRESS):
+    import pyvisa
     try:
-        rm = pyvisa.ResourceManager()
-        inst = rm.open_resource(serial_address)
-        inst.baud_rate = 9600  # Set the baud rate (example: 9600)
-        inst.data_bits = 8
-        #inst.parity = pyvisa.constants.Parity.none  # Set parity (example: none)
-        #inst.stop_bits = pyvisa.constants.StopBits.one  # Set stop bits (example: one)
-        #inst.timeout = 5000  # Set timeout (example: 5000 ms)
+        inst = pool.get(serial_address, configure=configure_serial)
         return inst
     except pyvisa.Error as e:
         print(f"Error connecting to the power supply: {e}")
         return None
 
+@timing.timed('serial_write')
 def send_dc_voltage(inst, voltage, current):
+    import pyvisa
     try:
-        # Sending the command to set the voltage level
-        inst.write(f":SOURce:VOLTage:LEVel {voltage}")  # Set the voltage level
-        inst.write(f":SOURce:CURRent:LEVel {current}")
-        inst.write(":OUTPut:STATe ON")  # Turn on the output
+        # only the changed levels are sent, then *OPC? and the coil settle time (see PFR100L)
+        pool.driver(inst, PFR100L).set_dc(voltage, current)
         #print(f"DC voltage set to {voltage} V")
 
     except pyvisa.Error as e:
         print(f"Error: {e}")
-    time.sleep(0.01)  # Allow some time for the system to adapt
+        pool.discard(inst) #reconnect on the next use
 
+@timing.timed('serial_write')
 def turn_off_dc_output(inst):
+    import pyvisa
     try:
-        inst.write(":OUTPut:STATe OFF")  # Turn off the output
+        pool.driver(inst, PFR100L).output_off()  # Turn off the output
         print("Output turned off")
     except pyvisa.Error as e:
         print(f"Error: {e}")
+        pool.discard(inst)
 
 # Example usage
 
@@ -89,8 +267,18 @@ def turn_off_dc_output(inst):
 #   turn_off_dc_output(power_supply)  # Turn off the output
 #   power_supply.close()
 
+def ramp_dc_current(inst, current, max_step=1.0, voltage=12):
+    #re-establishes the coil current after a crash: the supply state is unknown, so every setting is sent again and the
+    #current is stepped up from 0 A in max_step increments instead of one jump
+    if inst is None:
+        return
+    pool.driver(inst, PFR100L).invalidate()
+    num_steps = max(1, math.ceil(abs(current) / max_step))
+    for k in range(num_steps + 1):
+        send_dc_voltage(inst, voltage, current * k / num_steps)
+
 def DC_offset(current):
-    power_supply = connect_power_supply('ASRL5::INSTR') #connecting via usb
+    power_supply = connect_power_supply()
     voltage = 12 #volts since thisis the max of the power supply
     if power_supply:
         send_dc_voltage(power_supply, voltage, current)